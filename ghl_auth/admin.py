@@ -1,10 +1,168 @@
+from django.conf import settings
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connection
+from django.db.models import Count, Q, Sum
+from django.utils import formats
+from django.utils.functional import cached_property
+from django.utils.html import format_html, format_html_join
 from .models import GHLOAuth,Contact,Opportunity
+from .utils import to_local
 from django_celery_beat.models import PeriodicTask, IntervalSchedule
 
 
-admin.site.register(GHLOAuth)
-admin.site.register(Contact)
-admin.site.register(Opportunity)
+def estimated_rows(model):
+    """Planner row estimate of the whole table (PostgreSQL statistics, SQLite ANALYZE), or None."""
+    table = model._meta.db_table
+    try:
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass", [table])
+            elif connection.vendor == "sqlite":
+                cursor.execute("SELECT stat FROM sqlite_stat1 WHERE tbl = %s AND idx IS NULL", [table])
+            else:
+                return None
+            row = cursor.fetchone()
+    except DatabaseError:
+        return None  # no statistics gathered yet
+    if not row or row[0] is None:
+        return None
+    return int(str(row[0]).split()[0])
+
+
+class CappedCountPaginator(Paginator):
+    """
+    Counts at most ``GHL_ADMIN_COUNT_CAP`` rows instead of an exact COUNT(*)
+    over millions. Past the cap, unfiltered listings report the planner's
+    estimate and filtered ones the cap; narrow down with filters or search.
+    """
+
+    @cached_property
+    def count(self):
+        cap = settings.GHL_ADMIN_COUNT_CAP
+        counted = self.object_list.order_by().values("pk")[:cap + 1].count()
+        if counted <= cap:
+            return counted
+        if not self.object_list.query.where:
+            return max(estimated_rows(self.object_list.model) or 0, cap)
+        return cap
+
+
+def prefix_match(field, prefix):
+    """``field`` starts with ``prefix``, as a range so a plain B-tree index serves it on any backend."""
+    return Q(**{f"{field}__gte": prefix, f"{field}__lt": prefix + "\U0010ffff"})
+
+
+class LocationFilter(admin.SimpleListFilter):
+    """Connected locations, read from the small GHLOAuth table rather than DISTINCT over millions of rows."""
+
+    title = "location"
+    parameter_name = "location_id"
+
+    def lookups(self, request, model_admin):
+        return [(location_id, location_id) for location_id in GHLOAuth.objects.order_by("location_id").values_list("location_id", flat=True)]
+
+    def queryset(self, request, queryset):
+        if self.value():
+            return queryset.filter(location_id=self.value())
+        return queryset
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """
+    Changelist settings for the synced tables: capped counts, ordering that
+    follows an index, and no second COUNT(*) for the unfiltered total.
+    """
+
+    paginator = CappedCountPaginator
+    show_full_result_count = False
+    list_filter = (LocationFilter,)
+    list_per_page = 100
+
+    def get_ordering(self, request):
+        # Within a location, the (location_id, updated_at, id) index; otherwise the primary key.
+        if request.GET.get(LocationFilter.parameter_name):
+            return ("-updated_at", "-id")
+        return ("-id",)
+
+    @admin.display(description="Updated at", ordering="updated_at")
+    def updated(self, obj):
+        # Stored in UTC; shown in GHL_TIMEZONE like the read API.
+        return formats.localize(to_local(obj.updated_at))
+
+
+class ContactChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        # One grouped query for the page instead of one per row.
+        contact_ids = [contact.contact_id for contact in self.result_list]
+        totals = {
+            row["contact_id"]: row
+            for row in Opportunity.objects.filter(contact_id__in=contact_ids)
+            .values("contact_id").annotate(count=Count("id"), value=Sum("monetaryValue"))
+        }
+        for contact in self.result_list:
+            contact.opportunity_summary = totals.get(contact.contact_id)
+
+
+@admin.register(Contact)
+class ContactAdmin(LargeTableAdmin):
+    list_display = ("contact_id", "first_name", "last_name", "email", "phone", "location_id", "opportunity_count", "opportunity", "updated")
+    search_help_text = "Exact contact ID, or the start of an email address or phone number."
+    search_fields = ("contact_id",)  # enables the search box; get_search_results does the matching
+    readonly_fields = ("opportunity_list",)
+
+    def get_changelist(self, request, **kwargs):
+        return ContactChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if not term:
+            return queryset, False
+        query = Q(contact_id=term)
+        for prefix in {term, term.lower()}:  # addresses are usually stored lower case
+            query |= prefix_match("email", prefix)
+        phone = "".join(term.split())
+        if phone.lstrip("+").isdigit():
+            query |= prefix_match("phone", phone)
+        return queryset.filter(query), False
+
+    @admin.display(description="Opportunities")
+    def opportunity_count(self, contact):
+        summary = getattr(contact, "opportunity_summary", None)
+        return summary["count"] if summary else 0
+
+    @admin.display(description="Opportunities")
+    def opportunity_list(self, contact):
+        limit = settings.GHL_ADMIN_INLINE_OPPORTUNITIES
+        opportunities = list(
+            Opportunity.objects.filter(contact_id=contact.contact_id)
+            .order_by("-updated_at").values_list("opportunity_id", "name", "monetaryValue", "updated_at")[:limit + 1]
+        )
+        if not opportunities:
+            return "-"
+        rows = format_html_join(
+            "", "<tr><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>",
+            ((*row[:3], formats.localize(to_local(row[3]))) for row in opportunities[:limit]),
+        )
+        more = format_html("<p>Showing the latest {}.</p>", limit) if len(opportunities) > limit else ""
+        return format_html(
+            "<table><tr><th>ID</th><th>Name</th><th>Value</th><th>Updated</th></tr>{}</table>{}", rows, more,
+        )
+
+
+@admin.register(Opportunity)
+class OpportunityAdmin(LargeTableAdmin):
+    list_display = ("opportunity_id", "name", "contact_id", "location_id", "monetaryValue", "updated")
+    search_help_text = "Exact opportunity or contact ID."
+    search_fields = ("=opportunity_id", "=contact_id")
+
+
+@admin.register(GHLOAuth)
+class GHLOAuthAdmin(admin.ModelAdmin):
+    list_display = ("location_id", "expires_at")
+    search_fields = ("location_id",)
+    ordering = ("location_id",)
 # admin.site.register(PeriodicTask)
-# admin.site.register(IntervalSchedule)
\ No newline at end of file
+# admin.site.register(IntervalSchedule)
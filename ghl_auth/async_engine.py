@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .ghl_client import GHLAPIError
+from .pipeline import StageStats
+
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+async def _run_job(start, semaphore, executor):
+    """
+    Drive one location's pagination stream. Page fetches run on the fetch
+    executor so many streams are in flight at once; DB work goes through
+    sync_to_async, which runs it on a single thread so writes never contend.
+    """
+    async with semaphore:
+        loop = asyncio.get_running_loop()
+        job = await sync_to_async(start)()
+        if job is None:
+            return None
+
+        stats = {name: StageStats(name) for name in ("fetch", "transform", "write")}
+        pages = iter(job.pages)
+        try:
+            while True:
+                started = time.monotonic()
+                item = await loop.run_in_executor(executor, next, pages, _DONE)
+                if item is _DONE:
+                    break
+                records, next_cursor = item
+                stats["fetch"].add(len(records), time.monotonic() - started)
+
+                started = time.monotonic()
+                rows, watermark = job.transform(records)
+                stats["transform"].add(len(rows), time.monotonic() - started)
+
+                started = time.monotonic()
+                await sync_to_async(job.write)(rows, watermark, next_cursor)
+                stats["write"].add(len(rows), time.monotonic() - started)
+        except GHLAPIError as e:
+            await sync_to_async(job.abort)(e)
+            return None
+        except Exception as e:
+            await sync_to_async(job.fail)(e)
+            raise
+
+        result = {name: stage.as_dict() for name, stage in stats.items()}
+        await sync_to_async(job.complete)(result)
+        return result
+
+
+async def run_jobs(starters, concurrency=None):
+    """
+    Run location syncs concurrently inside one process. ``starters`` maps a
+    key (the location id) to a callable returning a LocationSync or None.
+    Returns ``{key: stats | None | exception}``; one failing location does
+    not stop the others.
+    """
+    concurrency = concurrency or settings.GHL_ASYNC_CONCURRENCY
+    semaphore = asyncio.Semaphore(concurrency)
+    keys = list(starters)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="ghl-async-fetch") as executor:
+        results = await asyncio.gather(
+            *(_run_job(starters[key], semaphore, executor) for key in keys),
+            return_exceptions=True,
+        )
+    return dict(zip(keys, results))
+
+
+def run_sync_jobs(starters, concurrency=None):
+    """Blocking entry point for Celery tasks."""
+    results = asyncio.run(run_jobs(starters, concurrency))
+    for key, result in results.items():
+        if isinstance(result, BaseException):
+            logger.error(f"Async sync failed for {key}: {result!r}")
+    return results
@@ -0,0 +1,317 @@
+"""
+Bulk upserts for the synced models, using the fastest path each backend has:
+
+* SQLite: multi-row ``INSERT ... VALUES (...), (...) ON CONFLICT DO UPDATE``
+  statements, as large as the connection's variable limit allows.
+* PostgreSQL: ``COPY`` into a temporary table, then one
+  ``INSERT ... SELECT ... ON CONFLICT DO UPDATE`` merge.
+* Anything else: ``bulk_create(update_conflicts=True)``.
+
+Rows carry a ``content_hash`` of their synced values. ``changed_rows``
+drops rows whose hash matches what is stored before they reach the
+database, and the native upserts only rewrite a conflicting row when its
+hash differs.
+"""
+import io
+import csv
+import hashlib
+import json
+import logging
+from datetime import datetime
+from itertools import islice
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .models import Contact, Opportunity
+
+
+logger = logging.getLogger(__name__)
+
+# Column order of the row tuples produced by the sync transforms.
+CONTACT_COLUMNS = (
+    "contact_id", "first_name", "last_name", "email", "phone", "location_id", "created_at", "updated_at",
+    "custom_fields",
+)
+OPPORTUNITY_COLUMNS = (
+    "opportunity_id", "contact_id", "name", "phone", "location_id", "monetaryValue", "created_at", "updated_at",
+    "pipeline_id", "pipeline_stage_id", "status",
+)
+# Appended by the upsert layer, never produced by the transforms.
+HASH_COLUMN = "content_hash"
+
+# Large VALUES lists stop paying off well before SQLite's variable limit.
+SQLITE_MAX_ROWS_PER_STATEMENT = 500
+
+# Types whose Python values the DB-API drivers already accept as is.
+_PASSTHROUGH_TYPES = {"CharField", "TextField", "FloatField", "IntegerField", "BigIntegerField", "BooleanField"}
+
+
+def _json_dumps(value):
+    return None if value is None else json.dumps(value)
+
+
+def _hash_default(value):
+    if isinstance(value, datetime):
+        return value.timestamp()  # same instant, same hash, whatever the timezone
+    return str(value)
+
+
+def content_hash(row):
+    """16 hex chars identifying a row's synced values."""
+    payload = json.dumps(row, default=_hash_default, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(payload.encode(), digest_size=8).hexdigest()
+
+
+class UpsertSpec:
+    """
+    Table, columns and conflict target of one model's upsert. ``columns``
+    are the transform's row columns; ``HASH_COLUMN`` is appended to them.
+    """
+
+    def __init__(self, model, columns, conflict_column, update_columns):
+        self.model = model
+        self.data_columns = columns
+        self.columns = columns + (HASH_COLUMN,)
+        self.conflict_column = conflict_column
+        self.update_columns = update_columns + (HASH_COLUMN,)
+        self.fields = [model._meta.get_field(column) for column in self.columns]
+
+    @property
+    def table(self):
+        return self.model._meta.db_table
+
+    def with_hashes(self, rows):
+        """Append the content hash to rows that don't carry one yet."""
+        if not rows or len(rows[0]) == len(self.columns):
+            return rows
+        return [row + (content_hash(row),) for row in rows]
+
+    def prepare(self, rows, connection, fast_converters=None):
+        """
+        Adapt datetime/JSON values the way the model fields would on save.
+        ``fast_converters`` maps an internal field type to a cheaper
+        single-argument converter for the hot path, or to None when the
+        driver adapts the value itself.
+        """
+        fast_converters = fast_converters or {}
+        converters = []
+        for field in self.fields:
+            field_type = field.get_internal_type()
+            if field_type in _PASSTHROUGH_TYPES:
+                converters.append(None)
+            elif field_type in fast_converters:
+                converters.append(fast_converters[field_type])
+            else:
+                converters.append(lambda value, field=field: field.get_db_prep_save(value, connection))
+        if not any(converters):
+            return rows
+        return [
+            tuple(value if convert is None else convert(value) for convert, value in zip(converters, row))
+            for row in rows
+        ]
+
+
+def contact_spec():
+    return UpsertSpec(
+        Contact, CONTACT_COLUMNS, "contact_id",
+        ("first_name", "last_name", "email", "phone", "created_at", "updated_at", "custom_fields"),
+    )
+
+
+def opportunity_spec():
+    return UpsertSpec(
+        Opportunity, OPPORTUNITY_COLUMNS, "opportunity_id",
+        # contact_id too: an opportunity can be reassigned to another contact.
+        ("contact_id", "name", "phone", "monetaryValue", "created_at", "updated_at", "pipeline_id", "pipeline_stage_id", "status"),
+    )
+
+
+def _conflict_clause(spec, qn, distinct="IS NOT"):
+    """``distinct`` is the backend's null-safe inequality: ``IS NOT`` on SQLite, ``IS DISTINCT FROM`` on PostgreSQL."""
+    assignments = ", ".join(f"{qn(column)} = EXCLUDED.{qn(column)}" for column in spec.update_columns)
+    hash_column = qn(HASH_COLUMN)
+    return (
+        f"ON CONFLICT ({qn(spec.conflict_column)}) DO UPDATE SET {assignments} "
+        f"WHERE {qn(spec.table)}.{hash_column} {distinct} EXCLUDED.{hash_column}"
+    )
+
+
+def _sqlite_rows_per_statement(spec, connection):
+    connection.ensure_connection()
+    try:
+        import sqlite3
+        limit = connection.connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    except AttributeError:  # Python < 3.11
+        limit = connection.features.max_query_params
+    return max(1, min(SQLITE_MAX_ROWS_PER_STATEMENT, limit // len(spec.columns)))
+
+
+def upsert_sqlite(spec, rows, connection):
+    qn = connection.ops.quote_name
+    # Datetimes as the ORM stores them (naive UTC text), so stored values sort
+    # and compare the same whichever timezone the transform produced.
+    rows = spec.prepare(rows, connection, {
+        "DateTimeField": connection.ops.adapt_datetimefield_value, "JSONField": _json_dumps,
+    })
+    per_statement = _sqlite_rows_per_statement(spec, connection)
+    columns = ", ".join(qn(column) for column in spec.columns)
+    placeholder = "(" + ", ".join(["?"] * len(spec.columns)) + ")"
+    conflict = _conflict_clause(spec, qn)
+
+    def statement(row_count):
+        values = ", ".join([placeholder] * row_count)
+        return f"INSERT INTO {qn(spec.table)} ({columns}) VALUES {values} {conflict}"
+
+    full_statement = statement(per_statement)
+    # Straight to sqlite3: skips Django's per-query placeholder rewrite and,
+    # with DEBUG on, the logging of every multi-thousand-parameter statement.
+    raw = connection.connection
+    for start in range(0, len(rows), per_statement):
+        chunk = rows[start:start + per_statement]
+        sql = full_statement if len(chunk) == per_statement else statement(len(chunk))
+        raw.execute(sql, [value for row in chunk for value in row])
+
+
+def _copy_rows(cursor, table, columns, rows):
+    raw = cursor.cursor  # the driver cursor behind Django's wrapper
+    copy_sql = f"COPY {table} ({columns}) FROM STDIN"
+    if hasattr(raw, "copy"):  # psycopg 3
+        with raw.copy(copy_sql) as copy:
+            for row in rows:
+                copy.write_row(row)
+        return
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["\\N" if value is None else value for value in row])
+    buffer.seek(0)
+    raw.copy_expert(f"{copy_sql} WITH (FORMAT csv, NULL '\\N')", buffer)  # psycopg2
+
+
+def upsert_postgresql(spec, rows, connection):
+    qn = connection.ops.quote_name
+    # Serialized JSON text loads into jsonb through COPY on either driver.
+    rows = spec.prepare(rows, connection, {"JSONField": _json_dumps})
+    staging = qn(f"_upsert_{spec.table.lower()}")
+    columns = ", ".join(qn(column) for column in spec.columns)
+    key = qn(spec.conflict_column)
+
+    # ON COMMIT DROP: in autocommit the staging table would be gone before the COPY.
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {staging}")
+        cursor.execute(
+            f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+            f"SELECT {columns} FROM {qn(spec.table)} WITH NO DATA"
+        )
+        _copy_rows(cursor, staging, columns, rows)
+        # DISTINCT ON: a conflict target may only be touched once per statement.
+        cursor.execute(
+            f"INSERT INTO {qn(spec.table)} ({columns}) "
+            f"SELECT DISTINCT ON ({key}) {columns} FROM {staging} ORDER BY {key} "
+            f"{_conflict_clause(spec, qn, 'IS DISTINCT FROM')}"
+        )
+
+
+def upsert_generic(spec, rows, connection):
+    objs = [spec.model(**dict(zip(spec.columns, row))) for row in rows]
+    spec.model.objects.using(connection.alias).bulk_create(
+        objs,
+        update_conflicts=True,
+        unique_fields=[spec.conflict_column],
+        update_fields=list(spec.update_columns),
+    )
+
+
+STRATEGIES = {
+    "sqlite": upsert_sqlite,
+    "postgresql": upsert_postgresql,
+}
+
+
+def bulk_upsert(spec, rows, using="default", strategy=None):
+    """Upsert ``rows`` (tuples in ``spec.columns`` order) with the backend's fastest strategy."""
+    if not rows:
+        return 0
+    connection = connections[using]
+    upsert = strategy or STRATEGIES.get(connection.vendor, upsert_generic)
+    upsert(spec, spec.with_hashes(rows), connection)
+    return len(rows)
+
+
+def stored_hashes(spec, keys, using="default"):
+    """``{key: content_hash}`` of the stored rows among ``keys``."""
+    keys = list(keys)
+    hashes = {}
+    manager = spec.model.objects.using(using)
+    for start in range(0, len(keys), 500):
+        hashes.update(
+            manager.filter(**{f"{spec.conflict_column}__in": keys[start:start + 500]})
+            .values_list(spec.conflict_column, HASH_COLUMN)
+        )
+    return hashes
+
+
+class HashIndex:
+    """
+    Stored content hashes of one location, loaded once so unchanged rows
+    are filtered out without a query per batch. Locations with more than
+    ``GHL_HASH_INDEX_MAX_ROWS`` rows fall back to per-batch lookups, which
+    keeps a sync's memory independent of location size.
+    """
+
+    def __init__(self, spec, location_id, max_rows=None, using="default"):
+        self.spec = spec
+        self.location_id = location_id
+        self.max_rows = settings.GHL_HASH_INDEX_MAX_ROWS if max_rows is None else max_rows
+        self.using = using
+        self.hashes = None
+        self.loaded = False
+
+    def _load(self):
+        self.loaded = True
+        rows = (
+            self.spec.model.objects.using(self.using).filter(location_id=self.location_id)
+            .values_list(self.spec.conflict_column, HASH_COLUMN).iterator(chunk_size=5000)
+        )
+        hashes = dict(islice(rows, self.max_rows + 1))
+        if len(hashes) <= self.max_rows:
+            self.hashes = hashes
+        else:
+            logger.info(f"{self.spec.table} of {self.location_id} exceeds the hash index cap, using per-batch lookups")
+
+    def get_many(self, keys):
+        if not self.loaded:
+            self._load()
+        if self.hashes is None:
+            return stored_hashes(self.spec, keys, self.using)
+        return {key: self.hashes[key] for key in keys if key in self.hashes}
+
+    def update(self, rows):
+        if self.hashes is not None:
+            self.hashes.update((row[0], row[-1]) for row in rows)
+
+
+def changed_rows(spec, rows, hashes=None, using="default"):
+    """
+    Hash ``rows`` and keep those that are new or differ from the stored
+    row, looked up in ``hashes`` (a HashIndex) or, without one, the database.
+    The conflict column must be the first column. A key appearing more than
+    once (overlapping pages, replayed webhooks) keeps only its last row.
+    """
+    rows = list({row[0]: row for row in spec.with_hashes(rows)}.values())
+    keys = [row[0] for row in rows]
+    current = hashes.get_many(keys) if hashes is not None else stored_hashes(spec, keys, using)
+    changed = [row for row in rows if current.get(row[0]) != row[-1]]
+    if hashes is not None:
+        hashes.update(changed)
+    return changed
+
+
+def upsert_contacts(rows, using="default"):
+    return bulk_upsert(contact_spec(), rows, using)
+
+
+def upsert_opportunities(rows, using="default"):
+    return bulk_upsert(opportunity_spec(), rows, using)
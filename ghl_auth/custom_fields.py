@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .ghl_client import GHLAPIError, get_client
+
+
+logger = logging.getLogger(__name__)
+
+
+class CustomFieldCache:
+    """
+    Per-location custom field definitions (``{field_id: definition}``).
+
+    Two tiers: an in-process LRU with a TTL in front of the shared Django
+    cache (Redis in production). A miss on both fills them with a single
+    ``GET /locations/{id}/customFields`` call for the whole location.
+    """
+
+    def __init__(self, max_locations=None, ttl=None, shared_cache=None):
+        self.max_locations = max_locations or settings.GHL_CUSTOM_FIELD_CACHE_SIZE
+        self.ttl = ttl or settings.GHL_CUSTOM_FIELD_CACHE_TTL
+        self.shared_cache = shared_cache or cache
+        self._local = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, location_id):
+        return f"ghl:custom_fields:{location_id}"
+
+    def _get_local(self, location_id):
+        with self._lock:
+            entry = self._local.get(location_id)
+            if entry is None:
+                return None
+            expires_at, definitions = entry
+            if expires_at <= time.monotonic():
+                del self._local[location_id]
+                return None
+            self._local.move_to_end(location_id)
+            return definitions
+
+    def _set_local(self, location_id, definitions):
+        with self._lock:
+            self._local[location_id] = (time.monotonic() + self.ttl, definitions)
+            self._local.move_to_end(location_id)
+            while len(self._local) > self.max_locations:
+                self._local.popitem(last=False)
+
+    def fetch(self, location_id, access_token):
+        """
+        Raises GHLAPIError when the definitions can't be fetched: syncing with
+        an empty map would store custom fields keyed by raw field IDs.
+        """
+        try:
+            response = get_client().get(
+                f"/locations/{location_id}/customFields", access_token=access_token, location_id=location_id,
+            )
+        except Exception as e:
+            logger.error(f"Error fetching custom fields for {location_id}: {str(e)}")
+            raise GHLAPIError(f"Custom fields request failed for {location_id}: {str(e)}") from e
+        if response.status_code != 200:
+            logger.error(f"Failed to fetch custom fields for {location_id}, status: {response.status_code}")
+            raise GHLAPIError(f"Custom fields request failed for {location_id}", response.status_code)
+        try:
+            fields = response.json().get("customFields", [])
+        except ValueError as e:
+            logger.error(f"Invalid custom fields response for {location_id}: {str(e)}")
+            raise GHLAPIError(f"Invalid custom fields response for {location_id}") from e
+        return {field["id"]: field for field in fields if field.get("id")}
+
+    def get(self, location_id, access_token):
+        definitions = self._get_local(location_id)
+        if definitions is not None:
+            return definitions
+
+        definitions = self.shared_cache.get(self._key(location_id))
+        if definitions is None:
+            definitions = self.fetch(location_id, access_token)  # a failure isn't cached; the retry fetches again
+            self.shared_cache.set(self._key(location_id), definitions, timeout=self.ttl)
+
+        self._set_local(location_id, definitions)
+        return definitions
+
+    def invalidate(self, location_id):
+        with self._lock:
+            self._local.pop(location_id, None)
+        self.shared_cache.delete(self._key(location_id))
+
+
+_field_cache = None
+
+
+def get_field_cache():
+    global _field_cache
+    if _field_cache is None:
+        _field_cache = CustomFieldCache()
+    return _field_cache
+
+
+def get_custom_field_definitions(location_id, access_token):
+    return get_field_cache().get(location_id, access_token)
+
+
+def resolve_custom_fields(custom_fields, definitions):
+    """
+    Turn a contact's ``[{"id": ..., "value": ...}]`` list into
+    ``{field name: value}``; unknown field IDs are kept as keys.
+    """
+    values = {}
+    for field in custom_fields or []:
+        field_id = field.get("id")
+        if not field_id:
+            continue
+        definition = definitions.get(field_id)
+        name = definition.get("name") if definition else None
+        values[name or field_id] = field.get("value", field.get("fieldValue"))
+    return values
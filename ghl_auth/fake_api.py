@@ -0,0 +1,247 @@
+"""
+A local stand-in for the LeadConnector API, for tests and offline
+benchmarks. It serves the endpoints the sync uses from a deterministic
+dataset generated on demand, so millions of records cost no memory:
+
+* ``POST /contacts/search`` with ``searchAfter`` cursors and the
+  ``dateUpdated`` range filter,
+* ``GET /opportunities/search`` with ``startAfter``/``startAfterId`` cursors,
+* ``GET /locations/{id}/customFields``,
+* ``POST /oauth/token``, rotating refresh tokens and rejecting reused ones.
+
+Every ``error_every``-th API call fails with the next status from
+``error_statuses`` (429s carry GHL's rate-limit headers), and search pages
+can be slowed down with ``page_latency``.
+
+    with FakeGHLServer(contacts=10_000) as server:
+        with override_settings(GHL_API_BASE_URL=server.url):
+            ...
+"""
+import itertools
+import json
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+BASE_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc)
+CUSTOM_FIELDS = [
+    {"id": "cf-twitter", "name": "Twitter", "fieldKey": "contact.twitter"},
+    {"id": "cf-instagram", "name": "Instagram", "fieldKey": "contact.instagram"},
+]
+
+
+def _iso(moment):
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.") + f"{moment.microsecond // 1000:03d}Z"
+
+
+def _parse_iso(value):
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+class FakeGHLServer:
+    def __init__(self, contacts=1000, opportunities_per_contact=1, page_latency=0.0,
+                 error_every=0, error_statuses=(429, 520), retry_after_ms=50, host="127.0.0.1", port=0):
+        self.contacts = contacts
+        self.opportunities_per_contact = opportunities_per_contact
+        self.page_latency = page_latency
+        self.error_every = error_every
+        self.retry_after_ms = retry_after_ms
+        self._error_statuses = itertools.cycle(error_statuses)
+        self._counts = Counter()
+        self._used_refresh_tokens = set()
+        self._token_serial = itertools.count(1)
+        self._lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="fake-ghl-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        """Calls served per endpoint, plus ``injected`` errors and ``api_calls`` in total."""
+        with self._lock:
+            return dict(self._counts)
+
+    def _count(self, endpoint):
+        with self._lock:
+            self._counts[endpoint] += 1
+            if endpoint != "oauth":
+                self._counts["api_calls"] += 1
+            call_number = self._counts["api_calls"]
+        if endpoint != "oauth" and self.error_every and call_number % self.error_every == 0:
+            with self._lock:
+                self._counts["injected"] += 1
+                return next(self._error_statuses)
+        return None
+
+    # Dataset: record i of a location is updated at BASE_TIME + i seconds.
+
+    def contact(self, loc_id, i):
+        return {
+            "id": f"{loc_id}-c{i}",
+            "locationId": loc_id,
+            "firstNameLowerCase": f"first{i}",
+            "lastNameLowerCase": "contact",
+            "email": f"c{i}@{loc_id}.example.com",
+            "phone": f"+1555{i:07d}",
+            "dateAdded": _iso(BASE_TIME + timedelta(seconds=i)),
+            "dateUpdated": _iso(BASE_TIME + timedelta(seconds=i)),
+            "tags": ["fake"],
+            "customFields": [{"id": "cf-twitter", "value": f"@c{i}"}],
+            "searchAfter": [i, f"{loc_id}-c{i}"],
+        }
+
+    def opportunity(self, loc_id, j):
+        updated = BASE_TIME + timedelta(seconds=j)
+        return {
+            "id": f"{loc_id}-o{j}",
+            "locationId": loc_id,
+            "contactId": f"{loc_id}-c{j // self.opportunities_per_contact}",
+            "name": f"Deal {j}",
+            "monetaryValue": float((j % 10 + 1) * 100),
+            "pipelineId": "pipeline-1",
+            "pipelineStageId": f"stage-{j % 4}",
+            "status": ("open", "open", "won", "lost")[j % 4],
+            "createdAt": _iso(updated),
+            "updatedAt": _iso(updated),
+        }
+
+    def search_contacts(self, body):
+        loc_id = body["locationId"]
+        limit = int(body.get("pageLimit") or 20)
+        start = body["searchAfter"][0] + 1 if body.get("searchAfter") else 0
+        for condition in body.get("filters") or []:
+            if condition.get("field") == "dateUpdated" and "gt" in (condition.get("value") or {}):
+                since = _parse_iso(condition["value"]["gt"])
+                start = max(start, int((since - BASE_TIME).total_seconds()) + 1)
+        end = min(max(start, 0) + limit, self.contacts)
+        contacts = [self.contact(loc_id, i) for i in range(max(start, 0), end)]
+        return {"contacts": contacts, "total": self.contacts}
+
+    def search_opportunities(self, params):
+        loc_id = params["location_id"]
+        limit = int(params.get("limit") or 20)
+        start = 0
+        if params.get("startAfterId"):
+            start = int(params["startAfterId"].rsplit("-o", 1)[1]) + 1
+        total = self.contacts * self.opportunities_per_contact
+        end = min(start + limit, total)
+        opportunities = [self.opportunity(loc_id, j) for j in range(start, end)]
+        meta = {"total": total}
+        if end < total and opportunities:
+            last = BASE_TIME + timedelta(seconds=end - 1)
+            meta.update(startAfter=int(last.timestamp() * 1000), startAfterId=opportunities[-1]["id"])
+        return {"opportunities": opportunities, "meta": meta}
+
+    def issue_token(self, form):
+        if form.get("grant_type") == "refresh_token":
+            refresh_token = form.get("refresh_token")
+            with self._lock:
+                if not refresh_token or refresh_token in self._used_refresh_tokens:
+                    return 400, {"error": "invalid_grant", "error_description": "Refresh token already used"}
+                self._used_refresh_tokens.add(refresh_token)
+        serial = next(self._token_serial)
+        return 200, {
+            "access_token": f"fake-access-{serial}",
+            "refresh_token": f"fake-refresh-{serial}",
+            "token_type": "Bearer",
+            "expires_in": 86399,
+            "locationId": form.get("location_id") or form.get("code") or "fake-location",
+        }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _route(self, method):
+        fake = self.server.fake
+        url = urlsplit(self.path)
+        path = url.path.rstrip("/")
+        body = self._body()
+
+        if method == "POST" and path == "/oauth/token":
+            fake._count("oauth")
+            form = {key: values[-1] for key, values in parse_qs(body.decode()).items()}
+            return self._send(*fake.issue_token(form))
+
+        if not (self.headers.get("Authorization") or "").startswith("Bearer "):
+            return self._send(401, {"message": "Invalid JWT"})
+
+        if method == "POST" and path == "/contacts/search":
+            endpoint = "contacts"
+        elif method == "GET" and path == "/opportunities/search":
+            endpoint = "opportunities"
+        elif method == "GET" and path.startswith("/locations/") and path.endswith("/customFields"):
+            endpoint = "custom_fields"
+        else:
+            return self._send(404, {"message": "Not found"})
+
+        injected = fake._count(endpoint)
+        if injected == 429:
+            return self._send(429, {"message": "Too many requests"}, {
+                "X-RateLimit-Remaining": "0",
+                "X-RateLimit-Interval-Milliseconds": str(fake.retry_after_ms),
+            })
+        if injected:
+            return self._send(injected, {"message": "Injected failure"})
+
+        if endpoint == "custom_fields":
+            return self._send(200, {"customFields": CUSTOM_FIELDS})
+
+        if fake.page_latency:
+            time.sleep(fake.page_latency)
+        if endpoint == "contacts":
+            return self._send(200, fake.search_contacts(json.loads(body or b"{}")))
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        return self._send(200, fake.search_opportunities(params))
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
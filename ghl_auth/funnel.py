@@ -0,0 +1,96 @@
+"""
+Single-writer funnel for SQLite. With ``GHL_SYNC_WRITE_MODE = "funnel"``
+fetch workers don't write to the database at all: the start of each run,
+every batch flush and the end of the run become messages on the
+``GHL_WRITER_QUEUE`` broker queue. One ``run_batch_writer`` process applies
+them in order, many batches per transaction, so adding fetch workers never
+adds writers. Messages carry running totals and idempotent upserts, so
+applying them again after a writer crash changes nothing.
+"""
+import queue
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from kombu import Connection
+
+
+def encode_rows(rows):
+    """Row tuples as JSON-safe lists; datetimes become ISO strings (offset kept)."""
+    return [[value.isoformat() if isinstance(value, datetime) else value for value in row] for row in rows]
+
+
+def decode_rows(spec, rows):
+    """Inverse of ``encode_rows`` for rows in ``spec.data_columns`` order."""
+    datetime_columns = {
+        index for index, column in enumerate(spec.data_columns)
+        if spec.model._meta.get_field(column).get_internal_type() == "DateTimeField"
+    }
+    return [
+        tuple(
+            datetime.fromisoformat(value) if index in datetime_columns and value is not None else value
+            for index, value in enumerate(row)
+        )
+        for row in rows
+    ]
+
+
+def encode_datetime(value):
+    return value.isoformat() if value else None
+
+
+def decode_datetime(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+class BatchQueue:
+    """The writer queue, over a long-lived broker connection (kombu SimpleQueue)."""
+
+    def __init__(self, url=None, name=None):
+        self.url = url or settings.GHL_WRITER_BROKER_URL
+        self.name = name or settings.GHL_WRITER_QUEUE
+        self._connection = None
+        self._queue = None
+        self._lock = threading.Lock()
+
+    def _simple_queue(self):
+        if self._queue is None:
+            self._connection = Connection(self.url)
+            self._queue = self._connection.SimpleQueue(self.name)
+        return self._queue
+
+    def put(self, message):
+        with self._lock:
+            # Batches are thousands of similar rows; zlib shrinks them several times over.
+            self._simple_queue().put(message, serializer="json", compression="zlib")
+
+    def get(self, timeout=None):
+        """Next kombu message (``.payload``, ``.ack()``, ``.requeue()``); raises ``BatchQueue.Empty``."""
+        with self._lock:
+            return self._simple_queue().get(block=True, timeout=timeout)
+
+    def close(self):
+        with self._lock:
+            if self._queue is not None:
+                self._queue.close()
+                self._connection.release()
+            self._queue = self._connection = None
+
+    Empty = queue.Empty
+
+
+_queue = None
+
+
+def get_batch_queue():
+    global _queue
+    if _queue is None:
+        _queue = BatchQueue()
+    return _queue
+
+
+def reset_batch_queue():
+    global _queue
+    if _queue is not None:
+        _queue.close()
+    _queue = None
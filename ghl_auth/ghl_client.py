@@ -0,0 +1,192 @@
+import logging
+import os
+import threading
+import time
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .metrics import HTTP_REQUEST_SECONDS
+from .rate_limit import get_rate_limiter, jittered_backoff, retry_after_seconds
+
+
+logger = logging.getLogger(__name__)
+
+# Statuses worth another attempt: throttling, transient gateway errors and
+# Cloudflare's 520 which LeadConnector returns under load.
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504, 520})
+
+
+class GHLAPIError(Exception):
+    """Raised when a page could not be fetched after all retries."""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class GHLClient:
+    """
+    Thin wrapper around a pooled requests.Session for the LeadConnector API.
+
+    One instance is shared by every call site in a worker process so TCP/TLS
+    connections are kept alive across pages, locations and tasks.
+    """
+
+    def __init__(self, base_url=None, version=None, timeout=None, pool_size=None,
+                 max_retries=None, backoff_factor=None, rate_limiter=None):
+        self.base_url = (base_url or settings.GHL_API_BASE_URL).rstrip("/")
+        self.version = version or settings.GHL_API_VERSION
+        self.timeout = timeout or settings.GHL_HTTP_TIMEOUT
+        self.max_retries = settings.GHL_HTTP_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_factor = settings.GHL_HTTP_BACKOFF if backoff_factor is None else backoff_factor
+        pool_size = pool_size or settings.GHL_HTTP_POOL_SIZE
+        self.rate_limiter = rate_limiter or get_rate_limiter()
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Version": self.version,
+            "Accept": "application/json",
+        })
+        # Retries are handled in request() so every call site gets the same policy.
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._retries = 0
+        self._throttled = 0
+
+    def url(self, path):
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def endpoint_label(self, path, location_id=None):
+        """``path`` without host, query string or location ID, to keep metric labels few."""
+        if path.startswith(self.base_url):
+            path = path[len(self.base_url):]
+        path = "/" + path.split("?", 1)[0].lstrip("/")
+        if location_id:
+            path = path.replace(location_id, "{locationId}")
+        return path
+
+    def request(self, method, path, access_token=None, headers=None, location_id=None, retry=True, **kwargs):
+        """
+        Send a request through the shared rate limiter, retrying transient
+        failures with jittered exponential backoff. 429s wait for as long as
+        ``Retry-After`` / the rate-limit headers ask, for every worker.
+
+        ``retry=False`` sends the request exactly once. Use it for calls that
+        must not be replayed, like ``POST /oauth/token``: GHL may have consumed
+        the refresh token or auth code even though the response was lost.
+
+        The last response is returned once retries are exhausted so callers can
+        keep inspecting ``status_code`` as before; connection errors are raised.
+        """
+        max_retries = self.max_retries if retry else 0
+        request_headers = {}
+        if access_token:
+            request_headers["Authorization"] = f"Bearer {access_token}"
+        if headers:
+            request_headers.update(headers)
+        kwargs.setdefault("timeout", self.timeout)
+        url = self.url(path)
+        endpoint = self.endpoint_label(path, location_id)
+
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(location_id)
+            with self._lock:
+                self._requests += 1
+            throttled = False
+            started = time.monotonic()
+            try:
+                response = self.session.request(method, url, headers=request_headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                HTTP_REQUEST_SECONDS.observe(time.monotonic() - started, method=method, endpoint=endpoint, status="error")
+                if attempt >= max_retries:
+                    raise
+                logger.warning(f"{method} {url} failed ({e}), retrying")
+            else:
+                HTTP_REQUEST_SECONDS.observe(
+                    time.monotonic() - started, method=method, endpoint=endpoint, status=response.status_code,
+                )
+                if response.status_code == 429:
+                    throttled = True
+                    with self._lock:
+                        self._throttled += 1
+                    wait = retry_after_seconds(response) or jittered_backoff(attempt, self.backoff_factor)
+                    self.rate_limiter.penalize(location_id, wait)
+                if response.status_code not in RETRY_STATUSES or attempt >= max_retries:
+                    return response
+                logger.warning(f"{method} {url} returned {response.status_code}, retrying")
+
+            with self._lock:
+                self._retries += 1
+            # After a 429 the limiter's cooldown does the waiting on the next acquire().
+            if not throttled:
+                time.sleep(jittered_backoff(attempt, self.backoff_factor))
+            attempt += 1
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def stats(self):
+        """Connection-reuse counters aggregated over every pooled host."""
+        opened = 0
+        pooled_requests = 0
+        for adapter in self.session.adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                opened += pool.num_connections
+                pooled_requests += pool.num_requests
+
+        with self._lock:
+            return {
+                "requests": self._requests,
+                "retries": self._retries,
+                "throttled": self._throttled,
+                "connections_opened": opened,
+                "connections_reused": max(pooled_requests - opened, 0),
+            }
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the process-wide client, creating a fresh one after a fork so
+    prefork Celery children never share sockets with their parent.
+    """
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = GHLClient()
+                _client_pid = pid
+    return _client
+
+
+def reset_client():
+    """Close and drop the process-wide client; the next get_client() uses current settings."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = None
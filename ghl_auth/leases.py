@@ -0,0 +1,115 @@
+import logging
+import time
+import uuid
+
+from celery import current_task
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+
+def lease_key(location_id, entity):
+    return f"ghl:sync_lease:{location_id}:{entity}"
+
+
+def current_task_id():
+    """Id of the Celery task running this code, or None outside a worker."""
+    request = getattr(current_task, "request", None)
+    return getattr(request, "id", None)
+
+
+class SyncLease:
+    """
+    At most one sync per location and entity, held in the shared cache.
+
+    The holder stores ``{"token", "task_id", "run_id"}`` under the key, so a
+    duplicate trigger can report the run it attached to. A lease can be
+    claimed up front for a task that has not started yet (``task_id``); the
+    worker running that task adopts it. Leases expire after
+    ``GHL_SYNC_LEASE_SECONDS`` unless renewed, so a crashed worker blocks
+    its location for at most that long.
+    """
+
+    def __init__(self, location_id, entity, task_id=None, ttl=None, shared_cache=None):
+        self.location_id = location_id
+        self.entity = entity
+        self.key = lease_key(location_id, entity)
+        self.task_id = task_id
+        self.token = uuid.uuid4().hex
+        self.run_id = None
+        self.ttl = ttl or settings.GHL_SYNC_LEASE_SECONDS
+        self.shared_cache = shared_cache or cache
+        self.holder = None
+        self._renewed_at = 0.0
+
+    @classmethod
+    def held(cls, location_id, entity, token):
+        """
+        The lease stored under ``token``, for another process (the funnel
+        writer) to renew, attach a run to or release; None once it has
+        lapsed or been taken over.
+        """
+        lease = cls(location_id, entity)
+        holder = lease.shared_cache.get(lease.key)
+        if holder is None or holder.get("token") != token:
+            return None
+        lease.token, lease.task_id, lease.run_id = token, holder.get("task_id"), holder.get("run_id")
+        return lease
+
+    def value(self):
+        return {"token": self.token, "task_id": self.task_id, "run_id": self.run_id}
+
+    def _store(self):
+        self.shared_cache.set(self.key, self.value(), timeout=self.ttl)
+        self._renewed_at = time.monotonic()
+
+    def acquire(self):
+        """Take the lease. When someone else holds it, returns False and sets ``holder``."""
+        for _ in range(2):
+            if self.shared_cache.add(self.key, self.value(), timeout=self.ttl):
+                self._renewed_at = time.monotonic()
+                self.holder = None
+                return True
+            holder = self.shared_cache.get(self.key)
+            if holder is None:
+                continue  # expired between add and get
+            if self.task_id and holder.get("task_id") == self.task_id:
+                # Claimed for this task when it was queued, or held by an earlier try of it.
+                self._store()
+                self.holder = None
+                return True
+            self.holder = holder
+            return False
+        return False
+
+    def attach(self, run_id):
+        """Publish the run this lease covers, so duplicate triggers can return it."""
+        self.run_id = run_id
+        self._store()
+
+    def renew(self):
+        """Extend the lease; cheap to call per page, it only hits the cache every third of the TTL."""
+        if time.monotonic() - self._renewed_at < self.ttl / 3:
+            return
+        holder = self.shared_cache.get(self.key)
+        if holder is not None and holder.get("token") != self.token:
+            logger.warning(f"Sync lease of {self.entity} for {self.location_id} expired and was taken over")
+            self._renewed_at = time.monotonic()
+            return
+        self._store()
+
+    def hand_over(self):
+        """
+        Keep the lease held after this worker is done with it, for whoever
+        releases it by token. Retries of the task no longer adopt it.
+        """
+        self.task_id = None
+        self._store()
+
+    def release(self):
+        holder = self.shared_cache.get(self.key)
+        if holder is not None and holder.get("token") == self.token:
+            self.shared_cache.delete(self.key)
+
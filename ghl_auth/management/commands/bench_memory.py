@@ -0,0 +1,122 @@
+import gc
+import resource
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+
+from ghl_auth.models import SyncState
+from ghl_auth.pipeline import run_pipelined, run_sequential
+from ghl_auth.tasks import BatchWriter, contact_rows, fetch_contact_pages, store_contacts
+
+
+class Rollback(Exception):
+    pass
+
+
+class FakeResponse:
+    status_code = 200
+    text = ""
+
+    def __init__(self, payload):
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+
+class SimulatedLocation:
+    """Serves ``/contacts/search`` pages for ``count`` contacts, built on demand."""
+
+    def __init__(self, count):
+        self.count = count
+
+    def post(self, path, json, **kwargs):
+        start = json["searchAfter"][0] + 1 if json.get("searchAfter") else 0
+        end = min(start + json["pageLimit"], self.count)
+        return FakeResponse({"contacts": [
+            {
+                "id": f"mem-{i}",
+                "firstNameLowerCase": "first",
+                "lastNameLowerCase": f"last{i}",
+                "email": f"mem-{i}@example.com",
+                "phone": "+10000000000",
+                "dateAdded": "2024-01-01T00:00:00.000Z",
+                "dateUpdated": "2024-06-01T12:00:00.000Z",
+                "tags": ["imported", "newsletter"],
+                "customFields": [{"id": "f1", "value": f"@mem{i}"}],
+                "searchAfter": None if i == self.count - 1 else [i, f"mem-{i}"],
+            }
+            for i in range(start, end)
+        ]})
+
+
+def rss_mb():
+    """Current resident set size; falls back to the peak where /proc is missing."""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Command(BaseCommand):
+    help = "Sync a simulated location through the streaming pipeline and report RSS (rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--contacts", type=int, default=1_000_000)
+        parser.add_argument("--sample-every", type=int, default=100_000, help="Rows between RSS samples")
+        parser.add_argument("--pipelined", action="store_true")
+        parser.add_argument(
+            "--debug", action="store_true",
+            help="Keep DEBUG query logging on (Django keeps up to 9000 queries, which shows up as growth)",
+        )
+
+    def handle(self, *args, **options):
+        with override_settings(DEBUG=options["debug"] and settings.DEBUG):
+            self.bench(options)
+
+    def bench(self, options):
+        loc_id = "bench-memory"
+        sample_every = options["sample_every"]
+        samples = []
+
+        gc.collect()
+        baseline = rss_mb()
+        self.stdout.write(f"Baseline RSS {baseline:.1f} MB, syncing {options['contacts']:,} contacts")
+
+        started = time.perf_counter()
+        try:
+            with transaction.atomic():
+                state = SyncState.for_location(loc_id, SyncState.CONTACTS)
+                writer = BatchWriter(state, store_contacts, full_sync=True)
+
+                def write(rows, watermark, next_cursor):
+                    before = writer.rows_flushed + len(writer.pending)
+                    writer.write(rows, watermark, next_cursor)
+                    after = writer.rows_flushed + len(writer.pending)
+                    if after // sample_every > before // sample_every:
+                        samples.append((after, rss_mb()))
+                        self.stdout.write(f"{after:>10,} rows  RSS {samples[-1][1]:7.1f} MB")
+
+                pages = fetch_contact_pages(SimulatedLocation(options["contacts"]), loc_id, "token")
+                transform = lambda records: contact_rows(records, loc_id)
+                run = run_pipelined if options["pipelined"] else run_sequential
+                run(pages, transform, write)
+                writer.flush()
+                raise Rollback()
+        except Rollback:
+            pass
+        elapsed = time.perf_counter() - started
+
+        if samples:
+            rss = [value for _, value in samples]
+            self.stdout.write(
+                f"{options['contacts']:,} contacts in {elapsed:.1f}s; RSS min {min(rss):.1f} MB, "
+                f"max {max(rss):.1f} MB, growth after first sample {rss[-1] - rss[0]:+.1f} MB"
+            )
@@ -0,0 +1,109 @@
+import logging
+import time
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+from django.utils.timezone import now
+
+from ghl_auth.custom_fields import get_field_cache
+from ghl_auth.fake_api import FakeGHLServer
+from ghl_auth.ghl_client import get_client, reset_client
+from ghl_auth.leases import lease_key
+from ghl_auth.models import Contact, GHLOAuth, Opportunity, OpportunityRollup, SyncRun, SyncState, WebhookEvent
+from ghl_auth.tasks import sync_location, sync_locations_async
+from ghl_auth.tokens import get_token_manager
+
+
+MODES = ("sequential", "pipelined", "async")
+
+# Every table holding per-location sync data; each run starts from none of it.
+LOCATION_MODELS = (Contact, Opportunity, OpportunityRollup, SyncState, SyncRun, WebhookEvent)
+
+
+class Command(BaseCommand):
+    help = "Benchmark full syncs of every mode against the local fake GHL API"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--locations", type=int, default=4)
+        parser.add_argument("--contacts", type=int, default=5000, help="Contacts per location")
+        parser.add_argument("--opportunities-per-contact", type=int, default=1)
+        parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every search page")
+        parser.add_argument("--error-every", type=int, default=0, help="Inject a 429/520 every N API calls")
+        parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+
+    def handle(self, *args, **options):
+        logging.getLogger("ghl_auth").setLevel(logging.ERROR)
+        location_ids = [f"bench-loc-{i}" for i in range(options["locations"])]
+        server = FakeGHLServer(
+            contacts=options["contacts"],
+            opportunities_per_contact=options["opportunities_per_contact"],
+            page_latency=options["latency"],
+            error_every=options["error_every"],
+        )
+        self.stdout.write(
+            f"{len(location_ids)} locations x {options['contacts']:,} contacts, "
+            f"{options['latency'] * 1000:.0f} ms/page, error every {options['error_every'] or '-'} calls"
+        )
+        # Rate limits off: the fake API never throttles unless asked to.
+        with server, override_settings(
+            GHL_API_BASE_URL=server.url, GHL_HTTP_BACKOFF=0.05,
+            GHL_RATE_LIMIT_LOCATION_REQUESTS=0, GHL_RATE_LIMIT_APP_REQUESTS=0,
+        ):
+            reset_client()
+            try:
+                for mode in options["modes"]:
+                    for entity in (SyncState.CONTACTS, SyncState.OPPORTUNITIES):
+                        self.reset(location_ids)
+                        self.report(mode, entity, *self.run(server, mode, entity, location_ids))
+            finally:
+                self.reset(location_ids, tokens=True)
+                reset_client()
+
+    def reset(self, location_ids, tokens=False):
+        for model in LOCATION_MODELS:
+            model.objects.filter(location_id__in=location_ids).delete()
+        # Leases outlive an interrupted run in the shared cache and would skip its locations.
+        cache.delete_many([
+            lease_key(loc_id, entity) for loc_id in location_ids for entity in (SyncState.CONTACTS, SyncState.OPPORTUNITIES)
+        ])
+        token_manager = get_token_manager()
+        for loc_id in location_ids:
+            get_field_cache().invalidate(loc_id)
+            token_manager.invalidate(loc_id)
+            if tokens:
+                GHLOAuth.objects.filter(location_id=loc_id).delete()
+            else:
+                # Expired on purpose so every run includes a token refresh.
+                GHLOAuth.objects.update_or_create(location_id=loc_id, defaults={
+                    "access_token": "expired", "refresh_token": f"bench-{time.monotonic_ns()}",
+                    "expires_at": now() - timedelta(minutes=1),
+                })
+
+    def run(self, server, mode, entity, location_ids):
+        api_before = server.stats()
+        client_before = get_client().stats()
+        started = time.perf_counter()
+        if mode == "async":
+            results = sync_locations_async(location_ids, entity, full_sync=True)
+        else:
+            results = {
+                loc_id: sync_location(loc_id, entity, full_sync=True, pipelined=mode == "pipelined")
+                for loc_id in location_ids
+            }
+        elapsed = time.perf_counter() - started
+
+        api_after = server.stats()
+        calls = {key: api_after.get(key, 0) - api_before.get(key, 0) for key in api_after}
+        retries = get_client().stats()["retries"] - client_before["retries"]
+        rows = sum(result["write"]["rows"] for result in results.values() if result)
+        db_time = sum(result["write"]["busy_seconds"] for result in results.values() if result)
+        return elapsed, rows, calls, retries, db_time
+
+    def report(self, mode, entity, elapsed, rows, calls, retries, db_time):
+        self.stdout.write(
+            f"{mode:<10} {entity:<13} {rows:>9,} rows {elapsed:7.2f}s {rows / elapsed:>9,.0f} rec/s  "
+            f"api {calls.get('api_calls', 0):>5} (+{calls.get('oauth', 0)} oauth, {calls.get('injected', 0)} injected, "
+            f"{retries} retries)  db {db_time:6.2f}s"
+        )
@@ -0,0 +1,60 @@
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytz
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from ghl_auth.utils import convert_timestamps, convert_to_timezone
+
+
+def legacy_convert_to_timezone(utc_time_str, timezone_str):
+    """convert_to_timezone as it was before batch conversion, for comparison."""
+    utc_time = datetime.strptime(utc_time_str, "%Y-%m-%dT%H:%M:%S.%fZ")
+    utc_time = utc_time.replace(tzinfo=pytz.utc)
+    return utc_time.astimezone(pytz.timezone(timezone_str))
+
+
+def make_timestamps(count):
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    return [
+        (start + timedelta(seconds=random.randint(0, 30_000_000), milliseconds=random.randint(0, 999)))
+        .strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+        for _ in range(count)
+    ]
+
+
+class Command(BaseCommand):
+    help = "Microbenchmark timestamp conversion: legacy per-row vs batch API"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=100_000)
+        parser.add_argument("--page-size", type=int, default=100)
+
+    def handle(self, *args, **options):
+        values = make_timestamps(options["count"])
+        page_size = options["page_size"]
+        pages = [values[i:i + page_size] for i in range(0, len(values), page_size)]
+
+        cases = {
+            "legacy strptime + pytz": lambda: [legacy_convert_to_timezone(v, "Asia/Kolkata") for v in values],
+            "convert_to_timezone": lambda: [convert_to_timezone(v, "Asia/Kolkata") for v in values],
+            "convert_timestamps": lambda: [convert_timestamps(page, "Asia/Kolkata") for page in pages],
+        }
+
+        def store_utc():
+            with override_settings(GHL_STORE_UTC=True):
+                return [convert_timestamps(page) for page in pages]
+
+        cases["convert_timestamps (UTC)"] = store_utc
+
+        baseline = None
+        for name, case in cases.items():
+            started = time.perf_counter()
+            case()
+            elapsed = time.perf_counter() - started
+            baseline = baseline or elapsed
+            self.stdout.write(
+                f"{name:<26} {elapsed:7.3f}s  {len(values) / elapsed:>12,.0f}/s  x{baseline / elapsed:.1f}"
+            )
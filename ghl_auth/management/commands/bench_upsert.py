@@ -0,0 +1,74 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils.timezone import now
+
+from ghl_auth import bulk
+
+
+class Rollback(Exception):
+    pass
+
+
+def upsert_executemany(spec, rows, connection):
+    """The row-by-row executemany path the sync tasks used before ghl_auth.bulk."""
+    qn = connection.ops.quote_name
+    columns = ", ".join(qn(column) for column in spec.columns)
+    placeholders = ", ".join(["%s"] * len(spec.columns))
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {qn(spec.table)} ({columns}) VALUES ({placeholders}) {bulk._conflict_clause(spec, qn)}",
+            spec.prepare(spec.with_hashes(rows), connection),
+        )
+
+
+def make_contact_rows(count, location_id="bench-location", first_name="First"):
+    created = now() - timedelta(days=30)
+    return [
+        (f"bench-{i}", first_name, "Last", f"bench-{i}@example.com", "+10000000000", location_id, created, created,
+         {"Twitter": f"@bench{i}"})
+        for i in range(count)
+    ]
+
+
+class Command(BaseCommand):
+    help = "Benchmark the bulk upsert strategies for Contact rows (every run is rolled back)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+        parser.add_argument("--batch-size", type=int, default=3000, help="Rows handed to one upsert call")
+
+    def handle(self, *args, **options):
+        strategies = {"executemany": upsert_executemany, "generic": bulk.upsert_generic}
+        native = bulk.STRATEGIES.get(connection.vendor)
+        if native:
+            strategies[connection.vendor] = native
+
+        spec = bulk.contact_spec()
+        self.stdout.write(f"Backend: {connection.vendor}, batch size {options['batch_size']}")
+        for count in options["rows"]:
+            # The update pass changes every row; unchanged rows are skipped by the hash guard.
+            passes = (make_contact_rows(count), make_contact_rows(count, first_name="Changed"))
+            for name, strategy in strategies.items():
+                insert_time, update_time = self.run(spec, strategy, passes, options["batch_size"])
+                self.stdout.write(
+                    f"{count:>9} rows  {name:<12} insert {insert_time:7.2f}s ({count / insert_time:>9,.0f} rows/s)"
+                    f"  update {update_time:7.2f}s ({count / update_time:>9,.0f} rows/s)"
+                )
+
+    def run(self, spec, strategy, passes, batch_size):
+        """Time an insert pass, then an update pass over the same keys."""
+        elapsed = []
+        try:
+            with transaction.atomic():
+                for rows in passes:
+                    started = time.perf_counter()
+                    for start in range(0, len(rows), batch_size):
+                        bulk.bulk_upsert(spec, rows[start:start + batch_size], strategy=strategy)
+                    elapsed.append(time.perf_counter() - started)
+                raise Rollback()
+        except Rollback:
+            pass
+        return elapsed
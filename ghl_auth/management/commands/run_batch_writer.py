@@ -0,0 +1,99 @@
+import logging
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.db.backends.signals import connection_created
+
+from ghl_auth.funnel import BatchQueue
+from ghl_auth.tasks import apply_write_messages
+
+
+logger = logging.getLogger(__name__)
+
+# On top of the per-connection pragmas in DATABASES: the writer is the only
+# process writing synced rows, so it gets a large page cache and memory-mapped reads.
+WRITER_PRAGMAS = (
+    "PRAGMA cache_size = -262144",  # 256 MB
+    "PRAGMA mmap_size = 1073741824",
+    "PRAGMA wal_autocheckpoint = 10000",
+)
+
+
+def tune_writer_connection(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for pragma in WRITER_PRAGMAS:
+            cursor.execute(pragma)
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply batches queued by fetch workers in funnel write mode "
+        "(GHL_SYNC_WRITE_MODE=funnel), merging them into large transactions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--max-rows", type=int, default=settings.GHL_WRITER_MAX_ROWS,
+                            help="Commit once this many rows are collected")
+        parser.add_argument("--max-wait", type=float, default=settings.GHL_WRITER_MAX_WAIT_SECONDS,
+                            help="Commit at most this long after the first message of a transaction")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty")
+
+    def handle(self, *args, **options):
+        connection_created.connect(tune_writer_connection)
+        queue = BatchQueue()
+        logger.info(f"Batch writer consuming {queue.name}")
+        try:
+            while True:
+                messages = self.collect(queue, options["max_rows"], options["max_wait"], options["once"])
+                if messages:
+                    self.apply(messages)
+                elif options["once"]:
+                    break
+        except KeyboardInterrupt:
+            pass
+        finally:
+            queue.close()
+
+    def collect(self, queue, max_rows, max_wait, once):
+        """Messages for one transaction: whatever arrives within ``max_wait`` of the first, up to ``max_rows``."""
+        try:
+            messages = [queue.get(timeout=0.1 if once else 1)]
+        except BatchQueue.Empty:
+            return []
+        rows = len(messages[0].payload.get("rows") or ())
+        deadline = time.monotonic() + max_wait
+        while rows < max_rows:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                message = queue.get(timeout=remaining)
+            except BatchQueue.Empty:
+                break
+            messages.append(message)
+            rows += len(message.payload.get("rows") or ())
+        return messages
+
+    def apply(self, messages):
+        started = time.monotonic()
+        payloads = [message.payload for message in messages]
+        while True:
+            close_old_connections()
+            try:
+                rows, failed = apply_write_messages(payloads)
+                break
+            except Exception as e:
+                # The transaction itself failed (e.g. disk full). Retry the same
+                # messages, unacknowledged, so their order is preserved.
+                logger.exception(f"Writer transaction of {len(messages)} messages failed, retrying: {str(e)}")
+                time.sleep(1)
+        for message in messages:
+            message.ack()
+        logger.info(
+            f"Wrote {rows} rows from {len(messages)} messages in {time.monotonic() - started:.2f}s"
+            + (f" ({failed} dropped)" if failed else "")
+        )
@@ -1,24 +1,13 @@
 from django.core.management.base import BaseCommand
-from django_celery_beat.models import PeriodicTask, IntervalSchedule
-import json
+from ghl_auth.scheduling import plan_schedules
+from ghl_auth.tasks import get_location_ids
 
 class Command(BaseCommand):
-    help = "Setup periodic Celery tasks"
+    help = "Create or update the per-location periodic sync tasks"
 
     def handle(self, *args, **kwargs):
-        schedule, created = IntervalSchedule.objects.get_or_create(
-            every=30,  
-            period=IntervalSchedule.SECONDS
-        )
-
-        task_name = "print_hello_task"
-        if not PeriodicTask.objects.filter(name=task_name).exists():
-            PeriodicTask.objects.create(
-                interval=schedule,
-                name=task_name,
-                task="ghl_auth.tasks.print_hello",
-                args=json.dumps([]),
-            )
-            self.stdout.write(self.style.SUCCESS(f"Task '{task_name}' created successfully!"))
-        else:
-            self.stdout.write(self.style.SUCCESS(f"Task '{task_name}' already exists."))
+        plans = plan_schedules(get_location_ids())
+        for location_id, intervals in plans.items():
+            summary = ", ".join(f"{entity} every {minutes} min" for entity, minutes in intervals.items())
+            self.stdout.write(f"{location_id}: {summary}")
+        self.stdout.write(self.style.SUCCESS(f"Planned sync schedules for {len(plans)} locations."))
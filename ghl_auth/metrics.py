@@ -0,0 +1,363 @@
+"""
+Prometheus-style metrics for the sync hot paths, without extra dependencies.
+
+Every process keeps its own registry. With ``GHL_METRICS_DIR`` set (by
+default a per-host directory under the system temp dir), each process also
+writes a snapshot file there (after every Celery task and every
+``GHL_METRICS_SNAPSHOT_SECONDS``), and ``collect()`` merges all of them,
+so one ``/metrics`` endpoint covers the web app and every prefork worker
+child. Workers serve the same text on ``GHL_METRICS_PORT``.
+Snapshots of processes that have exited are dropped.
+
+Both endpoints answer requests bearing ``GHL_METRICS_TOKEN``, or, with no
+token configured, only requests from loopback and private addresses: the
+labels include location IDs.
+"""
+import bisect
+import glob
+import hmac
+import ipaddress
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from celery.signals import (
+    before_task_publish, task_postrun, task_prerun, worker_process_init, worker_process_shutdown, worker_ready,
+)
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+WAIT_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 300, 900, 3600)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            values = [[list(key), self._copy(value)] for key, value in self._values.items()]
+        return {"kind": self.kind, "help": self.documentation, "labelnames": list(self.labelnames), "values": values}
+
+    def _copy(self, value):
+        return value
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Per-bucket (not cumulative) counts, then sum and count.
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def snapshot(self):
+        data = super().snapshot()
+        data["buckets"] = list(self.buckets)
+        return data
+
+    def _copy(self, value):
+        return [list(value[0]), value[1], value[2]]
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "ghl_http_request_seconds", "GHL API request latency.", ("method", "endpoint", "status"),
+)
+PAGES_FETCHED = Counter("ghl_sync_pages_total", "Pages fetched from the GHL API.", ("entity", "location_id"))
+ROWS_FETCHED = Counter("ghl_sync_rows_total", "Records fetched from the GHL API.", ("entity", "location_id"))
+ROWS_UNCHANGED = Counter(
+    "ghl_sync_rows_unchanged_total", "Synced rows skipped because their content hash matched.", ("entity",),
+)
+FLUSH_SECONDS = Histogram("ghl_sync_flush_seconds", "Duration of one batch flush transaction.", ("entity",))
+FLUSH_ROWS = Histogram("ghl_sync_flush_rows", "Rows written per batch flush.", ("entity",), buckets=SIZE_BUCKETS)
+TOKEN_REFRESHES = Counter("ghl_token_refreshes_total", "OAuth access token refreshes.", ("result",))
+TOTALS_SECONDS = Histogram(
+    "ghl_contact_totals_seconds", "Duration of update_contact_opportunity_totals.", ("scope",),
+)
+TASK_QUEUE_WAIT_SECONDS = Histogram(
+    "ghl_task_queue_wait_seconds", "Time between a Celery task being published (or due) and starting.",
+    ("task",), buckets=WAIT_BUCKETS,
+)
+
+
+# Snapshots shared between processes
+
+def _snapshot_path(pid=None):
+    return os.path.join(settings.GHL_METRICS_DIR, f"metrics-{pid or os.getpid()}.json")
+
+
+def write_snapshot(registry=REGISTRY):
+    if not settings.GHL_METRICS_DIR:
+        return
+    path = _snapshot_path()
+    tmp_path = f"{path}.tmp"
+    try:
+        os.makedirs(settings.GHL_METRICS_DIR, exist_ok=True)
+        with open(tmp_path, "w") as snapshot_file:
+            json.dump(registry.snapshot(), snapshot_file)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not write metrics snapshot {path}: {str(e)}")
+
+
+def merge(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for name, data in snapshot.items():
+            target = merged.setdefault(name, {**data, "values": {}})
+            for key, value in data["values"]:
+                key = tuple(key)
+                current = target["values"].get(key)
+                if current is None:
+                    target["values"][key] = value
+                elif data["kind"] == "histogram":
+                    target["values"][key] = [
+                        [a + b for a, b in zip(current[0], value[0])], current[1] + value[1], current[2] + value[2],
+                    ]
+                else:
+                    target["values"][key] = current + value
+    for data in merged.values():
+        data["values"] = [[list(key), value] for key, value in data["values"].items()]
+    return merged
+
+
+def remove_snapshot(pid=None):
+    if not settings.GHL_METRICS_DIR:
+        return
+    try:
+        os.remove(_snapshot_path(pid))
+    except OSError:
+        pass
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # someone else's process
+    return True
+
+
+def collect(registry=REGISTRY):
+    """This process's metrics, merged with every live process's snapshot when GHL_METRICS_DIR is set."""
+    if not settings.GHL_METRICS_DIR:
+        return registry.snapshot()
+    write_snapshot(registry)
+    snapshots = []
+    for path in glob.glob(os.path.join(settings.GHL_METRICS_DIR, "metrics-*.json")):
+        pid = os.path.basename(path)[len("metrics-"):-len(".json")]
+        if pid.isdigit() and not _process_alive(int(pid)):
+            # Killed without shutting down (OOM, SIGKILL); its counters stop counting.
+            remove_snapshot(int(pid))
+            continue
+        try:
+            with open(path) as snapshot_file:
+                snapshots.append(json.load(snapshot_file))
+        except (OSError, ValueError):
+            continue  # being replaced right now
+    return merge(snapshots)
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _le(bound):
+    return f'le="{bound}"'
+
+
+def render(snapshot):
+    """Prometheus text exposition format."""
+    lines = []
+    for name, data in sorted(snapshot.items()):
+        lines.append(f"# HELP {name} {data['help']}")
+        lines.append(f"# TYPE {name} {data['kind']}")
+        names = data["labelnames"]
+        for key, value in data["values"]:
+            if data["kind"] != "histogram":
+                lines.append(f"{name}{_labels(names, key)} {value}")
+                continue
+            bucket_counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(data["buckets"], bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(names, key, _le(bound))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(names, key, _le('+Inf'))} {count}")
+            lines.append(f"{name}_sum{_labels(names, key)} {total}")
+            lines.append(f"{name}_count{_labels(names, key)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def authorized(remote_addr, authorization):
+    """Whether a scrape may read the metrics; see the module docstring."""
+    token = settings.GHL_METRICS_TOKEN
+    if token:
+        return hmac.compare_digest((authorization or "").encode(), f"Bearer {token}".encode())
+    try:
+        address = ipaddress.ip_address(remote_addr or "")
+    except ValueError:
+        return False
+    return address.is_loopback or address.is_private
+
+
+# Serving from Celery workers
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        if not authorized(self.client_address[0], self.headers.get("Authorization")):
+            self.send_error(403)
+            return
+        body = render(collect()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port, host="0.0.0.0"):
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="ghl-metrics-http", daemon=True).start()
+    logger.info(f"Serving metrics on :{port}/metrics")
+    return server
+
+
+def start_snapshot_thread(interval=None):
+    interval = interval or settings.GHL_METRICS_SNAPSHOT_SECONDS
+
+    def run():
+        while True:
+            time.sleep(interval)
+            write_snapshot()
+
+    threading.Thread(target=run, name="ghl-metrics-snapshot", daemon=True).start()
+
+
+@worker_process_init.connect
+def _start_child_snapshots(**kwargs):
+    if settings.GHL_METRICS_DIR:
+        start_snapshot_thread()
+
+
+@worker_process_shutdown.connect
+def _remove_child_snapshot(**kwargs):
+    remove_snapshot()
+
+
+@worker_ready.connect
+def _serve_worker_metrics(**kwargs):
+    if settings.GHL_METRICS_PORT:
+        if not settings.GHL_METRICS_DIR:
+            # Prefork children run the tasks; without snapshots only this process's metrics are served.
+            logger.error("GHL_METRICS_DIR is empty: worker /metrics will miss every pool process's metrics.")
+        try:
+            start_http_server(settings.GHL_METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Could not serve metrics on port {settings.GHL_METRICS_PORT}: {str(e)}")
+
+
+@before_task_publish.connect
+def _stamp_published_at(headers=None, **kwargs):
+    if headers is not None:
+        headers["ghl_published_at"] = time.time()
+
+
+@task_prerun.connect
+def _observe_queue_wait(task=None, **kwargs):
+    request = getattr(task, "request", None)
+    published_at = getattr(request, "ghl_published_at", None) or (getattr(request, "headers", None) or {}).get("ghl_published_at")
+    if not published_at:
+        return
+    due_at = published_at
+    eta = getattr(request, "eta", None)
+    if eta:
+        # Countdowns are intentional; only the time past the ETA is queueing.
+        try:
+            due_at = max(published_at, datetime.fromisoformat(eta).timestamp() if isinstance(eta, str) else eta.timestamp())
+        except (TypeError, ValueError):
+            pass
+    TASK_QUEUE_WAIT_SECONDS.observe(max(time.time() - due_at, 0), task=task.name)
+
+
+@task_postrun.connect
+def _snapshot_after_task(**kwargs):
+    write_snapshot()
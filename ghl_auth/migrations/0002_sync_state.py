@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location_id', models.CharField(max_length=255)),
+                ('entity', models.CharField(choices=[('contacts', 'Contacts'), ('opportunities', 'Opportunities')], max_length=20)),
+                ('watermark', models.DateTimeField(blank=True, null=True)),
+                ('last_synced_at', models.DateTimeField(blank=True, null=True)),
+                ('last_full_sync_at', models.DateTimeField(blank=True, null=True)),
+                ('cursor', models.JSONField(blank=True, null=True)),
+                ('rows_flushed', models.IntegerField(default=0)),
+                ('cursor_full_sync', models.BooleanField(default=False)),
+                ('cursor_watermark', models.DateTimeField(blank=True, null=True)),
+                ('checkpoint_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'SyncState',
+                'unique_together': {('location_id', 'entity')},
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0004_contact_custom_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location_id', models.CharField(max_length=255)),
+                ('event_type', models.CharField(max_length=64)),
+                ('entity', models.CharField(choices=[('contacts', 'Contacts'), ('opportunities', 'Opportunities')], max_length=20)),
+                ('object_id', models.CharField(max_length=255)),
+                ('payload', models.JSONField()),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'WebhookEvent',
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:35
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0005_webhook_event'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location_id', models.CharField(max_length=255)),
+                ('entity', models.CharField(choices=[('contacts', 'Contacts'), ('opportunities', 'Opportunities')], max_length=20)),
+                ('status', models.CharField(choices=[('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='running', max_length=20)),
+                ('full_sync', models.BooleanField(default=False)),
+                ('started_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('pages', models.IntegerField(default=0)),
+                ('rows', models.IntegerField(default=0)),
+                ('errors', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('last_cursor', models.JSONField(blank=True, null=True)),
+            ],
+            options={
+                'db_table': 'SyncRun',
+                'indexes': [models.Index(fields=['location_id', 'entity', '-started_at'], name='syncrun_loc_started_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0006_sync_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contact',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='opportunity',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=16),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0007_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contact',
+            index=models.Index(fields=['location_id', 'updated_at', 'id'], name='contact_loc_upd_id_idx'),
+        ),
+        migrations.RemoveIndex(
+            model_name='contact',
+            name='contact_loc_updated_idx',
+        ),
+    ]
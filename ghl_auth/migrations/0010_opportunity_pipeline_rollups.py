@@ -0,0 +1,62 @@
+# Generated by Django 5.2.18 on 2026-10-18 08:45
+
+from django.db import migrations, models
+
+
+def build_rollups(apps, schema_editor):
+    """Seed the rollups from existing opportunities; later batches apply deltas."""
+    qn = schema_editor.connection.ops.quote_name
+    key = ", ".join(qn(column) for column in ("location_id", "pipeline_id", "pipeline_stage_id", "status"))
+    schema_editor.execute(
+        f"INSERT INTO {qn('OpportunityRollup')} ({key}, {qn('opportunities')}, {qn('monetary_value')}) "
+        f"SELECT {key}, COUNT(*), COALESCE(SUM({qn('monetaryValue')}), 0) FROM {qn('Opportunity')} GROUP BY {key}"
+    )
+
+
+def resync_opportunities(apps, schema_editor):
+    """Existing opportunities lack pipeline fields and delta runs won't revisit them; force a full sync."""
+    SyncState = apps.get_model("ghl_auth", "SyncState")
+    SyncState.objects.filter(entity="opportunities").update(last_full_sync_at=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0009_contact_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='opportunity',
+            name='pipeline_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='opportunity',
+            name='pipeline_stage_id',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='opportunity',
+            name='status',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.CreateModel(
+            name='OpportunityRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location_id', models.CharField(max_length=255)),
+                ('pipeline_id', models.CharField(blank=True, default='', max_length=255)),
+                ('pipeline_stage_id', models.CharField(blank=True, default='', max_length=255)),
+                ('status', models.CharField(blank=True, default='', max_length=32)),
+                ('opportunities', models.IntegerField(default=0)),
+                ('monetary_value', models.FloatField(default=0)),
+            ],
+            options={
+                'db_table': 'OpportunityRollup',
+                'constraints': [models.UniqueConstraint(fields=('location_id', 'pipeline_id', 'pipeline_stage_id', 'status'), name='opp_rollup_key')],
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+        migrations.RunPython(resync_opportunities, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+from datetime import datetime, timezone
+
+from django.db import migrations
+
+
+CHUNK_SIZE = 2000
+
+
+def utc_text(value):
+    # The driver may already have parsed the column into an aware datetime.
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(value)
+    return str(value.astimezone(timezone.utc).replace(tzinfo=None))
+
+
+def normalize_timestamps(apps, schema_editor):
+    """
+    The SQLite bulk upsert used to store synced timestamps as offset-qualified
+    text (``... +05:30``, or ``+00:00`` with GHL_STORE_UTC), which doesn't sort
+    or compare against the ORM's naive UTC text. Rewrite those values in UTC.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite":
+        return  # real timestamp columns elsewhere
+    qn = connection.ops.quote_name
+    for table in ("Contact", "Opportunity"):
+        for column in ("created_at", "updated_at"):
+            offset_qualified = f"{qn(column)} GLOB '*[+-][0-9][0-9]:[0-9][0-9]'"
+            with connection.cursor() as cursor:
+                while True:
+                    cursor.execute(
+                        f"SELECT id, {qn(column)} FROM {qn(table)} WHERE {offset_qualified} LIMIT {CHUNK_SIZE}"
+                    )
+                    rows = cursor.fetchall()
+                    if not rows:
+                        break
+                    cursor.executemany(
+                        f"UPDATE {qn(table)} SET {qn(column)} = %s WHERE id = %s",
+                        [(utc_text(value), pk) for pk, value in rows],
+                    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0010_opportunity_pipeline_rollups'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_timestamps, migrations.RunPython.noop),
+    ]
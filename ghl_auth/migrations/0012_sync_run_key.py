@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 09:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ghl_auth', '0011_utc_timestamps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncrun',
+            name='key',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddIndex(
+            model_name='syncrun',
+            index=models.Index(fields=['key'], name='syncrun_key_idx'),
+        ),
+    ]
@@ -1,8 +1,11 @@
+import uuid
+
 from django.db import models
 from django.utils.timezone import now
 from datetime import timedelta
-import requests
 from django.conf import settings
+from django.core.cache import cache
+from .ghl_client import get_client
 
 class GHLOAuth(models.Model):
     location_id = models.CharField(max_length=255, unique=True)
@@ -21,7 +24,6 @@ class GHLOAuth(models.Model):
         if not self.refresh_token:
             return None  
         
-        url = "https://services.leadconnectorhq.com/oauth/token"
         data = {
             "grant_type": "refresh_token",
             "refresh_token": self.refresh_token,
@@ -29,14 +31,14 @@ class GHLOAuth(models.Model):
             "client_secret": settings.GHL_CLIENT_SECRET
         }
 
-        response = requests.post(url, data=data)
+        response = get_client().post("/oauth/token", data=data, retry=False)
 
         if response.status_code == 200:
             token_data = response.json()
             self.access_token = token_data["access_token"]
             self.refresh_token = token_data.get("refresh_token", self.refresh_token)  # Keep old if not provided
             self.expires_at = now() + timedelta(seconds=token_data["expires_in"])
-            self.save()
+            self.save(update_fields=["access_token", "refresh_token", "expires_at"])
             return self.access_token
         else:
             print("Failed to refresh token:", response.json())
@@ -44,9 +46,9 @@ class GHLOAuth(models.Model):
 
     def get_valid_access_token(self):
         """Get a valid access token, refreshing if expired."""
-        if self.is_expired():
-            return self.refresh_access_token()
-        return self.access_token
+        from .tokens import get_access_token  # tokens imports this module
+
+        return get_access_token(self.location_id)
 
 
 
@@ -81,11 +83,21 @@ class Contact(models.Model):
     phone = models.CharField(max_length=20, blank=True, null=True)
     location_id = models.CharField(max_length=255)
     opportunity = models.FloatField(blank=True, null=True)
+    custom_fields = models.JSONField(default=dict, blank=True)  # {field name: value}
+    content_hash = models.CharField(max_length=16, blank=True, default="")  # see bulk.content_hash
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True) 
 
     class Meta:
         db_table = "Contact"  
+        indexes = [
+            # Per-location listings and delta reads ordered by last update; id
+            # completes the read API's (updated_at, id) keyset.
+            models.Index(fields=["location_id", "updated_at", "id"], name="contact_loc_upd_id_idx"),
+            # Prefix search in the admin.
+            models.Index(fields=["email"], name="contact_email_idx"),
+            models.Index(fields=["phone"], name="contact_phone_idx"),
+        ]
 
 
 class Opportunity(models.Model):
@@ -95,10 +107,269 @@ class Opportunity(models.Model):
     phone = models.CharField(max_length=20, blank=True, null=True)
     location_id = models.CharField(max_length=255)  
     monetaryValue = models.FloatField(blank=True, null=True,default=0)
+    pipeline_id = models.CharField(max_length=255, blank=True, default="")
+    pipeline_stage_id = models.CharField(max_length=255, blank=True, default="")
+    status = models.CharField(max_length=32, blank=True, default="")  # open, won, lost, abandoned
+    content_hash = models.CharField(max_length=16, blank=True, default="")  # see bulk.content_hash
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)  
 
     class Meta:
         db_table = "Opportunity" 
+        indexes = [
+            # Drives the correlated SUM in the contact totals update.
+            models.Index(fields=["contact_id"], name="opp_contact_idx"),
+            models.Index(fields=["location_id", "contact_id"], name="opp_loc_contact_idx"),
+            models.Index(fields=["location_id", "updated_at"], name="opp_loc_updated_idx"),
+        ]
 
     
+
+
+class OpportunityRollup(models.Model):
+    """
+    Count and value of a location's opportunities per pipeline stage and
+    status. Kept current by ``rollups.apply_rollup_deltas`` in every
+    opportunity batch; rows that drop to zero are kept for reuse.
+    """
+
+    location_id = models.CharField(max_length=255)
+    pipeline_id = models.CharField(max_length=255, blank=True, default="")
+    pipeline_stage_id = models.CharField(max_length=255, blank=True, default="")
+    status = models.CharField(max_length=32, blank=True, default="")
+    opportunities = models.IntegerField(default=0)
+    monetary_value = models.FloatField(default=0)
+
+    class Meta:
+        db_table = "OpportunityRollup"
+        constraints = [
+            models.UniqueConstraint(
+                fields=["location_id", "pipeline_id", "pipeline_stage_id", "status"], name="opp_rollup_key",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.location_id} {self.pipeline_id}/{self.pipeline_stage_id} {self.status}"
+
+
+class SyncState(models.Model):
+    """Per-location, per-entity high-water mark used for incremental syncs."""
+
+    CONTACTS = "contacts"
+    OPPORTUNITIES = "opportunities"
+    ENTITY_CHOICES = [(CONTACTS, "Contacts"), (OPPORTUNITIES, "Opportunities")]
+
+    location_id = models.CharField(max_length=255)
+    entity = models.CharField(max_length=20, choices=ENTITY_CHOICES)
+    watermark = models.DateTimeField(blank=True, null=True)  # max dateUpdated/updatedAt seen (UTC)
+    last_synced_at = models.DateTimeField(blank=True, null=True)
+    last_full_sync_at = models.DateTimeField(blank=True, null=True)
+
+    # Pagination checkpoint of the run in progress, written after each batch
+    # flush so a retried or crashed task resumes from the last committed page.
+    cursor = models.JSONField(blank=True, null=True)
+    rows_flushed = models.IntegerField(default=0)
+    cursor_full_sync = models.BooleanField(default=False)
+    cursor_watermark = models.DateTimeField(blank=True, null=True)
+    checkpoint_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        db_table = "SyncState"
+        unique_together = ("location_id", "entity")
+
+    def __str__(self):
+        return f"{self.location_id} {self.entity}"
+
+    @classmethod
+    def for_location(cls, location_id, entity):
+        state, _ = cls.objects.get_or_create(location_id=location_id, entity=entity)
+        return state
+
+    def needs_full_sync(self):
+        if self.watermark is None or self.last_full_sync_at is None:
+            return True
+        return now() - self.last_full_sync_at >= timedelta(hours=settings.GHL_FULL_RESYNC_HOURS)
+
+    def delta_since(self):
+        """Lower bound for a delta fetch, widened a little to absorb clock skew."""
+        return self.watermark - timedelta(seconds=settings.GHL_DELTA_OVERLAP_SECONDS)
+
+    def has_checkpoint(self):
+        if self.cursor is None or self.checkpoint_at is None:
+            return False
+        # Stale cursors may no longer be accepted by the API, start over instead.
+        return now() - self.checkpoint_at < timedelta(hours=settings.GHL_CHECKPOINT_MAX_AGE_HOURS)
+
+    def save_checkpoint(self, cursor, rows_flushed, full_sync, watermark):
+        self.cursor = cursor
+        self.rows_flushed = rows_flushed
+        self.cursor_full_sync = full_sync
+        self.cursor_watermark = watermark
+        self.checkpoint_at = now()
+        self.save(update_fields=["cursor", "rows_flushed", "cursor_full_sync", "cursor_watermark", "checkpoint_at"])
+
+    def clear_checkpoint(self):
+        self.cursor = None
+        self.rows_flushed = 0
+        self.cursor_full_sync = False
+        self.cursor_watermark = None
+        self.checkpoint_at = None
+
+    def mark_synced(self, watermark, full_sync):
+        synced_at = now()
+        if watermark and (self.watermark is None or watermark > self.watermark):
+            self.watermark = watermark
+        self.last_synced_at = synced_at
+        if full_sync:
+            self.last_full_sync_at = synced_at
+        self.clear_checkpoint()
+        self.save()
+
+
+class SyncRun(models.Model):
+    """
+    One location/entity sync run, updated at every batch flush. A task
+    retry that resumes from the checkpoint continues the same run.
+    """
+
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUS_CHOICES = [(RUNNING, "Running"), (SUCCEEDED, "Succeeded"), (FAILED, "Failed")]
+
+    location_id = models.CharField(max_length=255)
+    entity = models.CharField(max_length=20, choices=SyncState.ENTITY_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=RUNNING)
+    full_sync = models.BooleanField(default=False)
+    started_at = models.DateTimeField(default=now)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    updated_at = models.DateTimeField(default=now)
+    pages = models.IntegerField(default=0)
+    rows = models.IntegerField(default=0)
+    errors = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True, default="")
+    last_cursor = models.JSONField(blank=True, null=True)
+    # Chosen by the fetch worker, so funnel messages can name a run the writer hasn't created yet.
+    key = models.CharField(max_length=32, blank=True, default="")
+
+    class Meta:
+        db_table = "SyncRun"
+        indexes = [
+            models.Index(fields=["location_id", "entity", "-started_at"], name="syncrun_loc_started_idx"),
+            models.Index(fields=["key"], name="syncrun_key_idx"),
+        ]
+
+    def __str__(self):
+        return f"{self.location_id} {self.entity} {self.status}"
+
+    @classmethod
+    def resumable(cls, location_id, entity):
+        return (
+            cls.objects.filter(location_id=location_id, entity=entity)
+            .exclude(status=cls.SUCCEEDED).order_by("-started_at").first()
+        )
+
+    @classmethod
+    def begin(cls, location_id, entity, full_sync, resume=False, key=None):
+        """
+        Start a run, or reopen the unfinished one a resumed sync belongs to.
+        A run that already has ``key`` is reopened instead, so beginning
+        again with the same key is harmless.
+        """
+        run = cls.objects.filter(key=key).first() if key else None
+        if run is None and resume:
+            run = cls.resumable(location_id, entity)
+        if run:
+            run.status = cls.RUNNING
+            run.finished_at = None
+            run.updated_at = now()
+            run.key = key or run.key
+            run.save(update_fields=["status", "finished_at", "updated_at", "key"])
+            return run
+        return cls.objects.create(location_id=location_id, entity=entity, full_sync=full_sync, key=key or uuid.uuid4().hex)
+
+    @staticmethod
+    def status_cache_key(location_id):
+        return f"ghl:sync_status:{location_id}"
+
+    @classmethod
+    def status_for(cls, location_id):
+        """Latest run per entity, cached until a run of the location changes."""
+        key = cls.status_cache_key(location_id)
+        runs = cache.get(key)
+        if runs is None:
+            runs = {}
+            for entity, _ in SyncState.ENTITY_CHOICES:
+                run = cls.objects.filter(location_id=location_id, entity=entity).order_by("-started_at").first()
+                runs[entity] = run.as_dict() if run else None
+            cache.set(key, runs, timeout=settings.GHL_SYNC_STATUS_CACHE_SECONDS)
+        return runs
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        cache.delete(self.status_cache_key(self.location_id))
+
+    def record_flush(self, rows, pages, cursor):
+        self.rows += rows
+        self.pages += pages
+        if cursor:
+            self.last_cursor = cursor
+        self.updated_at = now()
+        self.save(update_fields=["rows", "pages", "last_cursor", "updated_at"])
+
+    def record_progress(self, rows, pages, cursor):
+        """Like ``record_flush``, from running totals; applying the same totals twice changes nothing."""
+        self.rows = max(self.rows, rows)
+        self.pages = max(self.pages, pages)
+        if cursor:
+            self.last_cursor = cursor
+        self.updated_at = now()
+        self.save(update_fields=["rows", "pages", "last_cursor", "updated_at"])
+
+    def record_error(self, error):
+        self.status = self.FAILED
+        self.errors += 1
+        self.last_error = str(error)[:2000]
+        self.updated_at = self.finished_at = now()
+        self.save(update_fields=["status", "errors", "last_error", "updated_at", "finished_at"])
+
+    def finish(self):
+        self.status = self.SUCCEEDED
+        self.updated_at = self.finished_at = now()
+        self.save(update_fields=["status", "updated_at", "finished_at"])
+
+    def as_dict(self):
+        return {
+            "id": self.pk,
+            "entity": self.entity,
+            "status": self.status,
+            "full_sync": self.full_sync,
+            "started_at": self.started_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "updated_at": self.updated_at.isoformat(),
+            "pages": self.pages,
+            "rows": self.rows,
+            "errors": self.errors,
+            "last_error": self.last_error,
+            "last_cursor": self.last_cursor,
+        }
+
+
+class WebhookEvent(models.Model):
+    """
+    Durable buffer between the webhook endpoint and the batch writer: the
+    view only inserts a row, ``flush_webhook_events`` applies and deletes them.
+    """
+
+    location_id = models.CharField(max_length=255)
+    event_type = models.CharField(max_length=64)
+    entity = models.CharField(max_length=20, choices=SyncState.ENTITY_CHOICES)
+    object_id = models.CharField(max_length=255)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = "WebhookEvent"
+
+    def __str__(self):
+        return f"{self.event_type} {self.object_id}"
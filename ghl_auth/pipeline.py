@@ -0,0 +1,173 @@
+import logging
+import queue
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class StageStats:
+    """Rows handled and time spent busy in one pipeline stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.rows = 0
+        self.busy = 0.0
+
+    def add(self, rows, elapsed):
+        self.items += 1
+        self.rows += rows
+        self.busy += elapsed
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.busy if self.busy else 0.0
+
+    def as_dict(self):
+        return {
+            "items": self.items,
+            "rows": self.rows,
+            "busy_seconds": round(self.busy, 3),
+            "rows_per_sec": round(self.rows_per_sec, 1),
+        }
+
+
+class _Stopped(Exception):
+    pass
+
+
+def _put(q, item, stop):
+    # Bounded queues give backpressure; poll so a failed consumer can stop us.
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _get(q, stop):
+    while True:
+        if stop.is_set():
+            raise _Stopped()
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+
+def _timed_iter(iterable, stats):
+    iterator = iter(iterable)
+    while True:
+        started = time.monotonic()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        stats.add(len(item[0]), time.monotonic() - started)
+        yield item
+
+
+def run_sequential(pages, transform, write):
+    """
+    Run fetch → transform → write one page at a time in the calling thread.
+
+    ``pages`` yields ``(records, next_cursor)``, ``transform(records)`` returns
+    ``(rows, watermark)`` and ``write(rows, watermark, next_cursor)`` stores
+    them. Returns per-stage stats.
+
+    Every stage is a generator step, so at most one page of records and the
+    writer's pending batch are alive at once, however large the location.
+    """
+    stats = {name: StageStats(name) for name in ("fetch", "transform", "write")}
+    for records, next_cursor in _timed_iter(pages, stats["fetch"]):
+        started = time.monotonic()
+        rows, watermark = transform(records)
+        stats["transform"].add(len(rows), time.monotonic() - started)
+
+        started = time.monotonic()
+        write(rows, watermark, next_cursor)
+        stats["write"].add(len(rows), time.monotonic() - started)
+    return {name: stage.as_dict() for name, stage in stats.items()}
+
+
+def run_pipelined(pages, transform, write, queue_size=4):
+    """
+    Same contract as run_sequential(), but the page fetcher and the
+    transformer run in their own threads connected by bounded queues, so
+    network latency overlaps with JSON handling and DB commits. ``write``
+    stays in the calling thread, which owns the DB connection. At most
+    ``queue_size`` pages wait between two stages.
+
+    The first exception raised by any stage stops the others and is
+    re-raised here.
+    """
+    stats = {name: StageStats(name) for name in ("fetch", "transform", "write")}
+    fetched = queue.Queue(maxsize=queue_size)
+    transformed = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def fetcher():
+        try:
+            for item in _timed_iter(pages, stats["fetch"]):
+                _put(fetched, item, stop)
+            _put(fetched, _DONE, stop)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    def transformer():
+        try:
+            while True:
+                item = _get(fetched, stop)
+                if item is _DONE:
+                    _put(transformed, _DONE, stop)
+                    return
+                records, next_cursor = item
+                started = time.monotonic()
+                rows, watermark = transform(records)
+                stats["transform"].add(len(rows), time.monotonic() - started)
+                _put(transformed, (rows, watermark, next_cursor), stop)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [
+        threading.Thread(target=fetcher, name="ghl-sync-fetch", daemon=True),
+        threading.Thread(target=transformer, name="ghl-sync-transform", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            item = _get(transformed, stop)
+            if item is _DONE:
+                break
+            rows, watermark, next_cursor = item
+            started = time.monotonic()
+            write(rows, watermark, next_cursor)
+            stats["write"].add(len(rows), time.monotonic() - started)
+    except _Stopped:
+        pass
+    except BaseException:
+        stop.set()
+        raise
+    finally:
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return {name: stage.as_dict() for name, stage in stats.items()}
@@ -0,0 +1,151 @@
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+APP_SCOPE = "app"
+
+
+def jittered_backoff(attempt, base=None, cap=None):
+    """Exponential backoff with jitter so retrying workers don't move in lockstep."""
+    base = settings.GHL_HTTP_BACKOFF if base is None else base
+    cap = settings.GHL_HTTP_BACKOFF_MAX if cap is None else cap
+    delay = min(cap, base * (2 ** attempt))
+    return random.uniform(delay / 2, delay)
+
+
+def retry_after_seconds(response):
+    """
+    How long GHL asked us to wait, from ``Retry-After`` or, when the interval
+    quota is exhausted, from ``X-RateLimit-Interval-Milliseconds``.
+    """
+    headers = response.headers or {}
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(float(retry_after), 0)
+        except ValueError:
+            pass  # HTTP-date form, fall back to the rate-limit headers
+
+    if headers.get("X-RateLimit-Remaining") == "0":
+        interval_ms = headers.get("X-RateLimit-Interval-Milliseconds")
+        if interval_ms:
+            try:
+                return float(interval_ms) / 1000
+            except ValueError:
+                pass
+    return None
+
+
+class RateLimiter:
+    """
+    Sliding-window request budgets shared by every worker through the Django
+    cache (Redis): one per location and one for the whole app, each allowing
+    ``limit`` requests in any ``GHL_RATE_LIMIT_WINDOW_SECONDS``.
+
+    Each scope counts requests per fixed window with ``cache.incr`` (atomic
+    across processes) and weighs the previous window's count by how much of
+    it still overlaps the sliding window, so a burst at the end of one window
+    can't be followed by a full budget at the start of the next. A 429 puts
+    the scope in a cooldown every worker honours.
+    """
+
+    def __init__(self, cache_backend=None):
+        self.cache = cache_backend or cache
+
+    def limits(self, scope):
+        if scope == APP_SCOPE:
+            return settings.GHL_RATE_LIMIT_APP_REQUESTS
+        return settings.GHL_RATE_LIMIT_LOCATION_REQUESTS
+
+    def _cooldown_key(self, scope):
+        return f"ghl:ratelimit:cooldown:{scope}"
+
+    def _bucket_key(self, scope, window_index):
+        return f"ghl:ratelimit:bucket:{scope}:{window_index}"
+
+    def _take(self, scope):
+        """
+        Count one request, returning ``(0, key)`` when the scope allows it and
+        ``(seconds to wait, None)`` otherwise; ``key`` is what ``_refund`` undoes.
+        """
+        limit = self.limits(scope)
+        if not limit:
+            return 0, None
+        window = settings.GHL_RATE_LIMIT_WINDOW_SECONDS
+        current = time.time()
+        window_index = int(current // window)
+        key = self._bucket_key(scope, window_index)
+        self.cache.add(key, 0, timeout=window * 2)
+        try:
+            taken = self.cache.incr(key)
+        except ValueError:
+            # Evicted between add and incr; treat as a fresh window.
+            self.cache.set(key, 1, timeout=window * 2)
+            taken = 1
+        previous = self.cache.get(self._bucket_key(scope, window_index - 1)) or 0
+        elapsed = (current - window_index * window) / window
+        if previous * (1 - elapsed) + taken <= limit:
+            return 0, key
+
+        self._refund(key)  # a denied request must not use up budget
+        if taken > limit or not previous:
+            return (window_index + 1) * window - current, None
+        # The previous window's weight has to fall until this request fits.
+        allowed_at = 1 - (limit - taken) / previous
+        return max((allowed_at - elapsed) * window, 0.01), None
+
+    def _refund(self, key):
+        try:
+            self.cache.decr(key)
+        except ValueError:
+            pass  # the window expired meanwhile
+
+    def _cooldown(self, scope):
+        until = self.cache.get(self._cooldown_key(scope))
+        return max(until - time.time(), 0) if until else 0
+
+    def acquire(self, location_id=None):
+        """Block until both the app and the location budget grant a request."""
+        scopes = [APP_SCOPE] + ([location_id] if location_id else [])
+        waited = 0
+        while True:
+            wait = max(self._cooldown(scope) for scope in scopes)
+            if not wait:
+                taken = []
+                for scope in scopes:
+                    wait, key = self._take(scope)
+                    if wait:
+                        # Give back what the other scopes granted for this attempt.
+                        for granted in taken:
+                            self._refund(granted)
+                        break
+                    if key:
+                        taken.append(key)
+            if not wait:
+                return waited
+            wait += random.uniform(0, 0.1)
+            waited += wait
+            time.sleep(wait)
+
+    def penalize(self, location_id, seconds):
+        """Pause every worker for ``seconds`` on the location (or app) that was throttled."""
+        scope = location_id or APP_SCOPE
+        until = time.time() + seconds
+        self.cache.set(self._cooldown_key(scope), until, timeout=int(seconds) + 1)
+        logger.warning(f"Rate limited on {scope}, pausing requests for {seconds:.1f}s")
+
+
+_limiter = None
+
+
+def get_rate_limiter():
+    global _limiter
+    if _limiter is None:
+        _limiter = RateLimiter()
+    return _limiter
@@ -0,0 +1,69 @@
+"""
+Versioned response caching for the read API.
+
+Every location has a data version in the shared cache: the time of the
+last committed write to its contacts or opportunities. Responses are
+cached under that version and carry an ETag and Last-Modified derived from
+it, so a repeated poll costs one cache read and, with a conditional
+request, no body at all. Writers call ``bump_data_version`` and every
+cached response of the location becomes unreachable.
+"""
+import hashlib
+import time
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse
+
+
+def version_key(location_id):
+    return f"ghl:read_version:{location_id}"
+
+
+def data_version(location_id):
+    """Last write time of the location; a cold cache starts a new version."""
+    version = cache.get(version_key(location_id))
+    if version is None:
+        cache.add(version_key(location_id), time.time(), timeout=None)
+        version = cache.get(version_key(location_id))
+    return version
+
+
+def bump_data_version(location_ids):
+    """Invalidate the location's cached responses once the current transaction commits."""
+    location_ids = set(location_ids)
+
+    def bump():
+        stamp = time.time()
+        cache.set_many({version_key(location_id): stamp for location_id in location_ids}, timeout=None)
+
+    transaction.on_commit(bump)
+
+
+def _request_version(request, location_id):
+    # The ETag, Last-Modified and body cache of one request must agree on the version.
+    versions = request.__dict__.setdefault("_ghl_data_versions", {})
+    if location_id not in versions:
+        versions[location_id] = data_version(location_id)
+    return versions[location_id]
+
+
+def response_etag(request, location_id, **kwargs):
+    version = _request_version(request, location_id)
+    return hashlib.blake2b(f"{version}:{request.get_full_path()}".encode(), digest_size=12).hexdigest()
+
+
+def response_last_modified(request, location_id, **kwargs):
+    return datetime.fromtimestamp(_request_version(request, location_id), tz=timezone.utc)
+
+
+def cached_json(request, location_id, build):
+    """Serve the JSON body ``build()`` returns, cached for the location's current data version."""
+    key = f"ghl:read:{location_id}:{response_etag(request, location_id)}"
+    body = cache.get(key)
+    if body is None:
+        body = build()
+        cache.set(key, body, timeout=settings.GHL_READ_CACHE_SECONDS)
+    return HttpResponse(body, content_type="application/json")
@@ -0,0 +1,64 @@
+"""
+Opportunity count and value per (location, pipeline, stage, status),
+maintained by deltas in the transaction of every opportunity write, so
+pipeline reports read one row per stage instead of scanning opportunities.
+"""
+from collections import defaultdict
+
+from django.db import connections, transaction
+
+from .models import Opportunity, OpportunityRollup
+
+
+ROLLUP_KEY = ("location_id", "pipeline_id", "pipeline_stage_id", "status")
+
+
+def rollup_deltas(removed, added):
+    """
+    Net change per rollup key from ``(key, value)`` pairs leaving and
+    entering it. Returns ``{key: (count delta, value delta)}`` without
+    keys whose net change is zero, e.g. opportunities that kept their stage.
+    """
+    deltas = defaultdict(lambda: [0, 0.0])
+    for key, value in removed:
+        deltas[key][0] -= 1
+        deltas[key][1] -= value or 0
+    for key, value in added:
+        deltas[key][0] += 1
+        deltas[key][1] += value or 0
+    return {key: (count, value) for key, (count, value) in deltas.items() if count or value}
+
+
+def apply_rollup_deltas(deltas, using="default"):
+    """Add the deltas onto the stored rollups, creating missing rows, in one statement per chunk."""
+    if not deltas:
+        return
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = qn(OpportunityRollup._meta.db_table)
+    key_columns = ", ".join(qn(column) for column in ROLLUP_KEY)
+    count, value = qn("opportunities"), qn("monetary_value")
+    sql = (
+        f"INSERT INTO {table} ({key_columns}, {count}, {value}) VALUES (%s, %s, %s, %s, %s, %s) "
+        f"ON CONFLICT ({key_columns}) DO UPDATE SET "
+        f"{count} = {table}.{count} + EXCLUDED.{count}, {value} = {table}.{value} + EXCLUDED.{value}"
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, [(*key, count_delta, value_delta) for key, (count_delta, value_delta) in deltas.items()])
+
+
+def rebuild_rollups(using="default"):
+    """Recompute every rollup from the opportunities; repairs drift from floating point deltas."""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    key_columns = ", ".join(qn(column) for column in ROLLUP_KEY)
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {qn(OpportunityRollup._meta.db_table)}")
+        cursor.execute(
+            f"""
+            INSERT INTO {qn(OpportunityRollup._meta.db_table)} ({key_columns}, {qn('opportunities')}, {qn('monetary_value')})
+            SELECT {key_columns}, COUNT(*), COALESCE(SUM({qn('monetaryValue')}), 0)
+            FROM {qn(Opportunity._meta.db_table)}
+            GROUP BY {key_columns}
+            """
+        )
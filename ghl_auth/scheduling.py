@@ -0,0 +1,109 @@
+"""
+Per-location polling schedules, stored as django_celery_beat periodic
+tasks so beat (with the DatabaseScheduler) picks up changes at runtime.
+
+Each location/entity gets an interval sized so a delta sync brings in
+about ``GHL_SCHEDULE_TARGET_ROWS`` changes, based on the rows its recent
+delta runs fetched. Start times are offset by a stable per-location jitter
+within the interval, so locations don't all poll at the same moment.
+"""
+import hashlib
+import json
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.timezone import now
+from django_celery_beat.models import IntervalSchedule, PeriodicTask
+
+from .models import SyncRun, SyncState
+
+
+logger = logging.getLogger(__name__)
+
+TASK_NAME_PREFIX = "ghl-sync"
+
+ENTITY_TASKS = {
+    SyncState.CONTACTS: "ghl_auth.tasks.fetch_location_contacts_task",
+    SyncState.OPPORTUNITIES: "ghl_auth.tasks.fetch_location_opportunities_task",
+}
+
+
+def periodic_task_name(location_id, entity):
+    return f"{TASK_NAME_PREFIX}:{location_id}:{entity}"
+
+
+def observed_change_rate(location_id, entity, window_hours=None):
+    """
+    Changed rows per hour over the recent window, or None with fewer than
+    two delta runs. Each delta run fetches what changed since the run
+    before it, so the first run in the window only marks the start.
+    """
+    window_hours = window_hours or settings.GHL_SCHEDULE_WINDOW_HOURS
+    runs = list(
+        SyncRun.objects.filter(
+            location_id=location_id, entity=entity, full_sync=False, status=SyncRun.SUCCEEDED,
+            started_at__gte=now() - timedelta(hours=window_hours),
+        ).order_by("started_at").values_list("started_at", "rows")
+    )
+    if len(runs) < 2:
+        return None
+    hours = (runs[-1][0] - runs[0][0]).total_seconds() / 3600
+    if hours <= 0:
+        return None
+    return sum(rows for _, rows in runs[1:]) / hours
+
+
+def interval_minutes(rate):
+    """Polling interval for a change rate (rows/hour), within the configured bounds."""
+    low, high = settings.GHL_SCHEDULE_MIN_MINUTES, settings.GHL_SCHEDULE_MAX_MINUTES
+    if rate is None:
+        return min(max(settings.GHL_SCHEDULE_DEFAULT_MINUTES, low), high)
+    if rate <= 0:
+        return high
+    return int(min(max(settings.GHL_SCHEDULE_TARGET_ROWS / rate * 60, low), high))
+
+
+def jitter_seconds(location_id, entity, minutes):
+    """Stable offset within the interval, so re-planning doesn't reshuffle start times."""
+    digest = hashlib.blake2b(f"{location_id}:{entity}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % (minutes * 60)
+
+
+def plan_location(location_id):
+    """Create or update the periodic sync tasks of a location. Returns ``{entity: minutes}``."""
+    planned = {}
+    for entity, task in ENTITY_TASKS.items():
+        minutes = interval_minutes(observed_change_rate(location_id, entity))
+        interval, _ = IntervalSchedule.objects.get_or_create(every=minutes, period=IntervalSchedule.MINUTES)
+        name = periodic_task_name(location_id, entity)
+
+        with transaction.atomic():
+            periodic = PeriodicTask.objects.select_for_update().filter(name=name).first()
+            if periodic is None:
+                periodic = PeriodicTask(name=name, task=task, args=json.dumps([location_id]))
+            elif periodic.interval_id == interval.pk:
+                planned[entity] = minutes
+                continue  # unchanged; saving would make beat reload its schedule
+            # First run lands at the jittered offset, then every interval after it.
+            periodic.interval = interval
+            periodic.start_time = now() + timedelta(seconds=jitter_seconds(location_id, entity, minutes))
+            periodic.last_run_at = None
+            periodic.save()
+        logger.info(f"Polling {entity} of {location_id} every {minutes} minutes")
+        planned[entity] = minutes
+    return planned
+
+
+def plan_schedules(location_ids):
+    """Plan every connected location, and drop the schedules of locations that are gone."""
+    plans = {location_id: plan_location(location_id) for location_id in location_ids}
+    keep = {periodic_task_name(location_id, entity) for location_id in location_ids for entity in ENTITY_TASKS}
+    names = PeriodicTask.objects.filter(name__startswith=f"{TASK_NAME_PREFIX}:").values_list("name", flat=True)
+    stale = [name for name in names if name not in keep]
+    for start in range(0, len(stale), 500):  # keeps IN (...) under SQLite's variable limit
+        PeriodicTask.objects.filter(name__in=stale[start:start + 500]).delete()
+    if stale:
+        logger.info(f"Removed {len(stale)} schedules of disconnected locations")
+    return plans
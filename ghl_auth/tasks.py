@@ -1,347 +1,758 @@
 import logging
-import requests
-from celery import shared_task
-from django.db import transaction
-from django.http import JsonResponse
-from .models import GHLOAuth, Contact,Opportunity
-from .utils import convert_to_timezone, get_custom_field_name  # Utility functions
-from datetime import datetime
+import uuid
+from functools import partial
+from celery import group, chain, shared_task
+from django.conf import settings
 from django.db import connection, transaction
-
-import time
+from django.http import JsonResponse
+from .models import GHLOAuth, Contact,Opportunity, SyncRun, SyncState, WebhookEvent
+from .utils import convert_timestamps  # Utility functions
+from .ghl_client import RETRY_STATUSES, GHLAPIError, get_client
+from .pipeline import run_pipelined, run_sequential
+from .async_engine import run_sync_jobs
+from .custom_fields import get_custom_field_definitions, resolve_custom_fields
+from .tokens import get_access_token
+from .leases import SyncLease, current_task_id
+from .scheduling import plan_schedules
+from .read_cache import bump_data_version
+from .funnel import decode_datetime, decode_rows, encode_datetime, encode_rows, get_batch_queue
+from .rollups import ROLLUP_KEY, apply_rollup_deltas, rebuild_rollups, rollup_deltas
+from .webhooks import coalesce_events
+from .metrics import FLUSH_ROWS, FLUSH_SECONDS, PAGES_FETCHED, ROWS_FETCHED, ROWS_UNCHANGED, TOTALS_SECONDS
+from .bulk import HashIndex, changed_rows, contact_spec, opportunity_spec, upsert_contacts, upsert_opportunities
+from django.core.cache import cache
 
 
 contact_logger = logging.getLogger(__name__)
+logger = contact_logger
+
+PAGE_LIMIT = 100  # API limit
+BATCH_SIZE = 3000
+IN_CLAUSE_SIZE = 500  # keeps IN (...) lists under SQLite's variable limit on old builds
+
+
+def get_location_ids(location_id=None):
+    return [location_id] if location_id else list(GHLOAuth.objects.values_list("location_id", flat=True))
+
+
+def split_into_lanes(location_ids, concurrency):
+    """
+    Deal locations round-robin into at most ``concurrency`` lanes. Each lane
+    runs its locations one after another, so no more than ``concurrency``
+    per-location subtasks are in flight at once.
+    """
+    lane_count = max(1, min(concurrency, len(location_ids)))
+    return [location_ids[i::lane_count] for i in range(lane_count)]
+
+
+def build_fan_out(subtask, location_ids, concurrency=None, **kwargs):
+    concurrency = concurrency or settings.GHL_SYNC_FANOUT_CONCURRENCY
+    lanes = split_into_lanes(location_ids, concurrency)
+    return group(chain(subtask.si(loc_id, **kwargs) for loc_id in lane) for lane in lanes)
+
+
+def chunked(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def newer(current, candidate):
+    if candidate is None:
+        return current
+    return candidate if current is None or candidate > current else current
+
+
+def fetch_contact_pages(client, loc_id, access_token, since=None, search_after=None):
+    """
+    Yield ``(contacts, next_cursor)`` for each page of a location's contacts,
+    starting after ``search_after``. ``next_cursor`` is None on the last page.
+    """
+    while True:
+        payload = {"locationId": loc_id, "pageLimit": PAGE_LIMIT}
+        if since:
+            payload["filters"] = [
+                {"field": "dateUpdated", "operator": "range", "value": {"gt": since.isoformat()}}
+            ]
+        if search_after:
+            payload["searchAfter"] = search_after
+
+        response = client.post("/contacts/search", json=payload, access_token=access_token, location_id=loc_id)
+
+        if response.status_code != 200:
+            contact_logger.error(f"Failed to fetch contacts for {loc_id}. Status: {response.status_code}, Response: {response.text}")
+            raise GHLAPIError(f"Contacts page failed for {loc_id}", response.status_code)
+
+        try:
+            data = response.json()
+        except ValueError as e:
+            contact_logger.error(f"Invalid JSON response for location {loc_id}: {str(e)}")
+            raise GHLAPIError(f"Invalid contacts page for {loc_id}")
+        contacts_data = data.get("contacts", [])
+        # Only the records travel on; the raw body and envelope are freed now.
+        del response, data
+        contact_logger.debug(f"Contacts received for {loc_id}: {len(contacts_data)}")
+        PAGES_FETCHED.inc(entity=SyncState.CONTACTS, location_id=loc_id)
+        ROWS_FETCHED.inc(len(contacts_data), entity=SyncState.CONTACTS, location_id=loc_id)
+
+        if not contacts_data:
+            return
+
+        search_after = contacts_data[-1].get("searchAfter")
+        yield contacts_data, search_after
+
+        if not search_after:
+            return
+
+
+def contact_rows(contacts_data, loc_id, since=None, field_definitions=None):
+    """
+    Project a page of contacts to row tuples in ``bulk.CONTACT_COLUMNS``
+    order. Custom field values are keyed by field name using the location's
+    cached definitions, so no extra API calls are made per contact.
+    """
+    field_definitions = field_definitions or {}
+    rows = []
+    watermark = None
+    added_at = convert_timestamps([contact.get("dateAdded") for contact in contacts_data])
+    updated_at = convert_timestamps([contact.get("dateUpdated") for contact in contacts_data])
+    for contact, added_at_local, updated_at_local in zip(contacts_data, added_at, updated_at):
+        watermark = newer(watermark, updated_at_local)
+
+        rows.append(
+            (
+                contact.get("id"),
+                (contact.get("firstNameLowerCase") or "").title(),
+                (contact.get("lastNameLowerCase") or "").title(),
+                contact.get("email"),
+                contact.get("phone"),
+                loc_id,
+                added_at_local,
+                updated_at_local,
+                resolve_custom_fields(contact.get("customFields"), field_definitions),
+            )
+        )
+    return rows, watermark
+
+
+def fetch_opportunity_pages(client, loc_id, access_token, since=None, cursor=None):
+    """
+    Yield ``(opportunities, next_cursor)`` for each page of a location's
+    opportunities, where cursors are ``[startAfter, startAfterId]`` pairs.
+    """
+    start_after, start_after_id = cursor or (None, None)
+    while True:
+        params = {"location_id": loc_id, "limit": PAGE_LIMIT}
+        if start_after:
+            params["startAfter"] = start_after
+            params["startAfterId"] = start_after_id
+
+        # 429s, 520s and other transient statuses are retried by the client.
+        response = client.get("/opportunities/search", params=params, access_token=access_token, location_id=loc_id)
+        logger.debug(f"Response status code: {response.status_code}")
+
+        if response.status_code != 200:
+            logger.error(f"Failed to fetch opportunities for {loc_id}. Status: {response.status_code}, Response: {response.text}")
+            raise GHLAPIError(f"Opportunities page failed for {loc_id}", response.status_code)
+
+        try:
+            data = response.json()
+        except ValueError as e:
+            logger.error(f"Invalid JSON response for location {loc_id}: {str(e)}")
+            raise GHLAPIError(f"Invalid opportunities page for {loc_id}")
+
+        opportunities_data = data.get("opportunities", [])
+        meta_data = data.get("meta", {})
+        del response, data
+        logger.debug(f"Opportunities received for {loc_id}: {len(opportunities_data)}")
+        PAGES_FETCHED.inc(entity=SyncState.OPPORTUNITIES, location_id=loc_id)
+        ROWS_FETCHED.inc(len(opportunities_data), entity=SyncState.OPPORTUNITIES, location_id=loc_id)
+
+        if not opportunities_data:
+            return
+
+        start_after = meta_data.get("startAfter") if meta_data else None
+        start_after_id = meta_data.get("startAfterId") if meta_data else None
+        logger.debug(f"start_after and start_after_id: {start_after} - {start_after_id}")
+
+        if not start_after or not start_after_id:
+            yield opportunities_data, None
+            return
+        yield opportunities_data, [start_after, start_after_id]
+
+
+def opportunity_rows(opportunities_data, loc_id, since=None):
+    """Project a page of opportunities to row tuples in ``bulk.OPPORTUNITY_COLUMNS`` order."""
+    rows = []
+    watermark = None
+    added_at = convert_timestamps([opportunity.get("createdAt") for opportunity in opportunities_data])
+    updated_at = convert_timestamps([opportunity.get("updatedAt") for opportunity in opportunities_data])
+    for opportunity, added_at_local, updated_at_local in zip(opportunities_data, added_at, updated_at):
+        watermark = newer(watermark, updated_at_local)
+        # The opportunities search endpoint has no updatedAt filter, so a delta
+        # run still pages through the location but only writes changed records.
+        if since and updated_at_local and updated_at_local <= since:
+            continue
+
+        rows.append(
+            (
+                opportunity.get("id"),
+                opportunity.get("contactId"),
+                opportunity.get("name"),
+                opportunity.get("phone"),
+                loc_id,
+                opportunity.get("monetaryValue"),
+                added_at_local,
+                updated_at_local,
+                opportunity.get("pipelineId") or "",
+                opportunity.get("pipelineStageId") or "",
+                opportunity.get("status") or "",
+            )
+        )
+    return rows, watermark
+
+
+def rollup_entry(row):
+    """``(rollup key, value)`` of an opportunity row in ``bulk.OPPORTUNITY_COLUMNS`` order."""
+    return (row[4], row[8], row[9], row[10]), row[5]
+
+
+def previous_opportunities(opportunity_ids):
+    """
+    Stored state of the given opportunities before this batch is written:
+    ``(contact ids they are attached to, [(rollup key, value)])``.
+    """
+    contact_ids, entries = set(), []
+    for chunk in chunked(opportunity_ids, IN_CLAUSE_SIZE):
+        for contact_id, *key, value in Opportunity.objects.filter(opportunity_id__in=chunk).values_list(
+            "contact_id", *ROLLUP_KEY, "monetaryValue",
+        ):
+            contact_ids.add(contact_id)
+            entries.append((tuple(key), value))
+    return contact_ids, entries
+
+
+def recompute_contact_totals(contact_ids, only_missing=False):
+    """
+    Recompute ``Contact.opportunity`` for just these contacts. A contact left
+    without opportunities gets 0. With ``only_missing`` only contacts that
+    have no total yet are touched (newly inserted contacts).
+    """
+    qn = connection.ops.quote_name
+    contact = qn(Contact._meta.db_table)
+    opportunity = qn(Opportunity._meta.db_table)
+    missing = f" AND {qn('opportunity')} IS NULL" if only_missing else ""
+    updated = 0
+    with connection.cursor() as cursor:
+        for chunk in chunked(contact_ids, IN_CLAUSE_SIZE):
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(
+                f"""
+                UPDATE {contact}
+                SET {qn('opportunity')} = (
+                    SELECT COALESCE(SUM({opportunity}.{qn('monetaryValue')}), 0)
+                    FROM {opportunity}
+                    WHERE {opportunity}.{qn('contact_id')} = {contact}.{qn('contact_id')}
+                )
+                WHERE {qn('contact_id')} IN ({placeholders}){missing}
+                """,
+                chunk
+            )
+            updated += cursor.rowcount
+    return updated
+
+
+def store_contacts(rows, hashes=None):
+    """Upsert the contacts of a batch that changed; ``hashes`` is the location's HashIndex, if loaded."""
+    changed = changed_rows(contact_spec(), rows, hashes)
+    ROWS_UNCHANGED.inc(len(rows) - len(changed), entity=SyncState.CONTACTS)
+    if not changed:
+        return
+    upsert_contacts(changed)
+    # Contacts synced after their opportunities have no total yet.
+    recompute_contact_totals({row[0] for row in changed}, only_missing=True)
+
+
+def store_opportunities(rows, hashes=None):
+    """
+    Upsert the opportunities of a batch that changed, refresh the totals
+    of every contact they touched, including contacts an opportunity moved
+    away from, and move their count and value between pipeline rollups.
+    Runs in the batch's transaction, so totals never lag behind the rows.
+    """
+    changed = changed_rows(opportunity_spec(), rows, hashes)
+    ROWS_UNCHANGED.inc(len(rows) - len(changed), entity=SyncState.OPPORTUNITIES)
+    if not changed:
+        return
+    rows = changed
+    touched = {row[1] for row in rows if row[1]}
+    previous_contacts, previous_entries = previous_opportunities({row[0] for row in rows})
+    touched.update(previous_contacts)
+    upsert_opportunities(rows)
+    recompute_contact_totals(touched)
+    apply_rollup_deltas(rollup_deltas(previous_entries, [rollup_entry(row) for row in rows]))
+
+
+def delete_contacts(contact_ids):
+    for chunk in chunked(contact_ids, IN_CLAUSE_SIZE):
+        Contact.objects.filter(contact_id__in=chunk).delete()
+
+
+def delete_opportunities(opportunity_ids):
+    touched, entries = previous_opportunities(opportunity_ids)
+    for chunk in chunked(opportunity_ids, IN_CLAUSE_SIZE):
+        Opportunity.objects.filter(opportunity_id__in=chunk).delete()
+    recompute_contact_totals(touched)
+    apply_rollup_deltas(rollup_deltas(entries, []))
+
+
+ENTITY_SYNC = {
+    SyncState.CONTACTS: (fetch_contact_pages, contact_rows, store_contacts, contact_spec),
+    SyncState.OPPORTUNITIES: (fetch_opportunity_pages, opportunity_rows, store_opportunities, opportunity_spec),
+}
+
+
+def write_batch(state, store, rows, next_cursor, rows_flushed, full_sync, watermark, record_progress=None):
+    """
+    Store one batch, its checkpoint and its run progress in one transaction,
+    so the cursor never runs ahead of the data. ``rows_flushed`` includes
+    ``rows``; ``record_progress`` updates the run.
+    """
+    with FLUSH_SECONDS.time(entity=state.entity), transaction.atomic():
+        store(rows)
+        if next_cursor:
+            state.save_checkpoint(next_cursor, rows_flushed, full_sync, watermark)
+        if record_progress:
+            record_progress()
+        bump_data_version([state.location_id])
+    FLUSH_ROWS.observe(len(rows), entity=state.entity)
+
+
+class BatchWriter:
+    """
+    Collects transformed rows and flushes them every ``BATCH_SIZE`` rows,
+    checkpointing the cursor of the last page included in the same transaction.
+    ``begin`` and ``end`` open and close the run; ``end`` also releases the lease.
+    """
+
+    def __init__(self, state, store, full_sync, rows_flushed=0, watermark=None, run=None, lease=None):
+        self.state = state
+        self.store = store
+        self.full_sync = full_sync
+        self.rows_flushed = rows_flushed
+        self.watermark = watermark
+        self.run = run
+        self.lease = lease
+        self.pending = []
+        self.pending_pages = 0
+
+    @staticmethod
+    def load_state(location_id, entity):
+        return SyncState.for_location(location_id, entity)
+
+    def begin(self, resume=False):
+        self.run = SyncRun.begin(self.state.location_id, self.state.entity, self.full_sync, resume=resume)
+        if self.lease:
+            self.lease.attach(self.run.pk)
+
+    def write(self, rows, watermark, next_cursor):
+        self.pending.extend(rows)
+        self.pending_pages += 1
+        self.watermark = newer(self.watermark, watermark)
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush(next_cursor)
+
+    def flush(self, next_cursor=None):
+        if not self.pending:
+            if self.run and self.pending_pages:
+                self.run.record_flush(0, self.pending_pages, next_cursor)
+                self.pending_pages = 0
+            return
+        self.rows_flushed += len(self.pending)
+        record_progress = partial(self.run.record_flush, len(self.pending), self.pending_pages, next_cursor) if self.run else None
+        write_batch(
+            self.state, self.store, self.pending, next_cursor, self.rows_flushed, self.full_sync, self.watermark,
+            record_progress,
+        )
+        logger.info(f"Stored {len(self.pending)} {self.state.entity} for {self.state.location_id} ({self.rows_flushed} this run).")
+        self.pending = []
+        self.pending_pages = 0
+
+    def end(self, error=None):
+        """
+        Close the run. Only a run that walked every page advances the
+        watermark, otherwise the records after a failed page would never be
+        fetched by a delta run; a failed one records ``error``.
+        """
+        if error is None:
+            self.state.mark_synced(self.watermark, self.full_sync)
+            if self.run:
+                self.run.finish()
+        elif self.run:
+            self.run.record_error(error)
+        if self.lease:
+            self.lease.release()
+
+
+class FunnelBatchWriter(BatchWriter):
+    """
+    ``GHL_SYNC_WRITE_MODE = "funnel"``: the fetch worker only reads. The
+    start of the run, each flush and its end become messages for the single
+    writer process, which applies them in order. The lease stays held until
+    the writer has applied the end of the run, so an overlapping run can't
+    start from a checkpoint the writer hasn't caught up with yet.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.run_key = None
+        self.pages_flushed = 0
+
+    @staticmethod
+    def load_state(location_id, entity):
+        # Read only; the writer creates the row when it applies the run.
+        return (
+            SyncState.objects.filter(location_id=location_id, entity=entity).first()
+            or SyncState(location_id=location_id, entity=entity)
+        )
+
+    def _message(self, kind, **fields):
+        return {
+            "kind": kind,
+            "entity": self.state.entity,
+            "location_id": self.state.location_id,
+            "full_sync": self.full_sync,
+            "watermark": encode_datetime(self.watermark),
+            "run_key": self.run_key,
+            "lease_token": self.lease.token if self.lease else None,
+            **fields,
+        }
+
+    def begin(self, resume=False):
+        run = SyncRun.resumable(self.state.location_id, self.state.entity) if resume else None
+        self.run_key = (run and run.key) or uuid.uuid4().hex
+        # Running totals, so the writer can apply a message twice without counting it twice.
+        self.pages_flushed = run.pages if run else 0
+        get_batch_queue().put(self._message("begin", resume=resume))
+
+    def flush(self, next_cursor=None):
+        if not self.pending and not self.pending_pages:
+            return
+        self.rows_flushed += len(self.pending)
+        self.pages_flushed += self.pending_pages
+        get_batch_queue().put(self._message(
+            "batch", rows=encode_rows(self.pending), cursor=next_cursor, rows_flushed=self.rows_flushed,
+            pages_flushed=self.pages_flushed,
+        ))
+        logger.debug(f"Queued {len(self.pending)} {self.state.entity} for {self.state.location_id} ({self.rows_flushed} this run).")
+        self.pending = []
+        self.pending_pages = 0
+
+    def end(self, error=None):
+        if error is None:
+            get_batch_queue().put(self._message("finish"))
+        else:
+            get_batch_queue().put(self._message("error", error=str(error)[:2000]))
+        if self.lease:
+            self.lease.hand_over()  # the writer releases it
+
+
+def sync_writer_class():
+    return FunnelBatchWriter if settings.GHL_SYNC_WRITE_MODE == "funnel" else BatchWriter
+
+
+def apply_write_message(payload):
+    """Apply one funnel message (see ``FunnelBatchWriter``) in the writer process."""
+    kind, entity, location_id = payload["kind"], payload["entity"], payload["location_id"]
+    _, _, store, spec = ENTITY_SYNC[entity]
+    lease = SyncLease.held(location_id, entity, payload["lease_token"]) if payload["lease_token"] else None
+
+    if kind == "begin":
+        run = SyncRun.begin(location_id, entity, payload["full_sync"], resume=payload["resume"], key=payload["run_key"])
+        if lease:
+            lease.attach(run.pk)
+        return 0
+
+    run = SyncRun.objects.filter(key=payload["run_key"]).first()
+    if run and run.status == SyncRun.FAILED:
+        # An earlier message of this run failed: applying the rest would move the
+        # checkpoint and watermark past the rows it lost. A resumed sync begins it again.
+        logger.warning(f"Dropped {kind} of {entity} for {location_id}: its run already failed.")
+        if kind != "batch" and lease:
+            transaction.on_commit(lease.release)
+        return 0
+
+    state = SyncState.for_location(location_id, entity)
+    watermark = decode_datetime(payload["watermark"])
+
+    if kind == "batch":
+        rows = decode_rows(spec(), payload["rows"])
+        record_progress = partial(
+            run.record_progress, payload["rows_flushed"], payload["pages_flushed"], payload["cursor"],
+        ) if run else None
+        write_batch(
+            state, store, rows, payload["cursor"], payload["rows_flushed"], payload["full_sync"], watermark,
+            record_progress,
+        )
+        if lease:
+            lease.renew()
+        return len(rows)
+
+    if kind == "finish":
+        state.mark_synced(watermark, payload["full_sync"])
+        if run:
+            run.finish()
+    elif run:
+        run.record_error(payload["error"])
+    if lease:
+        # Only once committed: the next run must see this one's checkpoint and watermark.
+        transaction.on_commit(lease.release)
+    return 0
+
+
+def apply_write_messages(payloads):
+    """
+    Apply funnel messages in order in one transaction; each message gets a
+    savepoint, so a bad one is logged and dropped without losing the rest.
+    Once a message fails, the rest of its run is dropped too and the run
+    stays failed, with its checkpoint at the last batch applied.
+    Returns ``(rows written, failed messages)``.
+    """
+    rows, failed = 0, 0
+    failed_runs = set()
+    with transaction.atomic():
+        for payload in payloads:
+            run_key = payload.get("run_key")
+            if run_key and run_key in failed_runs:
+                failed += 1
+                logger.warning(f"Dropped {payload.get('kind')} of {payload.get('entity')} for {payload.get('location_id')}: its run already failed.")
+                _release_after_failure(payload)
+                continue
+            try:
+                with transaction.atomic():
+                    rows += apply_write_message(payload)
+            except Exception as e:
+                failed += 1
+                logger.exception(f"Dropped {payload.get('kind')} of {payload.get('entity')} for {payload.get('location_id')}: {str(e)}")
+                if run_key:
+                    failed_runs.add(run_key)
+                    run = SyncRun.objects.filter(key=run_key).first()
+                    if run:
+                        run.record_error(e)
+                _release_after_failure(payload)
+    return rows, failed
+
+
+def _release_after_failure(payload):
+    """The end of a run was dropped: release its lease anyway, once committed."""
+    if payload.get("kind") in ("finish", "error") and payload.get("lease_token"):
+        lease = SyncLease.held(payload["location_id"], payload["entity"], payload["lease_token"])
+        if lease:
+            transaction.on_commit(lease.release)
+
+
+class LocationSync:
+    """
+    One location/entity sync: resume-or-start bookkeeping, the page
+    generator, the row transform and the batch writer. Shared by the
+    sequential, pipelined and asyncio execution modes.
+    """
+
+    def __init__(self, loc_id, entity, access_token, full_sync=False, lease=None):
+        fetch_pages, self._transform, store, spec = ENTITY_SYNC[entity]
+        self.loc_id = loc_id
+        self.entity = entity
+        self.lease = lease
+        self.transform_kwargs = {}
+        if entity == SyncState.CONTACTS:
+            # Before the run begins: a failed definitions fetch fails the task, which retries.
+            self.transform_kwargs["field_definitions"] = get_custom_field_definitions(loc_id, access_token)
+        writer_class = sync_writer_class()
+        if writer_class is BatchWriter:
+            store = partial(store, hashes=HashIndex(spec(), loc_id))
+
+        self.state = state = writer_class.load_state(loc_id, entity)
+        resume = state.has_checkpoint()
+        if resume:
+            self.full_sync = state.cursor_full_sync
+            cursor = state.cursor
+            self.writer = writer_class(state, store, self.full_sync, state.rows_flushed, state.cursor_watermark, lease=lease)
+            logger.info(f"Resuming {entity} sync for {loc_id} after {state.rows_flushed} rows")
+        else:
+            self.full_sync = full_sync or state.needs_full_sync()
+            cursor = None
+            self.writer = writer_class(state, store, self.full_sync, lease=lease)
+        self.writer.begin(resume)
+        self.since = None if self.full_sync else state.delta_since()
+        logger.info(f"{'Full' if self.full_sync else 'Delta'} {entity} sync for {loc_id}" + (f" since {self.since.isoformat()}" if self.since else ""))
+
+        self.pages = fetch_pages(get_client(), loc_id, access_token, self.since, cursor)
+
+    def transform(self, records):
+        return self._transform(records, self.loc_id, self.since, **self.transform_kwargs)
+
+    def write(self, rows, watermark, next_cursor):
+        self.writer.write(rows, watermark, next_cursor)
+        if self.lease:
+            self.lease.renew()
+
+    def abort(self, error):
+        if error.status_code in RETRY_STATUSES:
+            # Let the task retry and resume from the checkpoint rather than dropping pages.
+            self.fail(error)
+            raise error
+        self.writer.flush()
+        self.writer.end(error)
+        logger.error(f"Stopped {self.entity} sync for {self.loc_id}: {str(error)}")
+
+    def fail(self, error):
+        """Record an error that ends this attempt; a retry resumes the same run."""
+        self.writer.end(error)
+
+    def complete(self, stats):
+        self.writer.flush()
+        logger.info(f"{self.entity.title()} sync for {self.loc_id} stage stats: {stats}")
+        self.writer.end()
+
+
+def start_location_sync(loc_id, entity, full_sync=False):
+    """
+    Set up a location sync under its lease. Returns None without syncing
+    when there is no token, or when another run of the same location and
+    entity is in flight (that run's id is logged; the caller attaches to it).
+    """
+    logger.info(f"Processing location_id: {loc_id}")
+
+    lease = SyncLease(loc_id, entity, task_id=current_task_id())
+    if not lease.acquire():
+        logger.info(f"{entity.title()} sync for {loc_id} already running (run {lease.holder.get('run_id')}); skipping")
+        return None
+
+    try:
+        access_token = get_access_token(loc_id)
+        if not access_token:
+            logger.error(f"Failed to retrieve access token for {loc_id}")
+            writer = sync_writer_class()(SyncState(location_id=loc_id, entity=entity), None, full_sync, lease=lease)
+            writer.begin()
+            writer.end("Failed to retrieve access token")
+            return None
+        return LocationSync(loc_id, entity, access_token, full_sync, lease=lease)
+    except Exception:
+        lease.release()
+        raise
+
+
+def sync_location(loc_id, entity, full_sync=False, pipelined=None):
+    job = start_location_sync(loc_id, entity, full_sync)
+    if job is None:
+        return None
+
+    pipelined = settings.GHL_SYNC_PIPELINED if pipelined is None else pipelined
+    try:
+        if pipelined:
+            stats = run_pipelined(job.pages, job.transform, job.write, queue_size=settings.GHL_PIPELINE_QUEUE_SIZE)
+        else:
+            stats = run_sequential(job.pages, job.transform, job.write)
+    except GHLAPIError as e:
+        job.abort(e)
+        return None
+    except Exception as e:
+        job.fail(e)
+        raise
 
+    job.complete(stats)
+    return stats
+
+
+def sync_locations_async(location_ids, entity, full_sync=False, concurrency=None):
+    """
+    Sync many locations from one worker process with the asyncio engine.
+    Raises the first error once every location has finished so the task
+    can retry; completed locations resume as cheap delta runs.
+    """
+    starters = {loc_id: partial(start_location_sync, loc_id, entity, full_sync) for loc_id in location_ids}
+    results = run_sync_jobs(starters, concurrency)
+    errors = [result for result in results.values() if isinstance(result, Exception)]
+    if errors:
+        raise errors[0]
+    return results
+
+
+def sync_location_contacts(loc_id, full_sync=False, pipelined=None):
+    return sync_location(loc_id, SyncState.CONTACTS, full_sync=full_sync, pipelined=pipelined)
+
+
+def sync_location_opportunities(loc_id, full_sync=False, pipelined=None):
+    return sync_location(loc_id, SyncState.OPPORTUNITIES, full_sync=full_sync, pipelined=pipelined)
 
 @shared_task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 60})
-def fetch_contacts_task(self, location_id=None):
+def fetch_contacts_task(self, location_id=None, fan_out=False, full_sync=False, use_async=False):
     try:
         contact_logger.info("Task started.")
-        
-        location_ids = [location_id] if location_id else list(GHLOAuth.objects.values_list("location_id", flat=True))
-        
+
+        location_ids = get_location_ids(location_id)
+
         if not location_ids:
             contact_logger.error("No locations found in the database.")
             return {"error": "No locations found"}
 
-        for loc_id in location_ids:
-            contact_logger.info(f"Processing location_id: {loc_id}")
-            
-            oauth_entry = GHLOAuth.objects.filter(location_id=loc_id).first()
-            if not oauth_entry:
-                contact_logger.error(f"No stored token for location {loc_id}")
-                continue
+        if fan_out and len(location_ids) > 1:
+            build_fan_out(fetch_location_contacts_task, location_ids, full_sync=full_sync).apply_async()
+            contact_logger.info(f"Dispatched contact sync for {len(location_ids)} locations.")
+            return {"message": "Contact sync dispatched", "locations": len(location_ids)}
 
-            access_token = oauth_entry.get_valid_access_token()
-            if not access_token:
-                contact_logger.error(f"Failed to retrieve access token for {loc_id}")
-                continue
+        if use_async:
+            sync_locations_async(location_ids, SyncState.CONTACTS, full_sync=full_sync)
+        else:
+            for loc_id in location_ids:
+                sync_location_contacts(loc_id, full_sync=full_sync)
 
-            url = "https://services.leadconnectorhq.com/contacts/search"
-            headers = {
-                "Authorization": f"Bearer {access_token}",
-                "Version": "2021-07-28",
-                "Content-Type": "application/json",
-                "Accept": "application/json"
-            }
-            
-            page_limit = 100
-            search_after = None
-            batch_size = 3000
-            insert_data = []
-                
-            
-            while True:
-                payload = {"locationId": loc_id, "pageLimit": page_limit}
-                if search_after:
-                    payload["searchAfter"] = search_after
-                
-                response = requests.post(url, json=payload, headers=headers)
-                
-                if response.status_code != 200:
-                    contact_logger.error(f"Failed to fetch contacts for {loc_id}. Status: {response.status_code}, Response: {response.text}")
-                    break
-                
-                try:
-                    data = response.json()
-                except ValueError as e:
-                    contact_logger.error(f"Invalid JSON response for location {loc_id}: {str(e)}")
-                    break
-                contacts_data = data.get("contacts", [])
-                contact_logger.info(f"Contacts received for {loc_id}: {len(contacts_data)}")
-                
-                if not contacts_data:
-                    break
-                
-                
-                for contact in contacts_data:
-                    contact_id = contact.get("id")
-                    added_at_utc = contact.get("dateAdded")
-                    updated_at_utc = contact.get("dateUpdated")
-                    added_at_local = convert_to_timezone(added_at_utc, "Asia/Kolkata") if added_at_utc else None
-                    updated_at_local = convert_to_timezone(updated_at_utc, "Asia/Kolkata") if updated_at_utc else None
-                    
-                    insert_data.append(
-                        (
-                            contact_id,
-                            (contact.get("firstNameLowerCase") or "").title(),
-                            (contact.get("lastNameLowerCase") or "").title(),
-                            contact.get("email"),
-                            contact.get("phone"),
-                            loc_id,
-                            added_at_local,
-                            updated_at_local
-                        )
-                    )
-                
-                if len(insert_data)>=batch_size:
-                    with transaction.atomic():
-                        with connection.cursor() as cursor:
-                            cursor.executemany(
-                                """
-                                INSERT INTO Contact (
-                                    contact_id,
-                                    first_name,
-                                    last_name, 
-                                    email, 
-                                    phone, 
-                                    location_id, 
-                                    created_at, 
-                                    updated_at)
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                                ON CONFLICT (contact_id) DO UPDATE
-                                SET 
-                                    first_name = EXCLUDED.first_name,
-                                    last_name = EXCLUDED.last_name,
-                                    email = EXCLUDED.email,
-                                    phone = EXCLUDED.phone,
-                                    created_at = EXCLUDED.created_at,
-                                    updated_at = EXCLUDED.updated_at;
-                                """,
-                                insert_data
-                            )
-
-                    insert_data=[]
-                
-                
-                search_after = contacts_data[-1].get("searchAfter") if contacts_data else None
-                if not search_after:
-                    
-                    break
-        
-            if insert_data:
-                with transaction.atomic():
-                    with connection.cursor() as cursor:
-                        cursor.executemany(
-                            """
-                            INSERT INTO Contact (
-                                contact_id,
-                                first_name,
-                                last_name, 
-                                email, 
-                                phone, 
-                                location_id, 
-                                created_at, 
-                                updated_at)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                            ON CONFLICT (contact_id) DO UPDATE
-                            SET 
-                                first_name = EXCLUDED.first_name,
-                                last_name = EXCLUDED.last_name,
-                                email = EXCLUDED.email,
-                                phone = EXCLUDED.phone,
-                                created_at = EXCLUDED.created_at,
-                                updated_at = EXCLUDED.updated_at;
-                            """,
-                            insert_data
-                        )
-
-                insert_data=[]
-            
-        contact_logger.info("Task completed successfully.")
+        contact_logger.info(f"Task completed successfully. HTTP stats: {get_client().stats()}")
         return {"message": "Contacts fetched, updated, and stored successfully"}
-    
+
     except Exception as e:
         contact_logger.exception(f"Unexpected error: {str(e)}")
         raise self.retry(exc=e)  # Retry the task in case of failure
 
 
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def fetch_location_contacts_task(self, location_id, full_sync=False):
+    """Fan-out subtask: sync the contacts of a single location."""
+    try:
+        sync_location_contacts(location_id, full_sync=full_sync)
+        return {"location_id": location_id, "message": "Contacts stored"}
+
+    except Exception as e:
+        contact_logger.exception(f"Contact sync failed for {location_id}: {str(e)}")
+        if self.request.retries >= self.max_retries:
+            # Don't break the lane for the remaining locations.
+            return {"location_id": location_id, "error": str(e)}
+        raise self.retry(exc=e)
 
-logger = logging.getLogger(__name__)
 
 @shared_task(bind=True, autoretry_for=(Exception,), retry_kwargs={'max_retries': 3, 'countdown': 60})
-def fetch_opportunities_task(self, location_id=None):
+def fetch_opportunities_task(self, location_id=None, fan_out=False, full_sync=False, use_async=False):
     try:
-        location_ids = [location_id] if location_id else list(GHLOAuth.objects.values_list("location_id", flat=True))
-        
+        location_ids = get_location_ids(location_id)
+
         if not location_ids:
             logger.error("No locations found in the database.")
             return {"error": "No locations found"}
 
-        for loc_id in location_ids:
-            logger.info(f"Processing location_id: {loc_id}")
-            
-            oauth_entry = GHLOAuth.objects.filter(location_id=loc_id).first()
-            if not oauth_entry:
-                logger.error(f"No stored token for location {loc_id}")
-                continue
-
-            access_token = oauth_entry.get_valid_access_token()
-            if not access_token:
-                logger.error(f"Failed to retrieve access token for {loc_id}")
-                continue
-
-            url = f"https://services.leadconnectorhq.com/opportunities/search?location_id={loc_id}"
-            headers = {
-                "Authorization": f"Bearer {access_token}",
-                "Version": "2021-07-28",
-                "Accept": "application/json"
-            }
-
-            page_limit = 100  # API limit
-            start_after = None
-            start_after_id = None
-            opportunities_to_store = []
-            batch_size = 3000
-
-
-            while True:
-                params = {"limit": page_limit}
-                if start_after:
-                    params["startAfter"] = start_after
-                    params["startAfterId"] = start_after_id
-
-                retry_attempts = 3
-                while retry_attempts > 0:
-                    response = requests.get(url, headers=headers, params=params)
-                    logger.info(f"Response status code: {response.status_code}")
-
-                    if response.status_code == 520:
-                        logger.error("520 Error encountered. Retrying...")
-                        retry_attempts -= 1
-                        time.sleep(5)  # Wait before retrying
-                    else:
-                        break
-
-                if response.status_code != 200:
-                    logger.error(f"Failed to fetch opportunities for {loc_id}. Status: {response.status_code}, Response: {response.text}")
-                    break
-
-                try:
-                    data = response.json()
-                except ValueError as e:
-                    logger.error(f"Invalid JSON response for location {loc_id}: {str(e)}")
-                    break
-
-                opportunities_data = data.get("opportunities", [])
-                meta_data = data.get("meta", {})
-                logger.info(f"Opportunities received for {loc_id}: {len(opportunities_data)}")
+        # Contact totals are maintained per batch by store_opportunities(), so
+        # neither mode needs a full update_contact_opportunity_totals pass.
+        if fan_out and len(location_ids) > 1:
+            build_fan_out(fetch_location_opportunities_task, location_ids, full_sync=full_sync).apply_async()
+            logger.info(f"Dispatched opportunity sync for {len(location_ids)} locations.")
+            return {"message": "Opportunity sync dispatched", "locations": len(location_ids)}
 
-                if not opportunities_data:
-                    break
+        if use_async:
+            sync_locations_async(location_ids, SyncState.OPPORTUNITIES, full_sync=full_sync)
+        else:
+            for loc_id in location_ids:
+                sync_location_opportunities(loc_id, full_sync=full_sync)
 
-                
-                for opportunity in opportunities_data:
-                    added_at_utc = opportunity.get("createdAt")
-                    updated_at_utc = opportunity.get("updatedAt")
-                    added_at_local = convert_to_timezone(added_at_utc, "Asia/Kolkata") if added_at_utc else None
-                    updated_at_local = convert_to_timezone(updated_at_utc, "Asia/Kolkata") if updated_at_utc else None
-                    
-                    opportunity_id = opportunity.get("id")
-                    contact_id = opportunity.get("contactId")
-                    name = opportunity.get("name")
-                    phone = opportunity.get("phone")
-                    monetary_value = opportunity.get("monetaryValue")
-
-                    
-                    opportunities_to_store.append(
-                        (
-                            opportunity_id,
-                            contact_id, 
-                            name, 
-                            phone, 
-                            loc_id, 
-                            monetary_value,
-                            added_at_local,
-                            updated_at_local
-                        )
-                    )
-
-
-
-                logger.info(f"Updated {len(opportunities_to_store)} opportunities in DB.")
-                
-                if len(opportunities_to_store)>=batch_size:
-                    with transaction.atomic():
-                        with connection.cursor() as cursor:
-                            cursor.executemany(
-                                """
-                                INSERT INTO Opportunity (
-                                    opportunity_id,
-                                    contact_id,
-                                    name, 
-                                    phone, 
-                                    location_id,
-                                    monetaryValue, 
-                                    created_at, 
-                                    updated_at
-                                    )
-                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                                ON CONFLICT (opportunity_id) DO UPDATE
-                                SET 
-                                    name = EXCLUDED.name,
-                                    phone = EXCLUDED.phone,
-                                    monetaryValue = EXCLUDED.monetaryValue,
-                                    created_at = EXCLUDED.created_at,
-                                    updated_at = EXCLUDED.updated_at;
-                                """,
-                                opportunities_to_store
-                            )
-                    
-                    logger.info(f"Updated {len(opportunities_to_store)} opportunities in DB.")
-                    
-                    opportunities_to_store=[]
-                
-
-                start_after = meta_data.get("startAfter") if meta_data else None
-                start_after_id = meta_data.get("startAfterId") if meta_data else None
-                logger.info(f"start_after and start_after_id: {start_after} - {start_after_id}")
-
-                if not start_after or not start_after_id:
-                    
-                    break
-            
-            if opportunities_to_store:
-                with transaction.atomic():
-                    with connection.cursor() as cursor:
-                        cursor.executemany(
-                            """
-                            INSERT INTO Opportunity (
-                                opportunity_id,
-                                contact_id,
-                                name, 
-                                phone, 
-                                location_id,
-                                monetaryValue, 
-                                created_at, 
-                                updated_at)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                            ON CONFLICT (opportunity_id) DO UPDATE
-                            SET 
-                                name = EXCLUDED.name,
-                                phone = EXCLUDED.phone,
-                                monetaryValue = EXCLUDED.monetaryValue,
-                                created_at = EXCLUDED.created_at,
-                                updated_at = EXCLUDED.updated_at;
-                            """,
-                            opportunities_to_store
-                        )
-                
-                opportunities_to_store=[]
-        
-        update_contact_opportunity_totals.delay()
-        logger.info("Task completed successfully.")
+        logger.info(f"Task completed successfully. HTTP stats: {get_client().stats()}")
         return {"message": "Opportunities fetched and stored successfully"}
 
     except Exception as e:
@@ -349,29 +760,74 @@ def fetch_opportunities_task(self, location_id=None):
         raise self.retry(exc=e)  # Retry the task in case of failure
 
 
+@shared_task(bind=True, max_retries=3, default_retry_delay=60)
+def fetch_location_opportunities_task(self, location_id, full_sync=False):
+    """Fan-out subtask: sync the opportunities of a single location."""
+    try:
+        sync_location_opportunities(location_id, full_sync=full_sync)
+        return {"location_id": location_id, "message": "Opportunities stored"}
+
+    except Exception as e:
+        logger.exception(f"Opportunity sync failed for {location_id}: {str(e)}")
+        if self.request.retries >= self.max_retries:
+            # Don't break the lane for the remaining locations.
+            return {"location_id": location_id, "error": str(e)}
+        raise self.retry(exc=e)
+
+
 
 
 @shared_task(bind=True)
-def update_contact_opportunity_totals(self):
+def plan_sync_schedules(self):
+    """Re-derive every location's polling interval from its recent change rate."""
+    location_ids = get_location_ids()
+    plans = plan_schedules(location_ids)
+    logger.info(f"Planned sync schedules for {len(plans)} locations.")
+    return {"message": "Sync schedules planned", "locations": len(plans)}
+
+
+
+@shared_task(bind=True)
+def update_contact_opportunity_totals(self, contact_ids=None):
+    """
+    With ``contact_ids``, recompute only those contacts' totals. Without,
+    rebuild every total and pipeline rollup; the sync keeps both current
+    per batch, so this full pass is only a periodic repair.
+    """
     try:
-        cursor = connection.cursor()
+        if contact_ids is not None:
+            with TOTALS_SECONDS.time(scope="contacts"):
+                updated = recompute_contact_totals(contact_ids)
+            locations = set()
+            for chunk in chunked(list(contact_ids), IN_CLAUSE_SIZE):
+                locations.update(Contact.objects.filter(contact_id__in=chunk).values_list("location_id", flat=True))
+            bump_data_version(locations)
+            contact_logger.info(f"Updated opportunity totals for {updated} contacts.")
+            return {"message": "Contact opportunity totals updated", "contacts": updated}
 
-        contact_logger.info("Updating contact opportunity totals...")
+        cursor = connection.cursor()
 
-        cursor.execute(
-            """
-            UPDATE Contact
-            SET opportunity = (
-                SELECT COALESCE(SUM(monetaryValue), 0)
-                FROM Opportunity
-                WHERE Opportunity.contact_id = Contact.contact_id
+        contact_logger.info("Rebuilding all contact opportunity totals...")
+
+        # Also resets contacts whose opportunities all moved to another contact.
+        with TOTALS_SECONDS.time(scope="all"):
+            cursor.execute(
+                """
+                UPDATE Contact
+                SET opportunity = (
+                    SELECT COALESCE(SUM(monetaryValue), 0)
+                    FROM Opportunity
+                    WHERE Opportunity.contact_id = Contact.contact_id
+                )
+                WHERE EXISTS (
+                    SELECT 1 FROM Opportunity WHERE Opportunity.contact_id = Contact.contact_id
+                ) OR opportunity != 0;
+                """
             )
-            WHERE EXISTS (
-                SELECT 1 FROM Opportunity WHERE Opportunity.contact_id = Contact.contact_id
-            );
-            """
-        )
+        with TOTALS_SECONDS.time(scope="rollups"):
+            rebuild_rollups()
 
+        bump_data_version(get_location_ids())
         contact_logger.info("Contact opportunity totals updated successfully.")
         return {"message": "Contact opportunity totals updated"}
 
@@ -379,3 +835,91 @@ def update_contact_opportunity_totals(self):
         contact_logger.exception(f"Unexpected error: {str(e)}")
         return {"error": str(e)}
 
+
+WEBHOOK_FLUSH_SCHEDULED_KEY = "ghl:webhook_flush:scheduled"
+WEBHOOK_FLUSH_LOCK_KEY = "ghl:webhook_flush:lock"
+
+
+def schedule_webhook_flush():
+    """
+    Queue a flush unless one is already pending, so every burst of events
+    within ``GHL_WEBHOOK_FLUSH_DELAY_SECONDS`` is written as one batch.
+    """
+    if not cache.add(WEBHOOK_FLUSH_SCHEDULED_KEY, 1, timeout=60):
+        return
+    try:
+        flush_webhook_events.apply_async(countdown=settings.GHL_WEBHOOK_FLUSH_DELAY_SECONDS)
+    except Exception as e:
+        # The events stay buffered; let the next webhook try to schedule again.
+        cache.delete(WEBHOOK_FLUSH_SCHEDULED_KEY)
+        logger.error(f"Could not schedule webhook flush: {str(e)}")
+
+
+def drop_stale_rows(spec, rows):
+    """
+    Rows not older than the stored record. A late, redelivered or replayed
+    event must not overwrite what a poll or a later event already stored.
+    """
+    if not rows:
+        return rows
+    updated_at = spec.data_columns.index("updated_at")
+    stored = {}
+    for chunk in chunked({row[0] for row in rows}, IN_CLAUSE_SIZE):
+        stored.update(
+            spec.model.objects.filter(**{f"{spec.conflict_column}__in": chunk})
+            .values_list(spec.conflict_column, "updated_at")
+        )
+    fresh = [
+        row for row in rows
+        if not (row[updated_at] and stored.get(row[0]) and stored[row[0]] > row[updated_at])
+    ]
+    if len(fresh) < len(rows):
+        logger.info(f"Skipped {len(rows) - len(fresh)} stale {spec.model._meta.db_table} webhook records.")
+    return fresh
+
+
+def apply_webhook_events(events):
+    """Write the net effect of buffered events with the sync's store functions."""
+    changes = coalesce_events(events)
+    bump_data_version(loc_id for entity_changes in changes.values() for loc_id in entity_changes)
+
+    for loc_id, (records, deleted) in changes[SyncState.CONTACTS].items():
+        if records:
+            access_token = get_access_token(loc_id)
+            field_definitions = get_custom_field_definitions(loc_id, access_token) if access_token else {}
+            rows, _ = contact_rows(list(records.values()), loc_id, field_definitions=field_definitions)
+            store_contacts(drop_stale_rows(contact_spec(), rows))
+        if deleted:
+            delete_contacts(deleted)
+
+    for loc_id, (records, deleted) in changes[SyncState.OPPORTUNITIES].items():
+        if records:
+            rows, _ = opportunity_rows(list(records.values()), loc_id)
+            store_opportunities(drop_stale_rows(opportunity_spec(), rows))
+        if deleted:
+            delete_opportunities(deleted)
+
+
+@shared_task(bind=True)
+def flush_webhook_events(self):
+    """Drain the webhook buffer in batches, one transaction per batch."""
+    cache.delete(WEBHOOK_FLUSH_SCHEDULED_KEY)  # events arriving from now on schedule the next flush
+    if not cache.add(WEBHOOK_FLUSH_LOCK_KEY, 1, timeout=300):
+        schedule_webhook_flush()  # another flush is running; come back after it
+        return {"message": "Flush already running"}
+
+    applied = 0
+    try:
+        while True:
+            with transaction.atomic():
+                events = list(WebhookEvent.objects.order_by("id")[:settings.GHL_WEBHOOK_FLUSH_BATCH_SIZE])
+                if not events:
+                    break
+                apply_webhook_events(events)
+                for chunk in chunked([event.id for event in events], IN_CLAUSE_SIZE):
+                    WebhookEvent.objects.filter(id__in=chunk).delete()
+            applied += len(events)
+            logger.info(f"Applied {len(events)} webhook events.")
+    finally:
+        cache.delete(WEBHOOK_FLUSH_LOCK_KEY)
+    return {"message": "Webhook events applied", "events": applied}
@@ -1,3 +1,1137 @@
-from django.test import TestCase
+import base64
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import tempfile
+from io import StringIO
+from datetime import timedelta
+from unittest import mock
+from zoneinfo import ZoneInfo
 
-# Create your tests here.
+import requests
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.timezone import now
+
+from . import bulk, metrics
+from .admin import prefix_match
+from .bulk import upsert_contacts, upsert_opportunities
+from .custom_fields import CustomFieldCache, get_field_cache, resolve_custom_fields
+from .fake_api import FakeGHLServer
+from .funnel import BatchQueue, get_batch_queue, reset_batch_queue
+from .leases import SyncLease, lease_key
+from .views import CONTACT_FIELDS, keyset_page
+from .scheduling import interval_minutes, periodic_task_name, plan_schedules
+from .ghl_client import GHLAPIError, GHLClient, reset_client
+from .rate_limit import RateLimiter, retry_after_seconds
+from .utils import convert_timestamps, convert_to_timezone, to_local
+from .models import Contact, GHLOAuth, Opportunity, OpportunityRollup, SyncRun, SyncState, WebhookEvent
+from .pipeline import run_pipelined
+from .tokens import TokenManager, get_token_manager
+from .rollups import rebuild_rollups
+from .tasks import (
+    BatchWriter, apply_write_messages,
+    delete_opportunities, fetch_contacts_task, fetch_opportunities_task, flush_webhook_events, recompute_contact_totals, split_into_lanes, store_contacts, store_opportunities, sync_location_contacts, sync_locations_async,
+    update_contact_opportunity_totals,
+)
+
+
+def fake_response(status_code, payload=None, headers=None):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.json.return_value = payload or {}
+    response.headers = headers or {}
+    response.text = ""
+    return response
+
+
+class GHLClientTests(SimpleTestCase):
+    def make_client(self, **kwargs):
+        return GHLClient(base_url="http://ghl.test", backoff_factor=0, rate_limiter=mock.Mock(), **kwargs)
+
+    def test_retries_transient_status_then_succeeds(self):
+        client = self.make_client(max_retries=3)
+        responses = [fake_response(520), fake_response(503), fake_response(200)]
+        with mock.patch.object(client.session, "request", side_effect=responses) as request:
+            response = client.get("/opportunities/search", access_token="abc")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(client.stats()["retries"], 2)
+        self.assertEqual(request.call_args.kwargs["headers"]["Authorization"], "Bearer abc")
+        self.assertEqual(request.call_args.args[1], "http://ghl.test/opportunities/search")
+
+    def test_returns_last_response_when_retries_exhausted(self):
+        client = self.make_client(max_retries=1)
+        with mock.patch.object(client.session, "request", return_value=fake_response(520)) as request:
+            response = client.get("/contacts/search")
+
+        self.assertEqual(response.status_code, 520)
+        self.assertEqual(request.call_count, 2)
+
+    def test_client_errors_are_not_retried(self):
+        client = self.make_client(max_retries=3)
+        with mock.patch.object(client.session, "request", return_value=fake_response(401)) as request:
+            response = client.get("/contacts/search")
+
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(request.call_count, 1)
+
+    def test_retry_false_sends_once(self):
+        client = self.make_client(max_retries=3)
+        with mock.patch.object(client.session, "request", return_value=fake_response(503)) as request:
+            self.assertEqual(client.post("/oauth/token", retry=False).status_code, 503)
+        with mock.patch.object(client.session, "request", side_effect=requests.Timeout) as request:
+            with self.assertRaises(requests.Timeout):
+                client.post("/oauth/token", retry=False)
+        self.assertEqual(request.call_count, 1)
+
+    def test_429_pauses_the_location_for_retry_after(self):
+        client = self.make_client(max_retries=2)
+        responses = [fake_response(429, headers={"Retry-After": "7"}), fake_response(200)]
+        with mock.patch.object(client.session, "request", side_effect=responses):
+            response = client.get("/contacts/search", location_id="loc1")
+
+        self.assertEqual(response.status_code, 200)
+        client.rate_limiter.penalize.assert_called_once_with("loc1", 7.0)
+        self.assertEqual(client.rate_limiter.acquire.call_count, 2)
+        self.assertEqual(client.stats()["throttled"], 1)
+
+
+@override_settings(GHL_RATE_LIMIT_WINDOW_SECONDS=10, GHL_RATE_LIMIT_LOCATION_REQUESTS=3, GHL_RATE_LIMIT_APP_REQUESTS=5)
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        self.limiter = RateLimiter()
+
+    def test_location_budget_runs_dry(self):
+        self.assertEqual([self.limiter._take("loc1")[0] for _ in range(3)], [0, 0, 0])
+        self.assertGreater(self.limiter._take("loc1")[0], 0)
+        self.assertEqual(self.limiter._take("loc2")[0], 0)
+
+    def test_no_double_burst_across_window_edge(self):
+        with mock.patch("ghl_auth.rate_limit.time.time", return_value=1009.9):
+            self.assertEqual([self.limiter._take("loc1")[0] for _ in range(3)], [0, 0, 0])
+        with mock.patch("ghl_auth.rate_limit.time.time", return_value=1010.1):
+            wait, key = self.limiter._take("loc1")
+        self.assertIsNone(key)
+        self.assertAlmostEqual(wait, 3.233, places=2)  # until a third of the old window has slid out
+        with mock.patch("ghl_auth.rate_limit.time.time", return_value=1013.5):
+            self.assertEqual(self.limiter._take("loc1")[0], 0)
+
+    def test_location_denial_refunds_the_app_budget(self):
+        for _ in range(3):
+            self.limiter.acquire("loc1")
+        with mock.patch("ghl_auth.rate_limit.time.sleep", side_effect=StopIteration):
+            with self.assertRaises(StopIteration):
+                self.limiter.acquire("loc1")
+        self.assertEqual([self.limiter._take("app")[0] for _ in range(2)], [0, 0])
+
+    def test_penalize_sets_shared_cooldown(self):
+        self.limiter.penalize("loc1", 5)
+
+        self.assertGreater(self.limiter._cooldown("loc1"), 4)
+        self.assertEqual(self.limiter._cooldown("loc2"), 0)
+
+    def test_retry_after_from_rate_limit_headers(self):
+        response = fake_response(429, headers={
+            "X-RateLimit-Remaining": "0", "X-RateLimit-Interval-Milliseconds": "10000",
+        })
+        self.assertEqual(retry_after_seconds(response), 10)
+        self.assertIsNone(retry_after_seconds(fake_response(429)))
+
+
+class FanOutTests(SimpleTestCase):
+    def test_lanes_respect_concurrency_cap(self):
+        lanes = split_into_lanes([f"loc{i}" for i in range(10)], 3)
+
+        self.assertEqual(len(lanes), 3)
+        self.assertEqual(sorted(sum(lanes, [])), sorted(f"loc{i}" for i in range(10)))
+
+    def test_fewer_locations_than_cap(self):
+        self.assertEqual(split_into_lanes(["a", "b"], 8), [["a"], ["b"]])
+
+
+class TokenManagerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.manager = TokenManager(refresh_margin=300, wait_timeout=1)
+        self.token = GHLOAuth.objects.create(
+            location_id="loc1", access_token="old", refresh_token="refresh",
+            expires_at=now() + timedelta(seconds=60),
+        )
+        self.client_mock = mock.Mock()
+        self.client_mock.post.return_value = fake_response(
+            200, {"access_token": "new", "refresh_token": "refresh2", "expires_in": 86400},
+        )
+        patcher = mock.patch("ghl_auth.models.get_client", return_value=self.client_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_refreshes_ahead_of_expiry_then_serves_from_memory(self):
+        self.assertEqual(self.manager.get_token("loc1"), "new")
+        with self.assertNumQueries(0):
+            self.assertEqual(self.manager.get_token("loc1"), "new")
+        self.assertEqual(self.client_mock.post.call_count, 1)
+        self.assertEqual(GHLOAuth.objects.get(location_id="loc1").refresh_token, "refresh2")
+
+    def test_lock_winner_skips_refresh_already_done_elsewhere(self):
+        stale = GHLOAuth.objects.get(location_id="loc1")
+        GHLOAuth.objects.filter(location_id="loc1").update(access_token="other", expires_at=now() + timedelta(hours=1))
+
+        self.assertEqual(self.manager._refresh(stale), "other")
+        self.client_mock.post.assert_not_called()
+
+    def test_waits_for_refresh_by_another_worker(self):
+        GHLOAuth.objects.filter(location_id="loc1").update(expires_at=now() - timedelta(seconds=1))
+        cache.add("ghl:token_refresh:loc1", 1234)
+
+        def other_worker_refreshes(seconds):
+            GHLOAuth.objects.filter(location_id="loc1").update(access_token="theirs", expires_at=now() + timedelta(hours=1))
+
+        with mock.patch("ghl_auth.tokens.time.sleep", side_effect=other_worker_refreshes):
+            self.assertEqual(self.manager.get_token("loc1"), "theirs")
+        self.client_mock.post.assert_not_called()
+
+    def test_refresh_keeps_a_lock_taken_over_after_expiry(self):
+        def lock_expires_mid_refresh(*args, **kwargs):
+            cache.set("ghl:token_refresh:loc1", "other-worker")
+            return fake_response(200, {"access_token": "new", "refresh_token": "refresh2", "expires_in": 86400})
+
+        self.client_mock.post.side_effect = lock_expires_mid_refresh
+        self.assertEqual(self.manager.get_token("loc1"), "new")
+        self.assertEqual(cache.get("ghl:token_refresh:loc1"), "other-worker")
+        self.assertEqual(self.client_mock.post.call_args.kwargs["retry"], False)
+        self.assertGreater(self.manager.lock_timeout, 2 * settings.GHL_HTTP_TIMEOUT)
+
+    def test_expiring_token_is_used_while_another_worker_refreshes(self):
+        cache.add("ghl:token_refresh:loc1", 1234)
+
+        self.assertEqual(self.manager.get_token("loc1"), "old")
+        self.client_mock.post.assert_not_called()
+
+
+class SyncStateTests(TestCase):
+    def test_first_run_is_full_then_delta(self):
+        state = SyncState.for_location("loc1", SyncState.CONTACTS)
+        self.assertTrue(state.needs_full_sync())
+
+        watermark = now() - timedelta(hours=1)
+        state.mark_synced(watermark, full_sync=True)
+
+        self.assertFalse(state.needs_full_sync())
+        self.assertEqual(state.watermark, watermark)
+        self.assertLess(state.delta_since(), watermark)
+
+    def test_watermark_never_moves_backwards(self):
+        state = SyncState.for_location("loc1", SyncState.OPPORTUNITIES)
+        watermark = now()
+        state.mark_synced(watermark, full_sync=True)
+        state.mark_synced(watermark - timedelta(days=1), full_sync=False)
+
+        self.assertEqual(state.watermark, watermark)
+
+    @override_settings(GHL_FULL_RESYNC_HOURS=1)
+    def test_full_resync_after_interval(self):
+        state = SyncState.for_location("loc1", SyncState.CONTACTS)
+        state.mark_synced(now(), full_sync=True)
+        state.last_full_sync_at = now() - timedelta(hours=2)
+
+        self.assertTrue(state.needs_full_sync())
+
+
+def contact_page(start, count, last=False):
+    contacts = [
+        {
+            "id": f"c{i}",
+            "firstNameLowerCase": f"first{i}",
+            "lastNameLowerCase": "last",
+            "email": f"c{i}@example.com",
+            "phone": "+10000000000",
+            "dateAdded": "2024-01-01T00:00:00.000Z",
+            "dateUpdated": f"2024-01-02T00:00:{i % 60:02d}.000Z",
+            "customFields": [{"id": "f1", "value": f"@c{i}"}],
+            "searchAfter": None if last and i == start + count - 1 else [i, f"c{i}"],
+        }
+        for i in range(start, start + count)
+    ]
+    return fake_response(200, {"contacts": contacts})
+
+
+def patch_client(test, client_mock):
+    """Route the sync and custom field lookups through ``client_mock``."""
+    client_mock.get.return_value = fake_response(200, {"customFields": [{"id": "f1", "name": "Twitter"}]})
+    for target in ("ghl_auth.tasks.get_client", "ghl_auth.custom_fields.get_client"):
+        patcher = mock.patch(target, return_value=client_mock)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    field_cache = get_field_cache()
+    for loc_id in ("loc1", "loc2", "loc3"):
+        field_cache.invalidate(loc_id)
+
+
+class SyncLocationContactsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        GHLOAuth.objects.create(
+            location_id="loc1", access_token="token", refresh_token="refresh",
+            expires_at=now() + timedelta(hours=1),
+        )
+        self.client_mock = mock.Mock()
+        patch_client(self, self.client_mock)
+
+    def test_full_then_delta_sync(self):
+        self.client_mock.post.side_effect = [contact_page(0, 100), contact_page(100, 50, last=True)]
+        sync_location_contacts("loc1")
+
+        self.assertEqual(Contact.objects.filter(location_id="loc1").count(), 150)
+        self.assertEqual(Contact.objects.get(contact_id="c3").first_name, "First3")
+        self.assertNotIn("filters", self.client_mock.post.call_args_list[0].kwargs["json"])
+
+        self.client_mock.post.side_effect = [fake_response(200, {"contacts": []})]
+        sync_location_contacts("loc1")
+
+        self.assertIn("filters", self.client_mock.post.call_args.kwargs["json"])
+
+    def test_custom_fields_use_one_definition_call(self):
+        self.client_mock.post.side_effect = [contact_page(0, 100), contact_page(100, 50, last=True)]
+        sync_location_contacts("loc1")
+
+        self.assertEqual(Contact.objects.get(contact_id="c7").custom_fields, {"Twitter": "@c7"})
+        self.assertEqual(self.client_mock.get.call_count, 1)
+        self.assertEqual(self.client_mock.get.call_args.args[0], "/locations/loc1/customFields")
+
+    def test_failed_definitions_fetch_stops_the_sync(self):
+        self.client_mock.get.return_value = fake_response(500)
+        with self.assertRaises(GHLAPIError):
+            sync_location_contacts("loc1")
+
+        # Nothing stored with raw field IDs, nothing cached, and the retry may start at once.
+        self.client_mock.post.assert_not_called()
+        self.assertFalse(Contact.objects.exists() or SyncRun.objects.exists())
+        self.assertIsNone(cache.get(lease_key("loc1", SyncState.CONTACTS)))
+
+        self.client_mock.get.return_value = fake_response(200, {"customFields": [{"id": "f1", "name": "Twitter"}]})
+        self.client_mock.post.side_effect = [contact_page(0, 10, last=True)]
+        sync_location_contacts("loc1")
+        self.assertEqual(Contact.objects.get(contact_id="c7").custom_fields, {"Twitter": "@c7"})
+
+    def test_resumes_from_checkpoint_after_failure(self):
+        pages = [contact_page(i * 100, 100) for i in range(30)]
+        self.client_mock.post.side_effect = pages + [ConnectionError("boom")]
+        with self.assertRaises(ConnectionError):
+            sync_location_contacts("loc1")
+
+        state = SyncState.for_location("loc1", SyncState.CONTACTS)
+        self.assertEqual(state.rows_flushed, 3000)
+        self.assertEqual(state.cursor, [2999, "c2999"])
+        run = SyncRun.objects.get()
+        self.assertEqual((run.status, run.errors, run.rows, run.pages), (SyncRun.FAILED, 1, 3000, 30))
+        self.assertEqual(run.last_cursor, [2999, "c2999"])
+
+        self.client_mock.post.side_effect = [contact_page(3000, 10, last=True)]
+        sync_location_contacts("loc1")
+
+        self.assertEqual(self.client_mock.post.call_args.kwargs["json"]["searchAfter"], [2999, "c2999"])
+        self.assertEqual(Contact.objects.count(), 3010)
+        state.refresh_from_db()
+        self.assertIsNone(state.cursor)
+        self.assertIsNotNone(state.last_full_sync_at)
+        run = SyncRun.objects.get()  # the retry continued the same run
+        self.assertEqual((run.status, run.rows, run.pages), (SyncRun.SUCCEEDED, 3010, 31))
+
+    def test_status_endpoint_is_cached_between_flushes(self):
+        cache.clear()
+        self.client_mock.post.side_effect = [contact_page(0, 10, last=True)]
+        sync_location_contacts("loc1")
+
+        url = reverse("sync_status", args=["loc1"])
+        self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+
+        contacts = response.json()["runs"][SyncState.CONTACTS]
+        self.assertEqual((contacts["status"], contacts["rows"], contacts["stuck"]), (SyncRun.SUCCEEDED, 10, False))
+        self.assertIsNone(response.json()["runs"][SyncState.OPPORTUNITIES])
+
+    def test_overlapping_sync_attaches_to_the_running_one(self):
+        running = SyncLease("loc1", SyncState.CONTACTS)
+        self.assertTrue(running.acquire())
+        running.attach(42)
+
+        self.assertIsNone(sync_location_contacts("loc1"))
+        self.client_mock.post.assert_not_called()
+        self.assertFalse(SyncRun.objects.exists())
+
+        running.release()
+        self.client_mock.post.side_effect = [contact_page(0, 10, last=True)]
+        sync_location_contacts("loc1")
+        self.assertEqual(Contact.objects.count(), 10)
+        self.assertIsNone(cache.get(lease_key("loc1", SyncState.CONTACTS)))  # released on completion
+
+    def test_fetch_endpoint_does_not_queue_duplicates(self):
+        url = reverse("fetch_contacts", args=["loc1"])
+        with mock.patch.object(fetch_contacts_task, "apply_async") as contacts_async, \
+                mock.patch.object(fetch_opportunities_task, "apply_async") as opportunities_async:
+            first = self.client.get(url).json()["syncs"]
+            second = self.client.get(url).json()["syncs"]
+
+        self.assertEqual((contacts_async.call_count, opportunities_async.call_count), (1, 1))
+        self.assertFalse(first[SyncState.CONTACTS]["attached"])
+        self.assertTrue(second[SyncState.CONTACTS]["attached"])
+        task_id = first[SyncState.CONTACTS]["task_id"]
+        self.assertEqual(second[SyncState.CONTACTS]["task_id"], task_id)
+        self.assertEqual(contacts_async.call_args.kwargs["task_id"], task_id)
+
+        # The queued task adopts the claim; anyone else still sees it held.
+        self.assertFalse(SyncLease("loc1", SyncState.CONTACTS, task_id="other").acquire())
+        self.assertTrue(SyncLease("loc1", SyncState.CONTACTS, task_id=task_id).acquire())
+
+    @override_settings(GHL_SYNC_WRITE_MODE="funnel", GHL_WRITER_BROKER_URL="memory://", GHL_WRITER_QUEUE="test.writes")
+    def test_funnel_mode_leaves_writes_to_the_batch_writer(self):
+        reset_batch_queue()
+        self.addCleanup(reset_batch_queue)
+        self.client_mock.post.side_effect = [contact_page(i * 100, 100) for i in range(30)] + [
+            contact_page(3000, 10, last=True)
+        ]
+        sync_location_contacts("loc1")
+
+        # The fetch worker wrote nothing and left the lease to the writer.
+        self.assertEqual(Contact.objects.count(), 0)
+        self.assertFalse(SyncState.objects.exists() or SyncRun.objects.exists())
+        self.assertIsNotNone(cache.get(lease_key("loc1", SyncState.CONTACTS)))
+        self.assertIsNone(sync_location_contacts("loc1"))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("run_batch_writer", "--once", stdout=StringIO())
+
+        self.assertEqual(Contact.objects.count(), 3010)
+        contact = Contact.objects.get(contact_id="c7")
+        self.assertEqual((contact.first_name, contact.custom_fields), ("First7", {"Twitter": "@c7"}))
+        state = SyncState.for_location("loc1", SyncState.CONTACTS)
+        self.assertIsNotNone(state.last_full_sync_at)
+        self.assertIsNone(state.cursor)
+        run = SyncRun.objects.get()
+        self.assertEqual((run.status, run.rows, run.pages), (SyncRun.SUCCEEDED, 3010, 31))
+        self.assertIsNone(cache.get(lease_key("loc1", SyncState.CONTACTS)))
+
+    @override_settings(GHL_SYNC_WRITE_MODE="funnel", GHL_WRITER_BROKER_URL="memory://", GHL_WRITER_QUEUE="test.replay")
+    def test_funnel_messages_replayed_after_a_crash_count_once(self):
+        reset_batch_queue()
+        self.addCleanup(reset_batch_queue)
+        self.client_mock.post.side_effect = [contact_page(i * 100, 100) for i in range(30)] + [
+            contact_page(3000, 10, last=True)
+        ]
+        sync_location_contacts("loc1")
+        payloads = []
+        while True:
+            try:
+                payloads.append(get_batch_queue().get(timeout=0.1).payload)
+            except BatchQueue.Empty:
+                break
+
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_write_messages(payloads)
+        # The writer died after committing, before acknowledging: everything is applied again.
+        apply_write_messages(payloads)
+
+        self.assertEqual([payload["kind"] for payload in payloads], ["begin", "batch", "batch", "finish"])
+        self.assertEqual(Contact.objects.count(), 3010)
+        run = SyncRun.objects.get()
+        self.assertEqual((run.status, run.rows, run.pages), (SyncRun.SUCCEEDED, 3010, 31))
+
+    @override_settings(GHL_SYNC_WRITE_MODE="funnel", GHL_WRITER_BROKER_URL="memory://", GHL_WRITER_QUEUE="test.failed")
+    def test_funnel_run_stops_at_its_first_failed_batch(self):
+        reset_batch_queue()
+        self.addCleanup(reset_batch_queue)
+        self.client_mock.post.side_effect = [contact_page(i * 100, 100) for i in range(60)] + [
+            contact_page(6000, 10, last=True)
+        ]
+        sync_location_contacts("loc1")
+        payloads = []
+        while True:
+            try:
+                payloads.append(get_batch_queue().get(timeout=0.1).payload)
+            except BatchQueue.Empty:
+                break
+        self.assertEqual([payload["kind"] for payload in payloads], ["begin", "batch", "batch", "batch", "finish"])
+        updated_at = bulk.contact_spec().data_columns.index("updated_at")
+        payloads[2]["rows"][0][updated_at] = "not a date"
+
+        with self.captureOnCommitCallbacks(execute=True):
+            rows, failed = apply_write_messages(payloads)
+
+        # The batches after the bad one and the finish are dropped with it.
+        self.assertEqual((rows, failed), (3000, 3))
+        self.assertEqual(Contact.objects.count(), 3000)
+        state = SyncState.for_location("loc1", SyncState.CONTACTS)
+        self.assertEqual(state.cursor, payloads[1]["cursor"])
+        self.assertIsNone(state.last_full_sync_at)
+        run = SyncRun.objects.get()
+        self.assertEqual((run.status, run.rows), (SyncRun.FAILED, 3000))
+        self.assertIsNone(cache.get(lease_key("loc1", SyncState.CONTACTS)))
+
+    def test_pipelined_mode_stores_every_page(self):
+        self.client_mock.post.side_effect = [contact_page(i * 100, 100) for i in range(40)] + [
+            contact_page(4000, 5, last=True)
+        ]
+        stats = sync_location_contacts("loc1", pipelined=True)
+
+        self.assertEqual(Contact.objects.count(), 4005)
+        self.assertEqual(stats["fetch"]["rows"], 4005)
+        self.assertEqual(stats["write"]["rows"], 4005)
+
+
+@override_settings(
+    GHL_SCHEDULE_TARGET_ROWS=500, GHL_SCHEDULE_MIN_MINUTES=5, GHL_SCHEDULE_MAX_MINUTES=360,
+    GHL_SCHEDULE_DEFAULT_MINUTES=60,
+)
+class SchedulingTests(TestCase):
+    def delta_runs(self, location_id, entity, rows, every):
+        started = now() - every * len(rows)
+        for i, count in enumerate(rows):
+            SyncRun.objects.create(
+                location_id=location_id, entity=entity, full_sync=False, status=SyncRun.SUCCEEDED,
+                started_at=started + every * i, rows=count,
+            )
+
+    def test_interval_follows_change_rate(self):
+        self.assertEqual(interval_minutes(None), 60)
+        self.assertEqual(interval_minutes(0), 360)
+        self.assertEqual(interval_minutes(3000), 10)
+        self.assertEqual(interval_minutes(10 ** 6), 5)
+
+    def test_plans_periodic_tasks_per_location(self):
+        from django_celery_beat.models import PeriodicTask
+
+        # Busy: 1000 changes per hour. Quiet: nothing changed.
+        self.delta_runs("busy", SyncState.CONTACTS, [0, 1000, 1000, 1000], timedelta(hours=1))
+        self.delta_runs("quiet", SyncState.CONTACTS, [0, 0, 0], timedelta(hours=1))
+
+        plans = plan_schedules(["busy", "quiet", "new"])
+
+        self.assertEqual(plans["busy"][SyncState.CONTACTS], 30)
+        self.assertEqual(plans["quiet"][SyncState.CONTACTS], 360)
+        self.assertEqual(plans["new"][SyncState.OPPORTUNITIES], 60)
+
+        task = PeriodicTask.objects.get(name=periodic_task_name("busy", SyncState.CONTACTS))
+        self.assertEqual((task.task, json.loads(task.args)), ("ghl_auth.tasks.fetch_location_contacts_task", ["busy"]))
+        self.assertEqual(task.interval.every, 30)
+        self.assertTrue(now() <= task.start_time < now() + timedelta(minutes=30))
+        starts = set(PeriodicTask.objects.filter(name__startswith="ghl-sync:").values_list("start_time", flat=True))
+        self.assertEqual(len(starts), 6)
+
+        plan_schedules(["busy"])  # unchanged intervals keep their start; disconnected locations are dropped
+        self.assertEqual(PeriodicTask.objects.get(pk=task.pk).start_time, task.start_time)
+        self.assertEqual(PeriodicTask.objects.filter(name__startswith="ghl-sync:").count(), 2)
+
+
+class FakeAPISyncTests(TestCase):
+    """End-to-end syncs against the local fake API, with injected 429s and 520s."""
+
+    def setUp(self):
+        cache.clear()
+        self.server = FakeGHLServer(contacts=250, opportunities_per_contact=2, error_every=7, retry_after_ms=10).start()
+        self.addCleanup(self.server.stop)
+        overrides = override_settings(
+            GHL_API_BASE_URL=self.server.url, GHL_HTTP_BACKOFF=0.01,
+            GHL_RATE_LIMIT_LOCATION_REQUESTS=0, GHL_RATE_LIMIT_APP_REQUESTS=0,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        reset_client()
+        self.addCleanup(reset_client)
+        for manager in (get_token_manager(), get_field_cache()):
+            manager.invalidate("loc1")
+            self.addCleanup(manager.invalidate, "loc1")
+
+        GHLOAuth.objects.create(
+            location_id="loc1", access_token="expired", refresh_token="refresh",
+            expires_at=now() - timedelta(minutes=1),
+        )
+
+    def test_contact_and_opportunity_tasks(self):
+        fetch_contacts_task(location_id="loc1")
+        fetch_opportunities_task(location_id="loc1")
+
+        self.assertEqual(Contact.objects.filter(location_id="loc1").count(), 250)
+        self.assertEqual(Opportunity.objects.filter(location_id="loc1").count(), 500)
+        contact = Contact.objects.get(contact_id="loc1-c0")
+        self.assertEqual(contact.custom_fields, {"Twitter": "@c0"})
+        self.assertEqual(contact.opportunity, 300.0)
+
+        stats = self.server.stats()
+        self.assertEqual(stats["oauth"], 1)  # refreshed once, then served from the token cache
+        self.assertEqual(stats["custom_fields"], 1)
+        self.assertGreater(stats["injected"], 0)
+        self.assertTrue(GHLOAuth.objects.get(location_id="loc1").access_token.startswith("fake-access-"))
+
+
+class CustomFieldCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.fetch = mock.patch.object(CustomFieldCache, "fetch", side_effect=lambda loc_id, token: {"f1": {"name": loc_id}})
+        self.fetch_mock = self.fetch.start()
+        self.addCleanup(self.fetch.stop)
+        cache.clear()
+
+    def test_local_tier_evicts_least_recently_used(self):
+        field_cache = CustomFieldCache(max_locations=2, ttl=60)
+        field_cache.get("loc1", "token")
+        field_cache.get("loc2", "token")
+        field_cache.get("loc1", "token")
+        field_cache.get("loc3", "token")
+
+        self.assertEqual(list(field_cache._local), ["loc1", "loc3"])
+        self.assertEqual(self.fetch_mock.call_count, 3)
+
+    def test_shared_tier_is_filled_once_for_all_processes(self):
+        CustomFieldCache(ttl=60).get("loc1", "token")
+        other_process = CustomFieldCache(ttl=60)
+
+        self.assertEqual(other_process.get("loc1", "token"), {"f1": {"name": "loc1"}})
+        self.assertEqual(self.fetch_mock.call_count, 1)
+
+    def test_resolve_keeps_unknown_ids(self):
+        values = resolve_custom_fields(
+            [{"id": "f1", "value": "@ann"}, {"id": "f2", "value": 3}], {"f1": {"name": "Twitter"}},
+        )
+        self.assertEqual(values, {"Twitter": "@ann", "f2": 3})
+
+
+WEBHOOK_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+WEBHOOK_PUBLIC_KEY = WEBHOOK_KEY.public_key().public_bytes(
+    serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo,
+).decode()
+
+
+@override_settings(GHL_WEBHOOK_PUBLIC_KEY=WEBHOOK_PUBLIC_KEY, GHL_WEBHOOK_SECRET="")
+class WebhookTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch("ghl_auth.tasks.flush_webhook_events.apply_async")
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post_event(self, payload, key=WEBHOOK_KEY):
+        body = json.dumps(payload).encode()
+        signature = base64.b64encode(key.sign(body, padding.PKCS1v15(), hashes.SHA256())).decode()
+        return self.client.post(
+            reverse("ghl_webhook"), body, content_type="application/json", HTTP_X_WH_SIGNATURE=signature,
+        )
+
+    def test_rejects_bad_signature(self):
+        other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        response = self.post_event({"type": "ContactCreate", "id": "c1", "locationId": "loc1"}, key=other_key)
+
+        self.assertEqual(response.status_code, 401)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_hmac_only_when_a_resigning_proxy_is_configured(self):
+        body = json.dumps({"type": "ContactCreate", "id": "c1", "locationId": "loc1"}).encode()
+        signature = hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+
+        def post():
+            return self.client.post(
+                reverse("ghl_webhook"), body, content_type="application/json", HTTP_X_GHL_SIGNATURE=signature,
+            )
+
+        self.assertEqual(post().status_code, 401)
+        with override_settings(GHL_WEBHOOK_SECRET="secret"):
+            self.assertEqual(post().status_code, 202)
+
+    def test_buffers_events_and_schedules_one_flush(self):
+        for contact_id in ("c1", "c2"):
+            response = self.post_event({"type": "ContactCreate", "id": contact_id, "locationId": "loc1"})
+            self.assertEqual(response.status_code, 202)
+
+        self.assertEqual(WebhookEvent.objects.count(), 2)
+        self.apply_async.assert_called_once()
+
+    def test_flush_coalesces_and_updates_totals(self):
+        events = [
+            {"type": "ContactCreate", "id": "c1", "locationId": "loc1", "firstName": "Ann"},
+            {"type": "ContactUpdate", "id": "c1", "locationId": "loc1", "firstName": "Anna"},
+            {"type": "OpportunityCreate", "id": "o1", "locationId": "loc1", "contactId": "c1", "monetaryValue": 100},
+            {"type": "OpportunityCreate", "id": "o2", "locationId": "loc1", "contactId": "c1", "monetaryValue": 50},
+            {"type": "OpportunityDelete", "id": "o2", "locationId": "loc1"},
+        ]
+        for event in events:
+            self.post_event(event)
+
+        result = flush_webhook_events()
+
+        self.assertEqual(result["events"], 5)
+        self.assertFalse(WebhookEvent.objects.exists())
+        contact = Contact.objects.get(contact_id="c1")
+        self.assertEqual(contact.first_name, "Anna")
+        self.assertEqual(contact.opportunity, 100)
+        self.assertEqual(list(Opportunity.objects.values_list("opportunity_id", flat=True)), ["o1"])
+
+
+    def test_redelivered_events_are_buffered_once(self):
+        event = {"type": "ContactUpdate", "id": "c1", "locationId": "loc1", "webhookId": "w1"}
+        self.assertEqual(self.post_event(event).status_code, 202)
+        response = self.post_event(event)
+
+        self.assertEqual((response.status_code, response.json()["status"]), (200, "duplicate"))
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+    def test_late_events_do_not_overwrite_newer_records(self):
+        Contact.objects.create(contact_id="c1", location_id="loc1", first_name="New")
+        Opportunity.objects.create(opportunity_id="o1", contact_id="c1", location_id="loc1", monetaryValue=100)
+        polled_at = now()
+        Contact.objects.update(updated_at=polled_at)
+        Opportunity.objects.update(updated_at=polled_at)
+        recompute_contact_totals({"c1"})
+        rebuild_rollups()
+        late = (polled_at - timedelta(minutes=5)).isoformat()
+        newer = (polled_at + timedelta(minutes=5)).isoformat()
+        self.post_event({"type": "ContactUpdate", "id": "c1", "locationId": "loc1", "firstName": "Old", "dateUpdated": late})
+        self.post_event({
+            "type": "OpportunityUpdate", "id": "o1", "locationId": "loc1", "contactId": "c1", "monetaryValue": 5,
+            "updatedAt": late,
+        })
+        self.post_event({"type": "ContactUpdate", "id": "c2", "locationId": "loc1", "firstName": "Two", "dateUpdated": newer})
+
+        flush_webhook_events()
+
+        self.assertEqual(Contact.objects.get(contact_id="c1").first_name, "New")
+        self.assertEqual(Contact.objects.get(contact_id="c1").opportunity, 100)
+        self.assertEqual(Opportunity.objects.get(opportunity_id="o1").monetaryValue, 100)
+        self.assertEqual(Contact.objects.get(contact_id="c2").first_name, "Two")
+
+class MetricsTests(SimpleTestCase):
+    def test_histogram_renders_cumulative_buckets(self):
+        registry = metrics.Registry()
+        latency = metrics.Histogram("latency_seconds", "Latency.", ("endpoint",), buckets=(0.1, 1), registry=registry)
+        for value in (0.05, 0.5, 5):
+            latency.observe(value, endpoint="/contacts/search")
+
+        text = metrics.render(registry.snapshot())
+
+        self.assertIn('latency_seconds_bucket{endpoint="/contacts/search",le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{endpoint="/contacts/search",le="1"} 2', text)
+        self.assertIn('latency_seconds_bucket{endpoint="/contacts/search",le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count{endpoint="/contacts/search"} 3', text)
+
+    def test_collect_merges_other_process_snapshots(self):
+        registry = metrics.Registry()
+        pages = metrics.Counter("pages_total", "Pages.", ("entity",), registry=registry)
+        pages.inc(2, entity="contacts")
+        with tempfile.TemporaryDirectory() as metrics_dir, override_settings(GHL_METRICS_DIR=metrics_dir):
+            exited = subprocess.Popen(["true"])
+            exited.wait()
+            for pid in (os.getppid(), exited.pid):
+                with open(os.path.join(metrics_dir, f"metrics-{pid}.json"), "w") as other_process:
+                    json.dump(registry.snapshot(), other_process)
+            pages.inc(entity="contacts")
+
+            merged = metrics.collect(registry)
+            self.assertFalse(os.path.exists(os.path.join(metrics_dir, f"metrics-{exited.pid}.json")))
+
+        self.assertEqual(merged["pages_total"]["values"], [[["contacts"], 5]])
+
+    def test_metrics_endpoint(self):
+        response = self.client.get(reverse("metrics"))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"# TYPE ghl_sync_flush_seconds histogram", response.content)
+        self.assertEqual(self.client.get(reverse("metrics"), REMOTE_ADDR="8.8.8.8").status_code, 403)
+        with override_settings(GHL_METRICS_TOKEN="scrape"):
+            self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+            response = self.client.get(reverse("metrics"), REMOTE_ADDR="8.8.8.8", HTTP_AUTHORIZATION="Bearer scrape")
+            self.assertEqual(response.status_code, 200)
+
+    def test_client_endpoint_label_drops_location_id(self):
+        client = GHLClient(base_url="http://ghl.test", rate_limiter=mock.Mock())
+        self.assertEqual(
+            client.endpoint_label("/locations/loc1/customFields?x=1", "loc1"), "/locations/{locationId}/customFields",
+        )
+
+
+class PipelineTests(SimpleTestCase):
+    def test_fetch_error_is_raised_in_caller(self):
+        def pages():
+            yield [1, 2], "cursor"
+            raise ConnectionError("boom")
+
+        with self.assertRaises(ConnectionError):
+            run_pipelined(pages(), lambda records: (records, None), lambda *args: None)
+
+    def test_write_error_stops_producers(self):
+        def pages():
+            while True:
+                yield [1], "cursor"
+
+        def write(*args):
+            raise ValueError("db down")
+
+        with self.assertRaises(ValueError):
+            run_pipelined(pages(), lambda records: (records, None), write, queue_size=1)
+
+
+class AsyncEngineTests(TransactionTestCase):
+    def setUp(self):
+        for loc_id in ("loc1", "loc2", "loc3"):
+            GHLOAuth.objects.create(
+                location_id=loc_id, access_token="token", refresh_token="refresh",
+                expires_at=now() + timedelta(hours=1),
+            )
+
+        def search(path, json, **kwargs):
+            offset = int(json["locationId"][-1]) * 1000
+            if json.get("searchAfter"):
+                return contact_page(offset + 100, 20, last=True)
+            return contact_page(offset, 100)
+
+        self.client_mock = mock.Mock()
+        self.client_mock.post.side_effect = search
+        patch_client(self, self.client_mock)
+
+    def test_syncs_every_location_concurrently(self):
+        results = sync_locations_async(["loc1", "loc2", "loc3"], SyncState.CONTACTS, concurrency=2)
+
+        self.assertEqual(set(results), {"loc1", "loc2", "loc3"})
+        self.assertEqual(results["loc2"]["write"]["rows"], 120)
+        for loc_id in ("loc1", "loc2", "loc3"):
+            self.assertEqual(Contact.objects.filter(location_id=loc_id).count(), 120)
+            self.assertIsNotNone(SyncState.for_location(loc_id, SyncState.CONTACTS).last_full_sync_at)
+
+
+class BulkUpsertTests(TestCase):
+    def opportunity(self, opportunity_id, contact_id, value):
+        stamp = now()
+        return (opportunity_id, contact_id, "Deal", None, "loc1", value, stamp, stamp, "p1", "s1", "open")
+
+    def test_contacts_insert_then_update(self):
+        stamp = now()
+        upsert_contacts([("c1", "Ann", "Lee", "ann@example.com", None, "loc1", stamp, stamp, {})])
+        upsert_contacts([("c1", "Anna", "Lee", "anna@example.com", None, "loc1", stamp, stamp, {})])
+
+        contact = Contact.objects.get(contact_id="c1")
+        self.assertEqual(contact.first_name, "Anna")
+        self.assertEqual(contact.email, "anna@example.com")
+
+    def test_unchanged_rows_are_skipped_and_never_rewritten(self):
+        stamp = now()
+        rows = [(f"c{i}", "Ann", "Lee", None, None, "loc1", stamp, stamp, {}) for i in range(3)]
+        store_contacts(rows)
+
+        self.assertEqual(bulk.changed_rows(bulk.contact_spec(), rows), [])
+        changes = connection.connection.total_changes
+        upsert_contacts(rows)  # the WHERE guard leaves matching rows alone
+        self.assertEqual(connection.connection.total_changes, changes)
+
+        rows[1] = rows[1][:1] + ("Bob",) + rows[1][2:]
+        self.assertEqual([row[0] for row in bulk.changed_rows(bulk.contact_spec(), rows)], ["c1"])
+        upsert_contacts(rows)
+        self.assertEqual(connection.connection.total_changes, changes + 1)
+        self.assertEqual(Contact.objects.get(contact_id="c1").first_name, "Bob")
+
+    def test_hash_index_is_loaded_once_per_location(self):
+        stamp = now()
+        rows = [(f"c{i}", "Ann", "Lee", None, None, "loc1", stamp, stamp, {}) for i in range(3)]
+        upsert_contacts(rows)
+        index = bulk.HashIndex(bulk.contact_spec(), "loc1")
+
+        with self.assertNumQueries(1):
+            self.assertEqual(bulk.changed_rows(bulk.contact_spec(), rows, index), [])
+            self.assertEqual(len(bulk.changed_rows(bulk.contact_spec(), [rows[0][:1] + ("Eve",) + rows[0][2:]], index)), 1)
+
+    def test_native_and_generic_strategies_agree(self):
+        rows = [self.opportunity(f"o{i}", "c1", float(i)) for i in range(1200)]
+        rows.append(self.opportunity("o5", "c2", 99.0))  # same key twice in one batch: last one wins
+        for strategy in (None, bulk.upsert_generic):
+            Opportunity.objects.all().delete()
+            bulk.bulk_upsert(bulk.opportunity_spec(), rows, strategy=strategy)
+
+            self.assertEqual(Opportunity.objects.count(), 1200)
+            self.assertEqual(Opportunity.objects.get(opportunity_id="o5").monetaryValue, 99.0)
+
+
+class ReadAPITests(TestCase):
+    def setUp(self):
+        cache.clear()
+        stamp = (now() - timedelta(days=1)).astimezone(ZoneInfo("Asia/Kolkata"))
+        # Pairs of contacts share an update time, so pages must break ties on id;
+        # the sync hands over local or UTC datetimes depending on GHL_STORE_UTC.
+        zones = [ZoneInfo("Asia/Kolkata"), ZoneInfo("UTC")]
+        upsert_contacts([
+            (f"c{i}", f"F{i}", "L", None, None, "loc1", stamp, (stamp + timedelta(minutes=i // 2)).astimezone(zones[i % 2]), {})
+            for i in range(7)
+        ])
+        upsert_opportunities([
+            ("o1", "c1", "Deal", None, "loc1", 100.0, stamp, stamp, "p1", "s1", "open"),
+            ("o2", "c1", "Deal", None, "loc1", 50.0, stamp, stamp, "p1", "s2", "won"),
+            ("o3", "c2", "Deal", None, "loc2", 10.0, stamp, stamp, "p1", "s1", "open"),
+        ])
+        rebuild_rollups()
+
+    def test_contacts_are_paged_by_keyset(self):
+        url = reverse("location_contacts", args=["loc1"])
+        seen, cursor = [], None
+        while True:
+            payload = self.client.get(url, {"limit": 3, **({"cursor": cursor} if cursor else {})}).json()
+            seen += [contact["contact_id"] for contact in payload["contacts"]]
+            cursor = payload["next_cursor"]
+            if not cursor:
+                break
+        self.assertEqual(seen, [f"c{i}" for i in range(7)])
+        self.assertEqual(self.client.get(url, {"cursor": "garbage"}).status_code, 400)
+        naive = base64.urlsafe_b64encode(json.dumps(["2024-03-01T10:00:00", 1]).encode()).decode()
+        self.assertEqual(self.client.get(url, {"cursor": naive}).status_code, 400)
+
+    def test_timestamps_are_stored_in_utc_and_shown_local(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT DISTINCT substr(updated_at, 20) FROM "Contact"')
+            self.assertNotIn("+", "".join(row[0] for row in cursor.fetchall()))
+        contacts = self.client.get(reverse("location_contacts", args=["loc1"])).json()["contacts"]
+        self.assertTrue(all(contact["updated_at"].endswith("+05:30") for contact in contacts))
+
+    def test_opportunities_and_revenue(self):
+        response = self.client.get(reverse("contact_opportunities", args=["loc1", "c1"]))
+        self.assertEqual([o["opportunity_id"] for o in response.json()["opportunities"]], ["o1", "o2"])
+
+        with self.assertNumQueries(2):
+            revenue = self.client.get(reverse("location_revenue", args=["loc1"])).json()
+        self.assertEqual((revenue["contacts"], revenue["opportunities"], revenue["revenue"]), (7, 2, 150.0))
+        self.assertEqual(
+            [(stage["stage_id"], stage["status"], stage["opportunities"]) for stage in revenue["pipelines"]["p1"]],
+            [("s1", "open", 1), ("s2", "won", 1)],
+        )
+
+    def test_conditional_and_cached_until_a_flush(self):
+        url = reverse("location_contacts", args=["loc1"])
+        first = self.client.get(url)
+        etag = first["ETag"]
+        self.assertIn("Last-Modified", first)
+
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(self.client.get(url).content, first.content)
+
+        stamp = now()
+        with self.captureOnCommitCallbacks(execute=True):
+            writer = BatchWriter(SyncState.for_location("loc1", SyncState.CONTACTS), store_contacts, False)
+            writer.write([("c9", "New", "L", None, None, "loc1", stamp, stamp, {})], stamp, None)
+            writer.flush()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(response.json()["contacts"][-1]["contact_id"], "c9")
+
+
+class AdminTests(TestCase):
+    def setUp(self):
+        from django.contrib.auth.models import User
+
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "pw"))
+        stamp = now()
+        GHLOAuth.objects.create(location_id="loc1", access_token="t", refresh_token="r", expires_at=stamp)
+        upsert_contacts([
+            (f"c{i}", "Ann", "Lee", f"ann{i}@example.com", f"+1555000{i}", "loc1", stamp, stamp, {}) for i in range(6)
+        ])
+        upsert_opportunities([(f"o{i}", f"c{i % 3}", "Deal", None, "loc1", 10.0, stamp, stamp, "", "", "") for i in range(9)])
+
+    def test_contact_changelist_batches_opportunity_lookups(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("admin:ghl_auth_contact_changelist"), {"location_id": "loc1"})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.context["cl"].result_list), 6)
+        self.assertEqual(len([q for q in queries.captured_queries if 'FROM "Opportunity"' in q["sql"]]), 1)
+        self.assertEqual(response.context["cl"].result_list[0].contact_id, "c5")  # newest first
+
+    def test_prefix_search_and_capped_count(self):
+        url = reverse("admin:ghl_auth_contact_changelist")
+        self.assertEqual(self.client.get(url, {"q": "ANN3@"}).context["cl"].result_count, 1)
+        self.assertEqual(self.client.get(url, {"q": "+1555 0004"}).context["cl"].result_count, 1)
+
+        with override_settings(GHL_ADMIN_COUNT_CAP=4):
+            self.assertEqual(self.client.get(url, {"location_id": "loc1"}).context["cl"].result_count, 4)
+
+    def test_contact_page_lists_its_opportunities(self):
+        contact = Contact.objects.get(contact_id="c1")
+        response = self.client.get(reverse("admin:ghl_auth_contact_change", args=[contact.pk]))
+        self.assertContains(response, "o4")
+        self.assertNotContains(response, "o2<")
+
+
+class ContactTotalsTests(TestCase):
+    def setUp(self):
+        stamp = now()
+        upsert_contacts([
+            (contact_id, None, None, None, None, "loc1", stamp, stamp, {}) for contact_id in ("c1", "c2", "c3")
+        ])
+
+    def opportunity(self, opportunity_id, contact_id, value, stage="s1", status="open"):
+        stamp = now()
+        return (opportunity_id, contact_id, "Deal", None, "loc1", value, stamp, stamp, "p1", stage, status)
+
+    def totals(self):
+        return dict(Contact.objects.values_list("contact_id", "opportunity"))
+
+    def rollups(self):
+        return {
+            (stage, status): (count, value)
+            for stage, status, count, value in OpportunityRollup.objects.filter(opportunities__gt=0).values_list(
+                "pipeline_stage_id", "status", "opportunities", "monetary_value",
+            )
+        }
+
+    def test_batch_updates_only_touched_contacts(self):
+        Contact.objects.filter(contact_id="c3").update(opportunity=42)
+        store_opportunities([self.opportunity("o1", "c1", 10), self.opportunity("o2", "c1", 5)])
+
+        self.assertEqual(self.totals(), {"c1": 15, "c2": None, "c3": 42})
+
+    def test_opportunity_moving_between_contacts(self):
+        store_opportunities([self.opportunity("o1", "c1", 10), self.opportunity("o2", "c1", 5)])
+        store_opportunities([self.opportunity("o2", "c2", 7)])
+
+        self.assertEqual(self.totals(), {"c1": 10, "c2": 7, "c3": None})
+
+        store_opportunities([self.opportunity("o1", "c2", 10)])
+        self.assertEqual(self.totals()["c1"], 0)
+
+    def test_duplicate_ids_in_one_batch_count_once(self):
+        store_opportunities([self.opportunity("o1", "c1", 100, stage="s"), self.opportunity("o1", "c2", 100, stage="s2")])
+
+        self.assertEqual(Opportunity.objects.count(), 1)
+        self.assertEqual(self.rollups(), {("s2", "open"): (1, 100.0)})
+        self.assertEqual(self.totals(), {"c1": None, "c2": 100, "c3": None})
+
+    def test_contact_synced_after_its_opportunities_gets_total(self):
+        store_opportunities([self.opportunity("o1", "c9", 12)])
+        store_contacts([("c9", None, None, None, None, "loc1", now(), now(), {})])
+
+        self.assertEqual(self.totals()["c9"], 12)
+
+    def test_pipeline_rollups_follow_stage_moves_and_deletes(self):
+        store_opportunities([self.opportunity("o1", "c1", 10), self.opportunity("o2", "c1", 5)])
+        self.assertEqual(self.rollups(), {("s1", "open"): (2, 15)})
+
+        store_opportunities([self.opportunity("o2", "c1", 7, stage="s2", status="won")])
+        self.assertEqual(self.rollups(), {("s1", "open"): (1, 10), ("s2", "won"): (1, 7)})
+
+        delete_opportunities(["o1"])
+        self.assertEqual(self.rollups(), {("s2", "won"): (1, 7)})
+
+        deltas = self.rollups()
+        rebuild_rollups()
+        self.assertEqual(self.rollups(), deltas)
+
+    def test_full_rebuild_repairs_stale_totals(self):
+        store_opportunities([self.opportunity("o1", "c1", 10)])
+        Contact.objects.filter(contact_id__in=["c1", "c2"]).update(opportunity=99)
+
+        update_contact_opportunity_totals()
+
+        self.assertEqual(self.totals(), {"c1": 10, "c2": 0, "c3": None})
+
+
+class QueryPlanTests(TestCase):
+    """
+    Guards the index layout: SQLite's planner is fed statistics for a 1M
+    contact / 1M opportunity dataset (10k locations), then the hot queries
+    must be index seeks rather than table scans.
+    """
+
+    ROWS = 1_000_000
+
+    def setUp(self):
+        stamp = now()
+        upsert_contacts([(f"c{i}", None, None, None, None, f"loc{i % 3}", stamp, stamp, {}) for i in range(30)])
+        upsert_opportunities([(f"o{i}", f"c{i % 30}", None, None, f"loc{i % 3}", 1.0, stamp, stamp, "", "", "") for i in range(60)])
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+            cursor.execute("DELETE FROM sqlite_stat1")
+            stats = [
+                ("Contact", None, f"{self.ROWS}"),
+                ("Contact", "sqlite_autoindex_Contact_1", f"{self.ROWS} 1"),
+                ("Contact", "contact_loc_upd_id_idx", f"{self.ROWS} 100 1 1"),
+                ("Contact", "contact_email_idx", f"{self.ROWS} 1"),
+                ("Contact", "contact_phone_idx", f"{self.ROWS} 1"),
+                ("Opportunity", None, f"{self.ROWS}"),
+                ("Opportunity", "sqlite_autoindex_Opportunity_1", f"{self.ROWS} 1"),
+                ("Opportunity", "opp_contact_idx", f"{self.ROWS} 2"),
+                ("Opportunity", "opp_loc_contact_idx", f"{self.ROWS} 100 2"),
+                ("Opportunity", "opp_loc_updated_idx", f"{self.ROWS} 100 1"),
+            ]
+            for table, index, stat in stats:
+                cursor.execute("INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (%s, %s, %s)", [table, index, stat])
+            cursor.execute("ANALYZE sqlite_schema")  # reload the statistics
+
+    def plan(self, sql, params=()):
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertSeeks(self, plan, index):
+        self.assertFalse([step for step in plan if step.startswith("SCAN")], plan)
+        self.assertTrue([step for step in plan if index in step], plan)
+
+    def test_incremental_totals_update_uses_indexes(self):
+        with CaptureQueriesContext(connection) as queries:
+            recompute_contact_totals(["c1", "c2"])
+        plan = self.plan(queries.captured_queries[-1]["sql"])
+
+        self.assertSeeks(plan, "opp_contact_idx")
+        self.assertTrue([step for step in plan if "SEARCH Contact" in step], plan)
+
+    def test_per_location_contact_listing_uses_index(self):
+        query = Contact.objects.filter(location_id="loc1").order_by("updated_at")[:100]
+        plan = self.plan(*query.query.sql_with_params())
+
+        self.assertSeeks(plan, "contact_loc_upd_id_idx")
+        self.assertFalse([step for step in plan if "TEMP B-TREE" in step], plan)
+
+    def test_read_api_keyset_page_uses_index(self):
+        with CaptureQueriesContext(connection) as queries:
+            keyset_page(Contact.objects.filter(location_id="loc1"), CONTACT_FIELDS, (now(), 10), 100)
+        plan = self.plan(queries.captured_queries[-1]["sql"])
+
+        self.assertTrue([step for step in plan if "contact_loc_upd_id_idx" in step], plan)
+        self.assertFalse([step for step in plan if step.startswith("SCAN") or "TEMP B-TREE" in step], plan)
+
+    def test_admin_prefix_search_uses_indexes(self):
+        query = Contact.objects.filter(prefix_match("email", "ann") | prefix_match("phone", "+1555"))
+        plan = self.plan(*query.query.sql_with_params())
+
+        self.assertSeeks(plan, "contact_email_idx")
+        self.assertSeeks(plan, "contact_phone_idx")
+
+    def test_per_location_opportunity_lookup_uses_index(self):
+        query = Opportunity.objects.filter(location_id="loc1", contact_id="c1")
+        self.assertSeeks(self.plan(*query.query.sql_with_params()), "opp_loc_contact_idx")
+
+        query = Opportunity.objects.filter(location_id="loc1").order_by("updated_at")[:100]
+        self.assertSeeks(self.plan(*query.query.sql_with_params()), "opp_loc_updated_idx")
+
+
+class TimestampConversionTests(SimpleTestCase):
+    def test_batch_conversion_matches_single_value_conversion(self):
+        values = ["2024-03-01T10:00:00.123Z", "2024-03-01T10:00:00Z", None, "not a date"]
+        converted = convert_timestamps(values, "Asia/Kolkata")
+
+        self.assertEqual(converted[0], convert_to_timezone(values[0], "Asia/Kolkata"))
+        self.assertEqual(converted[1].isoformat(), "2024-03-01T15:30:00+05:30")
+        self.assertEqual(converted[2:], [None, None])
+
+    @override_settings(GHL_STORE_UTC=True)
+    def test_store_utc_mode_skips_timezone_conversion(self):
+        converted = convert_timestamps(["2024-03-01T10:00:00.500Z"])[0]
+
+        self.assertEqual(converted.utcoffset(), timedelta(0))
+        self.assertEqual(to_local(converted, "Asia/Kolkata").hour, 15)
@@ -0,0 +1,135 @@
+import logging
+import threading
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.timezone import now
+
+from .metrics import TOKEN_REFRESHES
+from .models import GHLOAuth
+
+
+logger = logging.getLogger(__name__)
+
+
+def refresh_seconds():
+    """Longest one refresh can take: a rate-limit window of waiting, then connect and read timeouts."""
+    return settings.GHL_RATE_LIMIT_WINDOW_SECONDS + 2 * settings.GHL_HTTP_TIMEOUT
+
+
+class TokenManager:
+    """
+    Access tokens per location, refreshed ahead of expiry by exactly one
+    worker at a time.
+
+    Valid tokens are served from a per-process cache without touching the
+    database. When a token is within the refresh margin of expiring, the
+    worker that wins a ``cache.add`` lock refreshes it; everyone else keeps
+    using the still-valid token, or, if it has already expired, polls the
+    database until the winner has stored the new one. GHL rotates refresh
+    tokens on every use, so two concurrent refreshes would invalidate each
+    other.
+    """
+
+    def __init__(self, refresh_margin=None, lock_timeout=None, wait_timeout=None, shared_cache=None):
+        self.refresh_margin = timedelta(seconds=refresh_margin or settings.GHL_TOKEN_REFRESH_MARGIN_SECONDS)
+        # The lock must outlive the refresh, or a second worker would spend the
+        # same refresh token while the first is still waiting for GHL.
+        self.lock_timeout = max(lock_timeout or settings.GHL_TOKEN_LOCK_TIMEOUT_SECONDS, refresh_seconds() + 10)
+        self.wait_timeout = wait_timeout or settings.GHL_TOKEN_WAIT_SECONDS
+        self.poll_interval = 0.2
+        self.shared_cache = shared_cache or cache
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def _lock_key(self, location_id):
+        return f"ghl:token_refresh:{location_id}"
+
+    def _fresh(self, expires_at):
+        return expires_at - self.refresh_margin > now()
+
+    def _remember(self, token_obj):
+        with self._lock:
+            self._tokens[token_obj.location_id] = (token_obj.access_token, token_obj.expires_at)
+        return token_obj.access_token
+
+    def invalidate(self, location_id):
+        """Drop the cached token, e.g. after a re-authorization or a 401."""
+        with self._lock:
+            self._tokens.pop(location_id, None)
+
+    def get_token(self, location_id):
+        """Return a valid access token for the location, or None if it cannot be obtained."""
+        with self._lock:
+            cached = self._tokens.get(location_id)
+        if cached and self._fresh(cached[1]):
+            return cached[0]
+
+        token_obj = GHLOAuth.objects.filter(location_id=location_id).first()
+        if not token_obj:
+            logger.error(f"No stored token for location {location_id}")
+            return None
+        if self._fresh(token_obj.expires_at):
+            return self._remember(token_obj)
+        return self._refresh(token_obj)
+
+    def _refresh(self, token_obj):
+        location_id = token_obj.location_id
+        lock_key = self._lock_key(location_id)
+        lock_token = uuid.uuid4().hex
+        if not self.shared_cache.add(lock_key, lock_token, timeout=self.lock_timeout):
+            if not token_obj.is_expired():
+                return token_obj.access_token  # still usable while another worker refreshes it
+            return self._wait_for_refresh(location_id, token_obj.access_token)
+
+        try:
+            # Another worker may have refreshed between our read and taking the lock.
+            token_obj.refresh_from_db()
+            if self._fresh(token_obj.expires_at):
+                return self._remember(token_obj)
+
+            logger.info(f"Refreshing access token for {location_id}")
+            access_token = token_obj.refresh_access_token()
+            TOKEN_REFRESHES.inc(result="success" if access_token else "failure")
+            if not access_token:
+                logger.error(f"Token refresh failed for {location_id}")
+                self.invalidate(location_id)
+                return None if token_obj.is_expired() else token_obj.access_token
+            return self._remember(token_obj)
+        finally:
+            # Only our own lock: after an expiry it may belong to another worker.
+            if self.shared_cache.get(lock_key) == lock_token:
+                self.shared_cache.delete(lock_key)
+
+    def _wait_for_refresh(self, location_id, stale_token):
+        lock_key = self._lock_key(location_id)
+        deadline = time.monotonic() + self.wait_timeout
+        while time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+            token_obj = GHLOAuth.objects.filter(location_id=location_id).first()
+            if token_obj is None:
+                return None
+            if token_obj.access_token != stale_token and not token_obj.is_expired():
+                return self._remember(token_obj)
+            if self.shared_cache.get(lock_key) is None:
+                break  # the refresh finished without a new token
+
+        logger.error(f"Timed out waiting for the token refresh of {location_id}")
+        return None
+
+
+_manager = None
+
+
+def get_token_manager():
+    global _manager
+    if _manager is None:
+        _manager = TokenManager()
+    return _manager
+
+
+def get_access_token(location_id):
+    return get_token_manager().get_token(location_id)
@@ -7,6 +7,15 @@ urlpatterns = [
     path('oauth/callback/', views.ghl_callback, name='ghl-callback'),
     path('exchange-token/', views.exchange_code_for_token, name='exchange_code_for_token'),
     path('fetch-contacts/<str:location_id>/', views.fetch_contacts, name='fetch_contacts'),
+    path('sync-status/<str:location_id>/', views.sync_status, name='sync_status'),
+    path('webhooks/ghl/', views.ghl_webhook, name='ghl_webhook'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('api/locations/<str:location_id>/contacts/', views.location_contacts, name='location_contacts'),
+    path(
+        'api/locations/<str:location_id>/contacts/<str:contact_id>/opportunities/',
+        views.contact_opportunities, name='contact_opportunities',
+    ),
+    path('api/locations/<str:location_id>/revenue/', views.location_revenue, name='location_revenue'),
 
     
 
@@ -1,42 +1,36 @@
-import requests
 import logging
-import pytz
-from datetime import datetime
-from django.utils.timezone import now
+from datetime import datetime, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
 from django.conf import settings
-from .models import GHLOAuth
+from .custom_fields import get_custom_field_definitions
+from .tokens import get_access_token
 
 def refresh_ghl_token(location_id):
-    try:
-        token_obj = GHLOAuth.objects.get(location_id=location_id)
-        if token_obj.expires_at > now():
-            return token_obj.access_token  # Token is still valid
-
-        refresh_data = {
-            "client_id": settings.GHL_CLIENT_ID,
-            "client_secret": settings.GHL_CLIENT_SECRET,
-            "grant_type": "refresh_token",
-            "refresh_token": token_obj.refresh_token,
-        }
-
-        response = requests.post("https://app.gohighlevel.com/oauth/token", data=refresh_data)
-        if response.status_code != 200:
-            return None
-
-        token_info = response.json()
-        token_obj.access_token = token_info["access_token"]
-        token_obj.refresh_token = token_info["refresh_token"]
-        token_obj.expires_at = now() + datetime.timedelta(seconds=token_info["expires_in"])
-        token_obj.save()
-        
-        return token_obj.access_token
-    except GHLOAuth.DoesNotExist:
-        return None
+    """Valid access token for the location; refreshes go through the token manager."""
+    return get_access_token(location_id)
 
 
 contact_logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=None)
+def get_timezone(timezone_str):
+    # zoneinfo's C implementation converts several times faster than pytz.
+    return ZoneInfo(timezone_str)
+
+
+def parse_utc_timestamp(utc_time_str):
+    """
+    Parse an ISO-8601 timestamp from the API into an aware UTC datetime.
+    Accepts values with or without fractional seconds; naive values are UTC.
+    """
+    utc_time = datetime.fromisoformat(utc_time_str)
+    if utc_time.tzinfo is None:
+        return utc_time.replace(tzinfo=timezone.utc)
+    return utc_time.astimezone(timezone.utc)
+
+
 def convert_to_timezone(utc_time_str, timezone_str):
     """
     Converts UTC time string to the specified timezone.
@@ -45,43 +39,63 @@ def convert_to_timezone(utc_time_str, timezone_str):
         return None
 
     try:
-        # Convert string to datetime object
-        utc_time = datetime.strptime(utc_time_str, "%Y-%m-%dT%H:%M:%S.%fZ")
-
-        # Set as UTC timezone
-        utc_time = utc_time.replace(tzinfo=pytz.utc)
+        return parse_utc_timestamp(utc_time_str).astimezone(get_timezone(timezone_str))
 
-        # Convert to target timezone
-        target_timezone = pytz.timezone(timezone_str)
-        local_time = utc_time.astimezone(target_timezone)
+    except ValueError:
+        contact_logger.error(f"Invalid date format: {utc_time_str}")
+        return None
 
-        return local_time  # Returns a timezone-aware datetime object
 
+def _parse_or_none(utc_time_str):
+    if not utc_time_str:
+        return None
+    try:
+        return datetime.fromisoformat(utc_time_str)
     except ValueError:
         contact_logger.error(f"Invalid date format: {utc_time_str}")
         return None
 
 
+def convert_timestamps(values, timezone_str=None):
+    """
+    Convert a page's worth of API timestamps in one call.
+
+    Returns aware datetimes in ``timezone_str`` (default
+    ``settings.GHL_TIMEZONE``), or plain UTC datetimes when
+    ``settings.GHL_STORE_UTC`` is on. Either way they are stored in UTC;
+    the read API and admin convert for display (see ``to_local``).
+    """
+    try:
+        parsed = [datetime.fromisoformat(value) if value else None for value in values]
+    except ValueError:
+        # Slow path only for pages holding a malformed value.
+        parsed = [_parse_or_none(value) for value in values]
+
+    utc = timezone.utc
+    target = utc if settings.GHL_STORE_UTC else get_timezone(timezone_str or settings.GHL_TIMEZONE)
+    return [
+        None if value is None else (value if value.tzinfo else value.replace(tzinfo=utc)).astimezone(target)
+        for value in parsed
+    ]
+
+
+def to_local(value, timezone_str=None):
+    """Display conversion for stored (UTC) timestamps; naive values are UTC."""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(get_timezone(timezone_str or settings.GHL_TIMEZONE))
+
+
 def get_custom_field_name(location_id, field_id, access_token):
     """
-    Fetch custom field name from API and store it in the database.
+    Look up a custom field definition in the location's cached definitions
+    (one bulk API call per location, not one per field).
     """
     try:
-        url = f"https://services.leadconnectorhq.com/locations/{location_id}/customFields/{field_id}"
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Version": "2021-07-28",
-            "Content-Type": "application/json",
-            "Accept": "application/json"
-        }
-        response = requests.get(url, headers=headers)
-
-        if response.status_code == 200:
-            field_data = response.json()
-            return field_data if isinstance(field_data, dict) else {"name": "Unknown Field"}
-
-        contact_logger.error(f"Failed to fetch custom field {field_id}, status: {response.status_code}")
-        return {"name": "Unknown Field"}
+        field_data = get_custom_field_definitions(location_id, access_token).get(field_id)
+        return field_data if isinstance(field_data, dict) else {"name": "Unknown Field"}
 
     except Exception as e:
         contact_logger.error(f"Error fetching custom field {field_id}: {str(e)}")
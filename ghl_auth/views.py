@@ -1,13 +1,28 @@
 from datetime import timedelta,datetime
 from django.shortcuts import redirect, render
+from django.urls import reverse
 from django.conf import settings
-import requests
 import urllib.parse
 from django.utils.timezone import now
-from .models import GHLOAuth,Contact
-from django.http import JsonResponse
+from .models import GHLOAuth,Contact, Opportunity, OpportunityRollup, SyncRun, SyncState, WebhookEvent
+from django.http import HttpResponse, JsonResponse
+import base64
+import json
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
 import logging
-from .tasks import fetch_contacts_task,fetch_opportunities_task
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_GET, require_POST
+from celery.utils import uuid
+from .tasks import fetch_contacts_task,fetch_opportunities_task, schedule_webhook_flush
+from .ghl_client import get_client
+from .tokens import get_token_manager
+from .leases import SyncLease
+from .scheduling import plan_location
+from .utils import to_local
+from .read_cache import cached_json, response_etag, response_last_modified
+from .webhooks import claim_event, event_entity, release_event, verify_signature
+from . import metrics
 
 
 
@@ -45,8 +60,6 @@ def exchange_code_for_token(request):
         if not auth_code or not location_id:
             return JsonResponse({"error": "Missing required fields"}, status=400)
 
-        url = "https://services.leadconnectorhq.com/oauth/token"
-        
         data = {
             "grant_type": "authorization_code",
             "code": auth_code,
@@ -56,7 +69,7 @@ def exchange_code_for_token(request):
         }
 
 
-        response = requests.post(url, data=data)
+        response = get_client().post("/oauth/token", data=data, retry=False)
 
 
         
@@ -75,6 +88,8 @@ def exchange_code_for_token(request):
                         "expires_at": expires_at
                     }
                 )
+                get_token_manager().invalidate(location_id)
+                plan_location(location_id)  # start polling without waiting for the next re-plan
 
                 
                 return render(request, "success.html", {"message": "Access token generated and location saved!", 
@@ -98,16 +113,212 @@ def exchange_code_for_token(request):
 
 contact_logger = logging.getLogger(__name__)
 def fetch_contacts(request, location_id):
-    task1 = fetch_contacts_task.delay(location_id)
-    task2 = fetch_opportunities_task.delay(location_id)
+    """
+    Queue a contact and an opportunity sync of the location. An entity whose
+    sync is already queued or running is not queued again; the response
+    carries the in-flight task and run ids instead.
+    """
+    syncs = {}
+    for entity, task in ((SyncState.CONTACTS, fetch_contacts_task), (SyncState.OPPORTUNITIES, fetch_opportunities_task)):
+        # Claimed before queueing so two clicks can't both queue; the worker adopts the claim.
+        lease = SyncLease(location_id, entity, task_id=uuid())
+        if not lease.acquire():
+            holder = lease.holder
+            syncs[entity] = {"task_id": holder.get("task_id"), "run_id": holder.get("run_id"), "attached": True}
+            continue
+        try:
+            task.apply_async(args=[location_id], task_id=lease.task_id)
+        except Exception:
+            lease.release()
+            raise
+        syncs[entity] = {"task_id": lease.task_id, "run_id": None, "attached": False}
+
     return JsonResponse({
         "message": "Tasks started",
         "task_ids": {
-            "task1_id": task1.id,
-            "task2_id": task2.id
-        }
+            "task1_id": syncs[SyncState.CONTACTS]["task_id"],
+            "task2_id": syncs[SyncState.OPPORTUNITIES]["task_id"],
+        },
+        "syncs": syncs,
+        "status_url": request.build_absolute_uri(reverse("sync_status", args=[location_id])),
     }, status=202)
 
 
+def sync_status(request, location_id):
+    """
+    Latest contact and opportunity run of a location. Served from the cache
+    between flushes, so dashboards can poll it often.
+    """
+    runs = SyncRun.status_for(location_id)
+    stale_before = now() - timedelta(minutes=settings.GHL_SYNC_RUN_STALE_MINUTES)
+    for entity, run in runs.items():
+        if run:
+            # A running sync that stopped reporting flushes has lost its worker.
+            stuck = run["status"] == SyncRun.RUNNING and datetime.fromisoformat(run["updated_at"]) < stale_before
+            runs[entity] = {**run, "stuck": stuck}
+    return JsonResponse({"location_id": location_id, "runs": runs})
+
+
+@csrf_exempt
+@require_POST
+def ghl_webhook(request):
+    """
+    Receive GHL contact and opportunity events. Only verifies and buffers;
+    ``flush_webhook_events`` writes them in batches shortly after.
+    """
+    if not verify_signature(request.body, request.headers):
+        return JsonResponse({"error": "Invalid signature"}, status=401)
+
+    try:
+        payload = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+
+    event_type = payload.get("type") or ""
+    entity = event_entity(event_type)
+    if entity is None or not payload.get("id") or not payload.get("locationId"):
+        return JsonResponse({"status": "ignored"})
+
+    webhook_id = payload.get("webhookId")
+    if not claim_event(webhook_id):
+        return JsonResponse({"status": "duplicate"})
+
+    try:
+        WebhookEvent.objects.create(
+            location_id=payload["locationId"],
+            event_type=event_type,
+            entity=entity,
+            object_id=payload["id"],
+            payload=payload,
+        )
+    except Exception:
+        release_event(webhook_id)
+        raise
+    schedule_webhook_flush()
+    return JsonResponse({"status": "accepted"}, status=202)
+
+
+def metrics_view(request):
+    """Prometheus scrape target; merges every process's snapshot when GHL_METRICS_DIR is set."""
+    if not metrics.authorized(request.META.get("REMOTE_ADDR"), request.headers.get("Authorization")):
+        return HttpResponse("Forbidden", status=403)
+    return HttpResponse(metrics.render(metrics.collect()), content_type=metrics.CONTENT_TYPE)
+
+
+# Read API. Responses are cached per location until the next sync batch or
+# webhook flush for it commits; see read_cache.
+
+CONTACT_FIELDS = (
+    "contact_id", "first_name", "last_name", "email", "phone", "opportunity", "custom_fields", "created_at", "updated_at",
+)
+OPPORTUNITY_FIELDS = ("opportunity_id", "contact_id", "name", "phone", "monetaryValue", "created_at", "updated_at")
+
+
+def encode_cursor(updated_at, pk):
+    return base64.urlsafe_b64encode(json.dumps([updated_at.isoformat(), pk]).encode()).decode()
+
+
+def decode_cursor(value):
+    """``(updated_at, id)`` of the last row of the previous page; ValueError if malformed."""
+    try:
+        updated_at, pk = json.loads(base64.urlsafe_b64decode(value.encode()))
+        updated_at = datetime.fromisoformat(updated_at)
+        if updated_at.tzinfo is None:
+            raise ValueError("cursor timestamp has no UTC offset")
+        return updated_at, int(pk)
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {str(e)}")
+
+
+def keyset_page(queryset, fields, cursor, limit):
+    """
+    One page ordered by ``(updated_at, id)``, starting after ``cursor``.
+    Seeks on the index instead of counting past an OFFSET, so every page
+    costs the same however deep the client has paged.
+    """
+    if cursor:
+        updated_at, pk = cursor
+        queryset = queryset.filter(Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, id__gt=pk))
+    rows = list(queryset.order_by("updated_at", "id").values("id", *fields)[:limit + 1])
+    next_cursor = encode_cursor(rows[limit - 1]["updated_at"], rows[limit - 1]["id"]) if len(rows) > limit else None
+    items = rows[:limit]
+    for row in items:
+        del row["id"]
+        for field in ("created_at", "updated_at"):
+            if field in row:
+                row[field] = to_local(row[field])
+    return items, next_cursor
+
+
+def page_params(request):
+    """``(cursor, limit)`` from the query string; ValueError if either is malformed."""
+    limit = min(int(request.GET.get("limit") or settings.GHL_READ_PAGE_SIZE), settings.GHL_READ_PAGE_MAX)
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    cursor = request.GET.get("cursor")
+    return (decode_cursor(cursor) if cursor else None), limit
+
+
+@require_GET
+@condition(etag_func=response_etag, last_modified_func=response_last_modified)
+def location_contacts(request, location_id):
+    """Contacts of a location, oldest update first; follow ``next_cursor`` for more."""
+    try:
+        cursor, limit = page_params(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    def build():
+        contacts, next_cursor = keyset_page(Contact.objects.filter(location_id=location_id), CONTACT_FIELDS, cursor, limit)
+        return json.dumps({"location_id": location_id, "contacts": contacts, "next_cursor": next_cursor}, cls=DjangoJSONEncoder)
+
+    return cached_json(request, location_id, build)
+
+
+@require_GET
+@condition(etag_func=response_etag, last_modified_func=response_last_modified)
+def contact_opportunities(request, location_id, contact_id):
+    try:
+        cursor, limit = page_params(request)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    def build():
+        queryset = Opportunity.objects.filter(location_id=location_id, contact_id=contact_id)
+        opportunities, next_cursor = keyset_page(queryset, OPPORTUNITY_FIELDS, cursor, limit)
+        return json.dumps({
+            "location_id": location_id, "contact_id": contact_id,
+            "opportunities": opportunities, "next_cursor": next_cursor,
+        }, cls=DjangoJSONEncoder)
+
+    return cached_json(request, location_id, build)
+
 
+@require_GET
+@condition(etag_func=response_etag, last_modified_func=response_last_modified)
+def location_revenue(request, location_id):
+    """Opportunity count and value of a location, in total and per pipeline stage and status."""
+    def build():
+        pipelines = {}
+        opportunities, revenue = 0, 0.0
+        rollups = OpportunityRollup.objects.filter(location_id=location_id, opportunities__gt=0).order_by(
+            "pipeline_id", "pipeline_stage_id", "status",
+        )
+        for rollup in rollups:
+            opportunities += rollup.opportunities
+            revenue += rollup.monetary_value
+            pipelines.setdefault(rollup.pipeline_id, []).append({
+                "stage_id": rollup.pipeline_stage_id,
+                "status": rollup.status,
+                "opportunities": rollup.opportunities,
+                "revenue": rollup.monetary_value,
+            })
+        return json.dumps({
+            "location_id": location_id,
+            "contacts": Contact.objects.filter(location_id=location_id).count(),
+            "opportunities": opportunities,
+            "revenue": revenue,
+            "pipelines": pipelines,
+        })
 
+    return cached_json(request, location_id, build)
@@ -0,0 +1,136 @@
+"""
+Signature checks and event coalescing for GHL webhooks. The view buffers
+events in ``WebhookEvent``; ``tasks.flush_webhook_events`` drains them.
+"""
+import base64
+import binascii
+import hashlib
+import hmac
+import logging
+from collections import defaultdict
+from functools import lru_cache
+
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import SyncState
+
+
+logger = logging.getLogger(__name__)
+
+# GHL signs the raw body with RSA-SHA256 (base64) in this header.
+SIGNATURE_HEADER = "x-wh-signature"
+# Only with GHL_WEBHOOK_SECRET set: hex HMAC-SHA256 from a proxy that re-signs events.
+HMAC_SIGNATURE_HEADER = "x-ghl-signature"
+
+ENTITY_PREFIXES = {
+    "Contact": SyncState.CONTACTS,
+    "Opportunity": SyncState.OPPORTUNITIES,
+}
+
+
+@lru_cache(maxsize=4)
+def load_public_key(pem):
+    return serialization.load_pem_public_key(pem.encode())
+
+
+def verify_rsa_signature(body, signature):
+    """``signature``: base64 RSA-SHA256 (PKCS#1 v1.5) of the raw body under ``GHL_WEBHOOK_PUBLIC_KEY``."""
+    pem = settings.GHL_WEBHOOK_PUBLIC_KEY
+    if not pem or not signature:
+        return False
+    try:
+        load_public_key(pem).verify(base64.b64decode(signature), body, padding.PKCS1v15(), hashes.SHA256())
+    except (InvalidSignature, binascii.Error, ValueError):
+        return False
+    return True
+
+
+def verify_hmac_signature(body, signature):
+    """Hex HMAC-SHA256 of the raw body with ``GHL_WEBHOOK_SECRET``; off unless the secret is set."""
+    secret = settings.GHL_WEBHOOK_SECRET
+    if not secret or not signature:
+        return False
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, signature.strip().lower())
+
+
+def verify_signature(body, headers):
+    """Whether the request is from GHL, or from the re-signing proxy when one is configured."""
+    if verify_rsa_signature(body, headers.get(SIGNATURE_HEADER)):
+        return True
+    return verify_hmac_signature(body, headers.get(HMAC_SIGNATURE_HEADER))
+
+
+def seen_key(webhook_id):
+    return f"ghl:webhook:seen:{webhook_id}"
+
+
+def claim_event(webhook_id):
+    """
+    False if an event with this ``webhookId`` was already accepted within
+    ``GHL_WEBHOOK_DEDUPE_SECONDS``, so a redelivery is never applied twice.
+    """
+    if not webhook_id:
+        return True
+    return cache.add(seen_key(webhook_id), 1, timeout=settings.GHL_WEBHOOK_DEDUPE_SECONDS)
+
+
+def release_event(webhook_id):
+    """Forget a claim whose event could not be buffered, so GHL's retry is accepted."""
+    if webhook_id:
+        cache.delete(seen_key(webhook_id))
+
+
+def event_entity(event_type):
+    """``SyncState`` entity of a webhook type such as ``ContactUpdate``, or None if not handled."""
+    for prefix, entity in ENTITY_PREFIXES.items():
+        if event_type.startswith(prefix):
+            return entity
+    return None
+
+
+def is_delete(event_type):
+    return event_type.endswith("Delete")
+
+
+def as_search_record(entity, payload, received_at):
+    """
+    Shape a webhook payload like a search API record so the sync transforms
+    can project it. Webhooks carry ``firstName``/``dateAdded`` and may have
+    no update timestamp; the receive time stands in for missing timestamps.
+    """
+    record = dict(payload)
+    if entity == SyncState.CONTACTS:
+        record.setdefault("firstNameLowerCase", (payload.get("firstName") or "").lower())
+        record.setdefault("lastNameLowerCase", (payload.get("lastName") or "").lower())
+        created_key, updated_key = "dateAdded", "dateUpdated"
+    else:
+        record.setdefault("createdAt", payload.get("dateAdded"))
+        created_key, updated_key = "createdAt", "updatedAt"
+    for key in (created_key, updated_key):
+        if not record.get(key):
+            record[key] = received_at.isoformat()
+    return record
+
+
+def coalesce_events(events):
+    """
+    Collapse buffered events (oldest first) to the last change per object.
+    Returns ``{entity: {location_id: ({object_id: record}, {deleted ids})}}``.
+    """
+    latest = {}
+    for event in events:
+        latest[(event.entity, event.object_id)] = event
+
+    changes = defaultdict(lambda: defaultdict(lambda: ({}, set())))
+    for (entity, object_id), event in latest.items():
+        upserts, deletes = changes[entity][event.location_id]
+        if is_delete(event.event_type):
+            deletes.add(object_id)
+        else:
+            upserts[object_id] = as_search_record(entity, event.payload, event.received_at)
+    return changes
@@ -10,17 +10,16 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
 app.conf.beat_schedule = {
-    "fetch-contact-every-hour": {
-        "task": "ghl_auth.tasks.fetch_contacts_task",
-        "schedule": crontab(minute=0, hour='*/1'),
+    # Each location is polled by its own periodic task (see ghl_auth.scheduling),
+    # stored in the database; this re-plans their intervals from recent change rates.
+    "plan-sync-schedules-hourly": {
+        "task": "ghl_auth.tasks.plan_sync_schedules",
+        "schedule": crontab(minute=15),
     },
-    "fetch-opportunities-every-hour": {
-        "task": "ghl_auth.tasks.fetch_opportunities_task",
-        "schedule": crontab(minute=0, hour='*/1'),
-    },
-    "update-contact-opportunity-totals-every-hour": {  
+    # Totals are kept current by every opportunity batch; this is the repair pass.
+    "rebuild-contact-opportunity-totals-daily": {
         "task": "ghl_auth.tasks.update_contact_opportunity_totals",
-        "schedule": crontab(minute=0, hour='*/1'),
+        "schedule": crontab(minute=30, hour=3),
     },
 }
 
@@ -1,5 +1,7 @@
 from dotenv import load_dotenv
 import os
+import sys
+import tempfile
 
 load_dotenv()
 
@@ -71,10 +73,41 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # WAL lets readers run alongside the writer. IMMEDIATE transactions take
+        # the write lock up front, so concurrent writers wait out the timeout
+        # instead of failing with "database is locked" halfway through.
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY',
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 30,
+        },
     }
 }
 
 
+# Shared state between web and Celery processes: rate limits, sync leases,
+# token refresh locks and read/status cache versions only work across
+# processes when this is shared, so it defaults to the broker's Redis (its
+# own database). The test runner gets a local-memory cache instead;
+# CACHE_URL=locmem:// opts into one for a single-process setup.
+CACHE_URL = os.getenv("CACHE_URL", "redis://localhost:6379/2")
+TESTING = len(sys.argv) > 1 and sys.argv[1] == "test"
+
+if TESTING or CACHE_URL.startswith("locmem://"):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_URL,
+        }
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -123,7 +156,126 @@ SCOPE = os.getenv("SCOPE")
 
 
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
+# Keeps task results (e.g. the IDs returned by the fetch-contacts view) queryable.
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", 'redis://localhost:6379/1')
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_TIMEZONE = "Asia/Kolkata" 
-
+# Periodic tasks live in the database so per-location schedules change without a redeploy.
+CELERY_BEAT_SCHEDULER = "django_celery_beat.schedulers:DatabaseScheduler"
+
+
+
+GHL_API_BASE_URL = os.getenv("GHL_API_BASE_URL", "https://services.leadconnectorhq.com")
+GHL_API_VERSION = os.getenv("GHL_API_VERSION", "2021-07-28")
+GHL_HTTP_TIMEOUT = float(os.getenv("GHL_HTTP_TIMEOUT", "30"))
+GHL_HTTP_POOL_SIZE = int(os.getenv("GHL_HTTP_POOL_SIZE", "10"))
+GHL_HTTP_MAX_RETRIES = int(os.getenv("GHL_HTTP_MAX_RETRIES", "3"))
+GHL_HTTP_BACKOFF = float(os.getenv("GHL_HTTP_BACKOFF", "1"))
+
+# Max number of per-location sync subtasks in flight for one fan-out dispatch.
+GHL_SYNC_FANOUT_CONCURRENCY = int(os.getenv("GHL_SYNC_FANOUT_CONCURRENCY", "8"))
+
+# Incremental sync: regular runs only fetch records changed since the stored
+# watermark (minus the overlap); a full resync runs at least this often.
+GHL_FULL_RESYNC_HOURS = int(os.getenv("GHL_FULL_RESYNC_HOURS", "24"))
+GHL_DELTA_OVERLAP_SECONDS = int(os.getenv("GHL_DELTA_OVERLAP_SECONDS", "300"))
+# Pagination checkpoints older than this are discarded and the location restarts from page one.
+GHL_CHECKPOINT_MAX_AGE_HOURS = int(os.getenv("GHL_CHECKPOINT_MAX_AGE_HOURS", "6"))
+GHL_HTTP_BACKOFF_MAX = float(os.getenv("GHL_HTTP_BACKOFF_MAX", "60"))
+
+# Shared request budgets per GHL_RATE_LIMIT_WINDOW_SECONDS window. GHL allows
+# 100 requests per 10 seconds per location; 0 disables a bucket.
+GHL_RATE_LIMIT_WINDOW_SECONDS = int(os.getenv("GHL_RATE_LIMIT_WINDOW_SECONDS", "10"))
+GHL_RATE_LIMIT_LOCATION_REQUESTS = int(os.getenv("GHL_RATE_LIMIT_LOCATION_REQUESTS", "100"))
+GHL_RATE_LIMIT_APP_REQUESTS = int(os.getenv("GHL_RATE_LIMIT_APP_REQUESTS", "1000"))
+
+# Overlap page fetching, row transformation and DB writes in separate stages;
+# at most GHL_PIPELINE_QUEUE_SIZE pages are buffered between two stages.
+GHL_SYNC_PIPELINED = os.getenv("GHL_SYNC_PIPELINED", "false").lower() == "true"
+GHL_PIPELINE_QUEUE_SIZE = int(os.getenv("GHL_PIPELINE_QUEUE_SIZE", "4"))
+
+# Location streams kept in flight by the asyncio engine (use_async=True) in one
+# worker process. Keep GHL_HTTP_POOL_SIZE at least this large.
+GHL_ASYNC_CONCURRENCY = int(os.getenv("GHL_ASYNC_CONCURRENCY", "10"))
+
+# Timezone synced timestamps are shown in by the read API and admin; they are
+# stored in UTC. GHL_STORE_UTC skips converting them to it on ingest as well.
+GHL_TIMEZONE = os.getenv("GHL_TIMEZONE", "Asia/Kolkata")
+GHL_STORE_UTC = os.getenv("GHL_STORE_UTC", "false").lower() == "true"
+
+# Custom field definitions per location: in-process LRU in front of the shared cache.
+GHL_CUSTOM_FIELD_CACHE_SIZE = int(os.getenv("GHL_CUSTOM_FIELD_CACHE_SIZE", "512"))
+GHL_CUSTOM_FIELD_CACHE_TTL = int(os.getenv("GHL_CUSTOM_FIELD_CACHE_TTL", "3600"))
+
+# Access tokens are refreshed this long before they expire, by one worker per
+# location holding a lock for at most GHL_TOKEN_LOCK_TIMEOUT_SECONDS (never
+# less than one refresh request can take); others wait up to
+# GHL_TOKEN_WAIT_SECONDS for the new token.
+GHL_TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("GHL_TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+GHL_TOKEN_LOCK_TIMEOUT_SECONDS = int(os.getenv("GHL_TOKEN_LOCK_TIMEOUT_SECONDS", "90"))
+GHL_TOKEN_WAIT_SECONDS = int(os.getenv("GHL_TOKEN_WAIT_SECONDS", "15"))
+
+# Webhooks: GHL's published webhook public key (PEM, \n escapes allowed) that
+# x-wh-signature is checked against; GHL_WEBHOOK_SECRET only for a proxy that re-signs events
+# with HMAC-SHA256 in X-GHL-Signature (leave empty otherwise). Events are
+# buffered before one flush writes them (up to GHL_WEBHOOK_FLUSH_BATCH_SIZE per transaction).
+# A redelivered webhookId is ignored for GHL_WEBHOOK_DEDUPE_SECONDS (a week) after it was accepted.
+GHL_WEBHOOK_PUBLIC_KEY = os.getenv("GHL_WEBHOOK_PUBLIC_KEY", "").replace("\\n", "\n")
+GHL_WEBHOOK_SECRET = os.getenv("GHL_WEBHOOK_SECRET", "")
+GHL_WEBHOOK_FLUSH_DELAY_SECONDS = float(os.getenv("GHL_WEBHOOK_FLUSH_DELAY_SECONDS", "0.3"))
+GHL_WEBHOOK_FLUSH_BATCH_SIZE = int(os.getenv("GHL_WEBHOOK_FLUSH_BATCH_SIZE", "3000"))
+GHL_WEBHOOK_DEDUPE_SECONDS = int(os.getenv("GHL_WEBHOOK_DEDUPE_SECONDS", "604800"))
+
+# Metrics: snapshot directory shared by the web app and worker processes on a
+# host (empty keeps metrics per process, so a prefork worker's /metrics misses
+# its children's), and the port workers serve /metrics on (0 disables).
+GHL_METRICS_DIR = os.getenv("GHL_METRICS_DIR", "" if TESTING else os.path.join(tempfile.gettempdir(), "ghl-metrics"))
+GHL_METRICS_PORT = int(os.getenv("GHL_METRICS_PORT", "9808"))
+GHL_METRICS_SNAPSHOT_SECONDS = int(os.getenv("GHL_METRICS_SNAPSHOT_SECONDS", "15"))
+# Bearer token /metrics scrapes must send; without one only loopback and
+# private-network clients may scrape (labels include location IDs).
+GHL_METRICS_TOKEN = os.getenv("GHL_METRICS_TOKEN", "")
+
+# Sync status endpoint: cached reads (invalidated on every run update) and the
+# silence after which a running sync is reported as stuck.
+GHL_SYNC_STATUS_CACHE_SECONDS = int(os.getenv("GHL_SYNC_STATUS_CACHE_SECONDS", "60"))
+GHL_SYNC_RUN_STALE_MINUTES = int(os.getenv("GHL_SYNC_RUN_STALE_MINUTES", "15"))
+
+# Content hashes of up to this many rows per location are held in memory
+# during a sync; bigger locations look them up per batch.
+GHL_HASH_INDEX_MAX_ROWS = int(os.getenv("GHL_HASH_INDEX_MAX_ROWS", "250000"))
+
+# A location/entity sync holds a lease this long, renewed while it makes
+# progress; a crashed worker's lease lapses after it.
+GHL_SYNC_LEASE_SECONDS = int(os.getenv("GHL_SYNC_LEASE_SECONDS", "600"))
+
+# Per-location polling: each interval aims for GHL_SCHEDULE_TARGET_ROWS changes
+# per delta sync, from the delta runs of the last GHL_SCHEDULE_WINDOW_HOURS,
+# bounded to [MIN, MAX] minutes; locations without history use the default.
+GHL_SCHEDULE_TARGET_ROWS = int(os.getenv("GHL_SCHEDULE_TARGET_ROWS", "500"))
+GHL_SCHEDULE_WINDOW_HOURS = int(os.getenv("GHL_SCHEDULE_WINDOW_HOURS", "24"))
+GHL_SCHEDULE_MIN_MINUTES = int(os.getenv("GHL_SCHEDULE_MIN_MINUTES", "5"))
+GHL_SCHEDULE_MAX_MINUTES = int(os.getenv("GHL_SCHEDULE_MAX_MINUTES", "360"))
+GHL_SCHEDULE_DEFAULT_MINUTES = int(os.getenv("GHL_SCHEDULE_DEFAULT_MINUTES", "60"))
+
+# Read API: page sizes, and how long a cached response lives (it is also
+# invalidated as soon as a sync batch or webhook flush for its location commits).
+GHL_READ_PAGE_SIZE = int(os.getenv("GHL_READ_PAGE_SIZE", "100"))
+GHL_READ_PAGE_MAX = int(os.getenv("GHL_READ_PAGE_MAX", "1000"))
+GHL_READ_CACHE_SECONDS = int(os.getenv("GHL_READ_CACHE_SECONDS", "300"))
+
+# Admin: changelists count at most this many rows, and a contact's page lists
+# up to GHL_ADMIN_INLINE_OPPORTUNITIES of its latest opportunities.
+GHL_ADMIN_COUNT_CAP = int(os.getenv("GHL_ADMIN_COUNT_CAP", "10000"))
+GHL_ADMIN_INLINE_OPPORTUNITIES = int(os.getenv("GHL_ADMIN_INLINE_OPPORTUNITIES", "50"))
+
+# Sync write mode: "direct" (each fetch worker writes its own batches) or
+# "funnel" (workers queue batches for the single run_batch_writer process,
+# which commits up to GHL_WRITER_MAX_ROWS rows or GHL_WRITER_MAX_WAIT_SECONDS
+# of batches per transaction). Use the funnel with SQLite and parallel workers.
+GHL_SYNC_WRITE_MODE = os.getenv("GHL_SYNC_WRITE_MODE", "direct")
+GHL_WRITER_BROKER_URL = os.getenv("GHL_WRITER_BROKER_URL", CELERY_BROKER_URL)
+GHL_WRITER_QUEUE = os.getenv("GHL_WRITER_QUEUE", "ghl.sync.writes")
+GHL_WRITER_MAX_ROWS = int(os.getenv("GHL_WRITER_MAX_ROWS", "20000"))
+GHL_WRITER_MAX_WAIT_SECONDS = float(os.getenv("GHL_WRITER_MAX_WAIT_SECONDS", "0.5"))